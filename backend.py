@@ -1,76 +1,163 @@
+from itertools import islice
+from typing import Optional
+import atexit
+import json
 import os.path
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 from pathlib import Path
 
 from library.anki_client import AnkiConnectClient
+from library.anki_mirror import AnkiMirror
+from library.database_interface import DATABASE_ROOT
+from library.sentence_lookup import SentenceLookup
 from model.card_manager import CardManager
 
 ANKI_CONNECT_HOST = "localhost"
 ANKI_CONNECT_PORT = 8765
 CARD_MANAGER_FILE = os.path.join("data", "card_manager_save.json")
+CORPUS_DB_FILE = DATABASE_ROOT
+SENTENCE_CACHE_SIZE = 1024
+ANKI_MIRROR_FILE = os.path.join("data", "anki_mirror.db")
+# imports sync the local Anki mirror first, unless that was tried less than this many seconds ago
+ANKI_SYNC_INTERVAL = 30
+# cards added per step of an import, and per progress line when it is streamed
+IMPORT_PAGE_SIZE = 100
 
 app = Flask(__name__)
 CORS(app)
 
-anki_client = AnkiConnectClient(ANKI_CONNECT_HOST, ANKI_CONNECT_PORT)
-card_manager = CardManager.load_from_file(Path(CARD_MANAGER_FILE))
+# set by init_backend
+anki_client = None  # type: Optional[AnkiConnectClient]
+anki_mirror = None  # type: Optional[AnkiMirror]
+card_manager = None  # type: Optional[CardManager]
+sentence_lookup = None  # type: Optional[SentenceLookup]
+
+
+def init_backend(card_manager_file: str = CARD_MANAGER_FILE, corpus_db_file: str = CORPUS_DB_FILE,
+                 anki_mirror_file: str = ANKI_MIRROR_FILE, anki_host: str = ANKI_CONNECT_HOST,
+                 anki_port: int = ANKI_CONNECT_PORT) -> Flask:
+    """
+    Open the card list, corpus and Anki mirror the routes work on and return the app. Importing this module touches no
+    files, so the benchmarks can point the routes at scratch copies instead of the user's data.
+    """
+    global anki_client, anki_mirror, card_manager, sentence_lookup
+    anki_client = AnkiConnectClient(anki_host, anki_port)
+    anki_mirror = AnkiMirror(anki_mirror_file, anki_client)
+    card_manager = CardManager.load_from_file(Path(card_manager_file))
+    sentence_lookup = SentenceLookup(corpus_db_file, cache_size=SENTENCE_CACHE_SIZE)
+    return app
+
+
+def _words_data(cards):
+    return [{"word": card.first_field, "id": card.cardId} for card in cards]
+
+
+def _current_words_response():
+    return jsonify(_words_data(card_manager.get_current_cards()))
+
+
+def _import_pages(card_ids, added, skipped):
+    """
+    Read the cards from the Anki mirror a page at a time and add each page to the current list, deduplicating by
+    (cardId, deckName) across the whole import. Fills added and skipped (already current or repeated) and yields the
+    progress after each page.
+    """
+    cards = anki_mirror.iter_cards(card_ids)
+    seen_keys = set()
+    fetched = 0
+    while True:
+        page = list(islice(cards, IMPORT_PAGE_SIZE))
+        if not page:
+            break
+        fetched += len(page)
+
+        unique_cards = []
+        for card in page:
+            key = (card.cardId, card.deckName)
+            if key in seen_keys:
+                skipped.append(card.cardId)
+            else:
+                seen_keys.add(key)
+                unique_cards.append(card)
+        page_added = card_manager.add_cards(unique_cards)
+        added.extend(page_added)
+        added_ids = {card.cardId for card in page_added}
+        skipped.extend(card.cardId for card in unique_cards if card.cardId not in added_ids)
+        yield {"fetched": fetched, "total": len(card_ids), "added": len(added)}
+
+
+def _import_cards(card_ids):
+    """
+    Import the mirrored cards with these ids into the current list, returning the whole list, or with ?delta=1 only the
+    added cards and the ids of the skipped ones. With ?stream=1 the response is NDJSON: a progress line per page of
+    cards and a last line holding that result.
+    """
+    delta = request.args.get('delta', default=0, type=int)
+    added, skipped = [], []
+
+    def result():
+        if delta:
+            return {"added": _words_data(added), "skipped": skipped}
+        return _words_data(card_manager.get_current_cards())
+
+    if request.args.get('stream', default=0, type=int):
+        def generate():
+            for progress in _import_pages(card_ids, added, skipped):
+                yield json.dumps(progress) + "\n"
+            yield json.dumps({"done": True, "result": result()}, ensure_ascii=False) + "\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    # a single log write for the whole import
+    with card_manager.batch():
+        for _ in _import_pages(card_ids, added, skipped):
+            pass
+    return jsonify(result())
 
 
 @app.route('/api/words', methods=['GET'])
 def get_words():
-    current_cards = card_manager.get_current_cards()
-    words_data = [{"word": card.first_field, "id": card.cardId} for card in current_cards]
-    return jsonify(words_data)
+    return _current_words_response()
 
 
 @app.route('/api/sentences/<word>', methods=['GET'])
 def get_sentences(word):
-    dummy_sentences = {
-        "言葉": [
-            {"sentence": "これは言葉の例です。", "id": 101},
-            {"sentence": "言葉はコミュニケーションの基本です。", "id": 102},
-            {"sentence": "美しい言葉を使いましょう。", "id": 103},
-        ],
-        "勉強": [
-            {"sentence": "毎日勉強するのは大変です。", "id": 201},
-            {"sentence": "日本語の勉強は楽しいです。", "id": 202},
-            {"sentence": "勉強すればするほど賢くなります。", "id": 203},
-        ],
-        "難しい": [
-            {"sentence": "この問題は難しいですね。", "id": 301},
-            {"sentence": "難しい漢字はたくさんあります。", "id": 302},
-            {"sentence": "難しい決断を迫られています。", "id": 303},
-        ],
-        "例": [
-            {"sentence": "例を挙げてください。", "id": 401},
-            {"sentence": "例としてこれを考えてみましょう。", "id": 402},
-            {"sentence": "例はたくさんありますが、一つだけ挙げます。", "id": 403},
-        ],
-        "文章": [
-            {"sentence": "この文章は理解しやすいです。", "id": 501},
-            {"sentence": "文章を書くのは難しいです。", "id": 502},
-            {"sentence": "長い文章を読むのは疲れます。", "id": 503},
-        ],
-    }
-    if word in dummy_sentences:
-        return jsonify(dummy_sentences[word])
-    else:
-        return jsonify([])
+    offset = request.args.get('offset', default=0, type=int)
+    limit = request.args.get('limit', default=50, type=int)
+    sentences = sentence_lookup.get_sentences(word, offset=max(offset, 0), limit=max(limit, 0))
+    return jsonify([{"sentence": sentence.text, "id": f"{sentence.filename}:{sentence.line_number}"}
+                    for sentence in sentences])
+
+
+@app.route('/api/sentences/batch', methods=['POST'])
+def get_sentences_batch():
+    """Sentences for many words in one request, by default every word in the current card list."""
+    data = request.get_json(silent=True) or {}
+    words = data.get('words')
+    limit = data.get('limit', 50)
+    if words is None:
+        words = [card.first_field for card in card_manager.get_current_cards()]
+    if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+        return jsonify({"error": "words must be a list of strings"}), 400
+    # bool is an int subclass, but true/false aren't meant as limits
+    if not isinstance(limit, int) or isinstance(limit, bool):
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    sentences_by_word = sentence_lookup.get_sentences_batch(words, limit=max(limit, 0))
+    return jsonify({
+        word: [{"sentence": sentence.text, "id": f"{sentence.filename}:{sentence.line_number}"}
+               for sentence in sentences]
+        for word, sentences in sentences_by_word.items()
+    })
 
 
 @app.route('/api/anki_import_recent', methods=['GET'])
 def anki_import_recent():
     days = request.args.get('days', default=7, type=int)
     limit = request.args.get('limit', default=10, type=int)
-    recent_failed_cards = anki_client.get_failed_cards(days=days, limit=limit)
-    for card in recent_failed_cards:
-        card_manager.add_card(card)
-
-    current_cards = card_manager.get_current_cards()
-    words_data = [{"word": card.first_field, "id": card.cardId} for card in current_cards]
-    return jsonify(words_data)
+    anki_mirror.sync_if_stale(ANKI_SYNC_INTERVAL)
+    return _import_cards(anki_mirror.find_failed_card_ids(days=days, limit=limit))
 
 
 @app.route('/api/anki_import_difficult', methods=['GET'])
@@ -79,13 +166,8 @@ def anki_import_difficult():
     reps = request.args.get('reps', default=30, type=int)
     ease = request.args.get('ease', default=1.4, type=float)
 
-    difficult_cards = anki_client.get_difficult_cards(limit=limit, reps=reps, ease=ease)
-    for card in difficult_cards:
-        card_manager.add_card(card)
-
-    current_cards = card_manager.get_current_cards()
-    words_data = [{"word": card.first_field, "id": card.cardId} for card in current_cards]
-    return jsonify(words_data)
+    anki_mirror.sync_if_stale(ANKI_SYNC_INTERVAL)
+    return _import_cards(anki_mirror.find_difficult_card_ids(limit=limit, reps=reps, ease=ease))
 
 
 @app.route('/api/anki_import_exact', methods=['GET'])
@@ -96,13 +178,8 @@ def anki_import_exact():
     if not search:
         return jsonify({"error": "Search term is required"}), 400
 
-    exact_match_cards = anki_client.get_exact_matches_cards(search=search, limit=limit)
-    for card in exact_match_cards:
-        card_manager.add_card(card)
-
-    current_cards = card_manager.get_current_cards()
-    words_data = [{"word": card.first_field, "id": card.cardId} for card in current_cards]
-    return jsonify(words_data)
+    anki_mirror.sync_if_stale(ANKI_SYNC_INTERVAL)
+    return _import_cards(anki_mirror.find_exact_match_card_ids(search=search, limit=limit))
 
 
 @app.route('/api/remove_card', methods=['POST'])
@@ -113,31 +190,20 @@ def remove_card():
     if card_id is None:
         return jsonify({"error": "cardId is required"}), 400
 
-    card_to_remove = None
-    for card in card_manager.get_current_cards():
-        if card.cardId == card_id:
-            card_to_remove = card
-            break
-
+    card_to_remove = card_manager.get_by_id(card_id)
     if card_to_remove:
         card_manager.remove_card(card_to_remove)
     else:
         return jsonify({"error": f"Card with id {card_id} not found in current cards"}), 404
 
-    current_cards = card_manager.get_current_cards()
-    words_data = [{"word": card.first_field, "id": card.cardId} for card in current_cards]
-    return jsonify(words_data)
+    return _current_words_response()
 
 
 @app.route('/api/remove_all_cards', methods=['POST'])
 def remove_all_cards():
-    current_cards_copy = list(card_manager.get_current_cards())
-    for card in current_cards_copy:
-        card_manager.remove_card(card)
+    card_manager.remove_cards(card_manager.get_current_cards())
 
-    current_cards = card_manager.get_current_cards()
-    words_data = [{"word": card.first_field, "id": card.cardId} for card in current_cards]
-    return jsonify(words_data)
+    return _current_words_response()
 
 
 @app.route('/api/anki_open', methods=['POST'])
@@ -148,19 +214,29 @@ def anki_open():
     if card_id is None:
         return jsonify({"error": "cardId is required"}), 400
 
-    card_to_open = None
-    for card in card_manager.get_current_cards():
-        if card.cardId == card_id:
-            card_to_open = card
-            break
-
+    card_to_open = card_manager.get_by_id(card_id)
     if card_to_open:
-        anki_client.open_card_browser(card_to_open.note) # Use noteId
+        try:
+            anki_mirror.open_card_browser(card_to_open.note) # Use noteId
+        except Exception as e:
+            return jsonify({"error": f"Anki isn't reachable: {e}"}), 503
         return jsonify({"success": "Opened in Anki Browser"})
     else:
         return jsonify({"error": f"Card with id {card_id} not found in current cards"}), 404
 
 
+@app.route('/api/anki_sync', methods=['POST'])
+def anki_sync():
+    """Sync the local Anki mirror now; imports otherwise do it at most every ANKI_SYNC_INTERVAL seconds."""
+    synced = anki_mirror.sync()
+    return jsonify({"synced": synced, "last_sync": anki_mirror.last_sync})
+
+
 if __name__ == '__main__':
+    init_backend()
+    # debug mode runs this script twice: in a parent process that only watches for code changes and in the child that
+    # serves the requests; only the child's card list is current
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        atexit.register(card_manager.compact)
     app.run(debug=True, port=5001)
 
@@ -0,0 +1,104 @@
+"""
+Compares the per-row add_kanji_appearances/add_baseform_appearances path with AppearanceWriter.
+
+    python -m benchmarks.bench_appearance_inserts --lines 20000
+"""
+from pathlib import Path
+from typing import List, Tuple
+import argparse
+import random
+import sqlite3
+import tempfile
+import time
+
+from library.database_interface import (AppearanceWriter, add_baseform_appearances, add_kanji_appearances,
+                                        add_source_file, get_db_connection, initialize_database)
+
+# (sourcefile index, line number, kanji, baseforms)
+SyntheticLine = Tuple[int, int, List[str], List[str]]
+
+
+def generate_lines(line_count: int, chunk_size: int = 100, seed: int = 0) -> List[SyntheticLine]:
+    """Zipf-like term draws, so a few terms hit the cap quickly and a long tail never does."""
+    rng = random.Random(seed)
+    kanji_pool = [chr(0x4e00 + i) for i in range(3000)]
+    baseform_pool = [f"語{i}" for i in range(20000)]
+    kanji_weights = [1 / (rank + 1) for rank in range(len(kanji_pool))]
+    baseform_weights = [1 / (rank + 1) for rank in range(len(baseform_pool))]
+
+    lines = []
+    for i in range(line_count):
+        kanji = sorted(set(rng.choices(kanji_pool, kanji_weights, k=rng.randint(1, 12))))
+        baseforms = sorted(set(rng.choices(baseform_pool, baseform_weights, k=rng.randint(2, 10))))
+        lines.append((i // chunk_size, i % chunk_size, kanji, baseforms))
+    return lines
+
+
+def run_per_row(db_path: str, lines: List[SyntheticLine]) -> float:
+    initialize_database(db_path)
+    conn = get_db_connection(db_path)
+    start = time.perf_counter()
+    sourcefile_ids = {}
+    for chunk, line_number, kanji, baseforms in lines:
+        if chunk not in sourcefile_ids:
+            sourcefile_ids[chunk] = add_source_file(conn, f"chunk{chunk:06d}.txt")
+        add_kanji_appearances(conn, kanji, sourcefile_ids[chunk], line_number, max_appearances=50)
+        add_baseform_appearances(conn, baseforms, sourcefile_ids[chunk], line_number, max_appearances=50)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def run_batched(db_path: str, lines: List[SyntheticLine], batch_size: int = 32) -> float:
+    initialize_database(db_path)
+    conn = get_db_connection(db_path)
+    start = time.perf_counter()
+    writer = AppearanceWriter(conn, max_appearances=50)
+    sourcefile_ids = {}
+    for chunk, line_number, kanji, baseforms in lines:
+        if chunk not in sourcefile_ids:
+            if len(sourcefile_ids) % batch_size == 0:
+                writer.flush()
+            sourcefile_ids[chunk] = writer.add_source_file(f"chunk{chunk:06d}.txt")
+        writer.add_line(sourcefile_ids[chunk], line_number, kanji, baseforms)
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def dump_rows(db_path: str) -> Tuple[list, list]:
+    conn = sqlite3.connect(db_path)
+    kanji_rows = conn.execute("""
+        SELECT ka.kanji, sf.filename, ka.line_number FROM KanjiAppearances ka
+        JOIN SourceFiles sf ON ka.sourcefile_id = sf.id ORDER BY 1, 2, 3
+    """).fetchall()
+    baseform_rows = conn.execute("""
+        SELECT bfa.baseform, sf.filename, bfa.line_number FROM BaseFormAppearances bfa
+        JOIN SourceFiles sf ON bfa.sourcefile_id = sf.id ORDER BY 1, 2, 3
+    """).fetchall()
+    conn.close()
+    return kanji_rows, baseform_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    synthetic_lines = generate_lines(args.lines, seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        per_row_db = str(Path(tmp) / "per_row.db")
+        batched_db = str(Path(tmp) / "batched.db")
+        per_row_seconds = run_per_row(per_row_db, synthetic_lines)
+        batched_seconds = run_batched(batched_db, synthetic_lines)
+
+        per_row_result = dump_rows(per_row_db)
+        if per_row_result != dump_rows(batched_db):
+            raise AssertionError("batched writer produced different rows than the per-row path")
+        row_count = sum(len(rows) for rows in per_row_result)
+
+    print(f"{args.lines} lines, {row_count} appearance rows (identical in both paths)")
+    print(f"per-row: {per_row_seconds:8.2f}s  {row_count / per_row_seconds:12.0f} rows/sec")
+    print(f"batched: {batched_seconds:8.2f}s  {row_count / batched_seconds:12.0f} rows/sec")
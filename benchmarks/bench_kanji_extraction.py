@@ -0,0 +1,123 @@
+"""
+Compares the original kanji extraction (a per-character range check over every token surface) with the regex stage
+in library.kanji_extraction, per line and over a whole chunk. Each method is timed --repeats times and the fastest
+run is reported.
+
+    python -m benchmarks.bench_kanji_extraction --lines 20000
+"""
+from typing import Callable, List
+import argparse
+import random
+import re
+import time
+
+import fugashi
+
+from library.kanji_extraction import DEFAULT_KANJI_BLOCKS, compile_kanji_pattern, extract_kanji
+
+KANA = [chr(c) for c in range(0x3041, 0x3097)]
+PUNCTUATION = list("、。！？「」…")
+
+
+def generate_text(line_count: int, seed: int = 0) -> List[str]:
+    """Lines mixing kana, punctuation and Zipf-distributed kanji, roughly like script dialogue."""
+    rng = random.Random(seed)
+    kanji_pool = [chr(0x4e00 + i) for i in range(3000)]
+    kanji_weights = [1 / (rank + 1) for rank in range(len(kanji_pool))]
+    lines = []
+    for _ in range(line_count):
+        length = rng.randint(5, 60)
+        chars = []
+        for _ in range(length):
+            roll = rng.random()
+            if roll < 0.35:
+                chars.append(rng.choices(kanji_pool, kanji_weights)[0])
+            elif roll < 0.92:
+                chars.append(rng.choice(KANA))
+            else:
+                chars.append(rng.choice(PUNCTUATION))
+        lines.append(''.join(chars))
+    return lines
+
+
+def loop_over_surfaces(surfaces: List[List[str]]) -> List[List[str]]:
+    """The original loop, given each line's token surfaces."""
+    results = []
+    for line_surfaces in surfaces:
+        kanji_set = set()
+        for surface in line_surfaces:
+            for char in surface:
+                if '\u4e00' <= char <= '\u9fff':
+                    kanji_set.add(char)
+        results.append(sorted(kanji_set))
+    return results
+
+
+def loop_over_lines(lines: List[str]) -> List[List[str]]:
+    return [sorted({char for char in line if '\u4e00' <= char <= '\u9fff'}) for line in lines]
+
+
+def regex_per_line(lines: List[str]) -> List[List[str]]:
+    pattern = compile_kanji_pattern(["cjk_unified"])
+    return [extract_kanji(line, pattern) for line in lines]
+
+
+def regex_per_chunk(lines: List[str], chunk_size: int = 100) -> List[str]:
+    """Only answers which kanji a chunk contains, for callers that don't need line numbers."""
+    pattern = compile_kanji_pattern(DEFAULT_KANJI_BLOCKS)
+    return [extract_kanji('\n'.join(lines[i:i + chunk_size]), pattern) for i in range(0, len(lines), chunk_size)]
+
+
+def regex_per_chunk_by_line(lines: List[str], chunk_size: int = 100) -> List[List[str]]:
+    """One pass over each chunk that also matches line breaks, to split the kanji found by line."""
+    pattern = compile_kanji_pattern(["cjk_unified"])
+    kanji_or_break = re.compile(f"({pattern.pattern})|\n")
+    results = []
+    for i in range(0, len(lines), chunk_size):
+        line_kanji = set()
+        for kanji in kanji_or_break.findall('\n'.join(lines[i:i + chunk_size])):
+            if kanji:
+                line_kanji.add(kanji)
+            else:
+                results.append(sorted(line_kanji))
+                line_kanji = set()
+        results.append(sorted(line_kanji))
+    return results
+
+
+def timed(func: Callable, *args, repeats: int = 1) -> tuple:
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    text = generate_text(args.lines, seed=args.seed)
+    tagger = fugashi.Tagger('-Owakati')
+    # the original loop needs the tagger's output; tagging is timed on its own since it was paid either way
+    surfaces, tagging_seconds = timed(lambda: [[word.surface for word in tagger(line)] for line in text])
+    original, original_seconds = timed(loop_over_surfaces, surfaces, repeats=args.repeats)
+    by_line, by_line_seconds = timed(loop_over_lines, text, repeats=args.repeats)
+    regex, regex_seconds = timed(regex_per_line, text, repeats=args.repeats)
+    chunk_by_line, chunk_by_line_seconds = timed(regex_per_chunk_by_line, text, repeats=args.repeats)
+    _, chunk_seconds = timed(regex_per_chunk, text, repeats=args.repeats)
+    assert original == by_line == regex == chunk_by_line, "extraction methods disagree"
+
+    char_count = sum(len(line) for line in text)
+    print(f"{'(tagging alone)':26s} {tagging_seconds:7.3f}s")
+    for name, seconds in (("char loop over surfaces", original_seconds),
+                          ("char loop per line", by_line_seconds),
+                          ("regex per line", regex_seconds),
+                          ("regex per chunk, by line", chunk_by_line_seconds),
+                          ("regex per chunk", chunk_seconds)):
+        print(f"{name:26s} {seconds:7.3f}s  {char_count / seconds / 1e6:8.1f}M chars/sec")
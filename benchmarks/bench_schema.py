@@ -0,0 +1,84 @@
+"""
+Compares file size and insert speed of the original appearance schema (rowid tables plus indexes duplicating the
+primary key) with the current migrated schema (WITHOUT ROWID, no duplicate indexes).
+
+    python -m benchmarks.bench_schema --lines 50000
+"""
+from pathlib import Path
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from benchmarks.bench_appearance_inserts import generate_lines
+from library.database_interface import initialize_database
+
+LEGACY_SCHEMA = """
+CREATE TABLE SourceFiles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT UNIQUE NOT NULL
+);
+CREATE TABLE KanjiAppearances (
+    kanji TEXT NOT NULL,
+    sourcefile_id INTEGER NOT NULL,
+    line_number INTEGER NOT NULL,
+    FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
+    PRIMARY KEY (kanji, sourcefile_id, line_number)
+);
+CREATE TABLE BaseFormAppearances (
+    baseform TEXT NOT NULL,
+    sourcefile_id INTEGER NOT NULL,
+    line_number INTEGER NOT NULL,
+    FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
+    PRIMARY KEY (baseform, sourcefile_id, line_number)
+);
+CREATE INDEX idx_kanji_appearances ON KanjiAppearances (kanji, sourcefile_id, line_number);
+CREATE INDEX idx_baseform_appearances ON BaseFormAppearances (baseform, sourcefile_id, line_number);
+"""
+
+
+def insert_rows(db_path: str, lines: list) -> float:
+    """Inserts every appearance uncapped, so both schemas get exactly the same rows."""
+    conn = sqlite3.connect(db_path)
+    chunk_count = lines[-1][0] + 1
+    kanji_rows = [(kanji, chunk + 1, line_number) for chunk, line_number, kanji_list, _ in lines
+                  for kanji in kanji_list]
+    baseform_rows = [(baseform, chunk + 1, line_number) for chunk, line_number, _, baseform_list in lines
+                     for baseform in baseform_list]
+
+    start = time.perf_counter()
+    conn.executemany("INSERT INTO SourceFiles (filename) VALUES (?)",
+                     [(f"chunk{chunk:06d}.txt",) for chunk in range(chunk_count)])
+    conn.executemany("INSERT OR IGNORE INTO KanjiAppearances (kanji, sourcefile_id, line_number) VALUES (?, ?, ?)",
+                     kanji_rows)
+    conn.executemany("""
+        INSERT OR IGNORE INTO BaseFormAppearances (baseform, sourcefile_id, line_number) VALUES (?, ?, ?)
+    """, baseform_rows)
+    conn.commit()
+    elapsed = time.perf_counter() - start
+
+    conn.execute("VACUUM")
+    conn.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lines", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    synthetic_lines = generate_lines(args.lines, seed=args.seed)
+    row_count = sum(len(kanji) + len(baseforms) for _, _, kanji, baseforms in synthetic_lines)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = str(Path(tmp) / "legacy.db")
+        with sqlite3.connect(legacy_db) as legacy_conn:
+            legacy_conn.executescript(LEGACY_SCHEMA)
+        current_db = str(Path(tmp) / "current.db")
+        initialize_database(current_db)
+
+        for name, db_path in (("legacy", legacy_db), ("current", current_db)):
+            seconds = insert_rows(db_path, synthetic_lines)
+            size_mb = os.path.getsize(db_path) / (1024 * 1024)
+            print(f"{name:8s} {size_mb:8.1f}MB  {seconds:6.2f}s  {row_count / seconds:10.0f} rows/sec")
@@ -0,0 +1,162 @@
+"""
+A local stand-in for AnkiConnect that serves a fixed set of synthetic cards, for benchmarks and manual testing
+without Anki running. Speaks HTTP/1.1 with keep-alive like AnkiConnect and counts requests and connections.
+
+Queries are only understood as far as this tool uses them: a deck:"name" term filters by deck, *:"word" matches cards
+with a field equal to word, edited:n matches cards modified in the last n days and every other term matches all cards.
+Reviews, for cardReviews, are lists in AnkiConnect's format.
+
+    python -m benchmarks.fake_anki_connect --cards 20000 --port 8765
+"""
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+import argparse
+import json
+import re
+import threading
+import time
+
+from library.anki_client import CardInfo
+
+DECK_TERM = re.compile(r'deck:"([^"]*)"')
+EXACT_TERM = re.compile(r'\*:"([^"]*)"')
+EDITED_TERM = re.compile(r'edited:(\d+)')
+
+
+class FakeAnkiConnect:
+    """Serves the given cards on 127.0.0.1 from a background thread; port 0 picks a free port."""
+
+    def __init__(self, cards: List[CardInfo], port: int = 0, latency: float = 0.0,
+                 reviews: Optional[List[List[int]]] = None):
+        self.cards = {card.cardId: asdict(card) for card in cards}
+        # [reviewTime, cardID, usn, buttonPressed, newInterval, previousInterval, newFactor, reviewDuration, reviewType]
+        self.reviews = reviews or []
+        self.latency = latency  # seconds added to every request, to mimic Anki's own handling time
+        self.requests = 0
+        self.connections = 0
+        self.actions = []  # type: List[str]
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> 'FakeAnkiConnect':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        """Serve from the calling thread until interrupted."""
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'FakeAnkiConnect':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def find_cards(self, query: str) -> List[int]:
+        decks = DECK_TERM.findall(query)
+        words = EXACT_TERM.findall(query)
+        edited = EDITED_TERM.findall(query)
+        edited_since = time.time() - int(edited[0]) * 86400 if edited else None
+        matches = []
+        for card_id, card in self.cards.items():
+            if decks and card['deckName'] not in decks:
+                continue
+            if words and not any(field['value'] in words for field in card['fields'].values()):
+                continue
+            if edited_since is not None and card['mod'] < edited_since:
+                continue
+            matches.append(card_id)
+        return matches
+
+    def handle(self, action: str, params: Dict[str, Any]) -> Any:
+        self.actions.append(action)
+        if action == "version":
+            return 6
+        if action == "findCards":
+            return self.find_cards(params.get("query", ""))
+        if action == "cardsInfo":
+            # AnkiConnect answers an unknown id with an empty object
+            return [self.cards.get(card_id, {}) for card_id in params.get("cards", [])]
+        if action == "cardsModTime":
+            return [{"cardId": card_id, "mod": self.cards[card_id]['mod']}
+                    for card_id in params.get("cards", []) if card_id in self.cards]
+        if action == "deckNames":
+            return sorted({card['deckName'] for card in self.cards.values()})
+        if action == "cardReviews":
+            return [review for review in self.reviews if review[0] > params.get("startID", 0)
+                    and review[1] in self.cards and self.cards[review[1]]['deckName'] == params.get("deck")]
+        if action == "guiBrowse":
+            return self.find_cards(params.get("query", ""))
+        if action == "multi":
+            results = []
+            for inner in params.get("actions", []):
+                try:
+                    results.append({"result": self.handle(inner["action"], inner.get("params", {})), "error": None})
+                except Exception as e:
+                    results.append({"result": None, "error": str(e)})
+            return results
+        raise Exception(f"unsupported action {action}")
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out in separate writes; with Nagle on each response would wait for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                fake.connections += 1
+
+            def do_POST(self):
+                fake.requests += 1
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                try:
+                    response = {"result": fake.handle(request["action"], request.get("params", {})), "error": None}
+                except Exception as e:
+                    response = {"result": None, "error": str(e)}
+                body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    from benchmarks.run_suite import make_card
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cards", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    args = parser.parse_args()
+
+    server = FakeAnkiConnect([make_card(i, f"word{i}") for i in range(args.cards)], args.port, args.latency)
+    print(f"Serving {args.cards} cards on http://127.0.0.1:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
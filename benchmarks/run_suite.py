@@ -0,0 +1,304 @@
+"""
+Times the hot paths on a synthetic corpus and appends the results to a JSON lines history, comparing each run with
+the last one that used the same parameters.
+
+Covers corpus chunking, chunk and streamed ingestion, the appearance queries, SentenceLookup, CardManager and the
+Flask endpoints (through the test client), and the AnkiConnect client and import routes against a local fake
+AnkiConnect server, so Anki doesn't need to be running.
+
+    python -m benchmarks.run_suite --lines 100000 --workers 4
+"""
+from contextlib import contextmanager, redirect_stdout
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from benchmarks.corpus_generator import generate_corpus
+from library.anki_client import AnkiField, CardInfo
+from library.settings_manager import settings
+
+DEFAULT_HISTORY = os.path.join("data", "benchmark_history.jsonl")
+# changes within this fraction of the previous run, or on timings this short, aren't flagged
+NOISE_THRESHOLD = 0.10
+MIN_FLAGGED_SECONDS = 0.005
+
+
+class Timings:
+    """Collects named timings, each with an optional item count for a throughput figure."""
+
+    def __init__(self):
+        self.results = {}  # type: Dict[str, Dict[str, Any]]
+
+    @contextmanager
+    def timed(self, name: str, items: Optional[int] = None, unit: str = "items") -> Iterator[None]:
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        result = {"seconds": round(seconds, 4)}
+        if items:
+            result[f"{unit}_per_sec"] = round(items / seconds, 1) if seconds > 0 else None
+        self.results[name] = result
+        print(f"{name:40s} {seconds:9.3f}s" + (f"  {items / seconds:12.0f} {unit}/sec" if items and seconds else ""))
+
+
+@contextmanager
+def quiet() -> Iterator[None]:
+    """Silence the per-chunk prints of the code being timed."""
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield
+
+
+def make_card(card_id: int, word: str) -> CardInfo:
+    fields = {"Word": AnkiField(word, 0), "Meaning": AnkiField(f"meaning {card_id}", 1)}
+    return CardInfo(cardId=card_id, fields=fields,
+                    question=f"<div>{word}</div>", answer=f"<div>{word}</div><hr>meaning {card_id}",
+                    modelName="Basic", ord=0, deckName="Japanese", css=".card {}", factor=2500, interval=3,
+                    note=card_id + 1_000_000, type=2, queue=2, due=100, reps=10, lapses=1, left=0, mod=1700000000,
+                    nextReviews=[])
+
+
+def bench_ingestion(timings: Timings, work_dir: Path, args: argparse.Namespace) -> Path:
+    import catalog_data
+
+    raw_root, chunk_root = work_dir / "raw", work_dir / "chunk"
+    with timings.timed("generate_corpus", args.lines, "lines"):
+        generate_corpus(raw_root, args.lines, args.files, args.repeat_ratio, args.seed)
+    chunk_db, stream_db = work_dir / "chunks.db", work_dir / "stream.db"
+    with timings.timed("chunk_data", args.lines, "lines"), quiet():
+        catalog_data.chunk_data(str(raw_root), str(chunk_root))
+    with timings.timed("process_all_chunks", args.lines, "lines"), quiet():
+        catalog_data.process_all_chunks(str(chunk_db), str(chunk_root), workers=args.workers)
+    with timings.timed("process_raw_files", args.lines, "lines"), quiet():
+        catalog_data.process_raw_files(str(stream_db), str(raw_root), workers=args.workers)
+    timings.results["database_bytes"] = {"bytes": chunk_db.stat().st_size}
+    return chunk_db
+
+
+def bench_queries(timings: Timings, db_path: Path, query_count: int) -> List[str]:
+    """Returns the most frequent baseforms, which the later benchmarks use as words."""
+    from library.database_interface import (KIND_BASEFORM, get_db_connection, get_most_frequent_terms,
+                                            get_sentences_for_baseform, get_sentences_for_baseforms,
+                                            get_term_frequency)
+    from library.sentence_lookup import SentenceLookup
+
+    conn = get_db_connection(str(db_path), read_only=True)
+    try:
+        with timings.timed("get_most_frequent_terms"):
+            words = [term for term, _ in get_most_frequent_terms(conn, KIND_BASEFORM, limit=query_count)]
+        with timings.timed("get_sentences_for_baseform", len(words), "queries"):
+            for word in words:
+                get_sentences_for_baseform(conn, word)
+        with timings.timed("get_sentences_for_baseforms", len(words), "words"):
+            get_sentences_for_baseforms(conn, words)
+        with timings.timed("get_term_frequency", len(words), "queries"):
+            for word in words:
+                get_term_frequency(conn, word)
+    finally:
+        conn.close()
+
+    lookup = SentenceLookup(str(db_path))
+    try:
+        with timings.timed("sentence_lookup_cold", len(words), "words"):
+            for word in words:
+                lookup.get_sentences(word, limit=50)
+        with timings.timed("sentence_lookup_warm", len(words), "words"):
+            for word in words:
+                lookup.get_sentences(word, limit=50)
+    finally:
+        lookup.pool.close_all()
+    return words
+
+
+def bench_card_manager(timings: Timings, work_dir: Path, words: List[str], card_count: int) -> None:
+    from model.card_manager import CardManager
+
+    cards = [make_card(i, words[i % len(words)] if words else f"word{i}") for i in range(card_count)]
+    save_path = work_dir / "card_manager_bench.json"
+    manager = CardManager.load_from_file(save_path)
+    with timings.timed("card_manager_add_card", card_count, "cards"):
+        for card in cards:
+            manager.add_card(card)
+    with timings.timed("card_manager_load", card_count, "cards"):
+        manager = CardManager.load_from_file(save_path)
+    with timings.timed("card_manager_remove_card", card_count, "cards"):
+        for card in cards:
+            manager.remove_card(card)
+    with timings.timed("card_manager_add_cards", card_count, "cards"):
+        manager.add_cards(cards)
+    with timings.timed("card_manager_get_by_id", card_count, "lookups"):
+        for card in cards:
+            manager.get_by_id(card.cardId)
+    with timings.timed("card_manager_remove_cards", card_count, "cards"):
+        manager.remove_cards(cards)
+
+
+def bench_endpoints(timings: Timings, work_dir: Path, db_path: Path, words: List[str], card_count: int,
+                    repeats: int) -> None:
+    import backend
+
+    # point the app at the benchmark corpus and scratch files instead of the user's data
+    app = backend.init_backend(card_manager_file=str(work_dir / "card_manager_endpoints.json"),
+                               corpus_db_file=str(db_path), anki_mirror_file=str(work_dir / "anki_mirror_endpoints.db"))
+    for i in range(card_count):
+        backend.card_manager.add_card(make_card(i, words[i % len(words)] if words else f"word{i}"))
+    client = app.test_client()
+
+    with timings.timed("GET /api/words", repeats, "requests"):
+        for _ in range(repeats):
+            client.get('/api/words')
+    with timings.timed("GET /api/sentences/<word>", len(words), "requests"):
+        for word in words:
+            client.get(f'/api/sentences/{word}')
+    with timings.timed("POST /api/sentences/batch", repeats, "requests"):
+        for _ in range(repeats):
+            client.post('/api/sentences/batch', json={})
+    with timings.timed("POST /api/remove_card", card_count, "requests"):
+        for i in range(card_count):
+            client.post('/api/remove_card', json={"cardId": i})
+    backend.sentence_lookup.pool.close_all()
+    backend.anki_mirror.conn.close()
+
+
+def bench_anki_client(timings: Timings, work_dir: Path, db_path: Path, words: List[str], card_count: int,
+                      repeats: int) -> None:
+    import backend
+    from benchmarks.fake_anki_connect import FakeAnkiConnect
+    from library.anki_client import AnkiConnectClient
+    from library.anki_mirror import AnkiMirror
+
+    cards = [make_card(i, words[i % len(words)] if words else f"word{i}") for i in range(card_count)]
+    for card in cards:
+        # low ease and many reps, so the difficult card import takes every card
+        card.factor, card.reps = 1300, 40
+    with FakeAnkiConnect(cards) as fake:
+        client = AnkiConnectClient("127.0.0.1", fake.port)
+        with timings.timed("anki_client_version", repeats, "requests"):
+            for _ in range(repeats):
+                client._invoke("version")
+        with timings.timed("anki_client_get_difficult_cards", card_count * repeats, "cards"):
+            for _ in range(repeats):
+                client.get_difficult_cards(limit=card_count)
+        card_ids = [card.cardId for card in cards]
+        with timings.timed("anki_client_iter_cards_info", card_count * repeats, "cards"):
+            for _ in range(repeats):
+                for _ in client.iter_cards_info(card_ids):
+                    pass
+        with timings.timed("anki_client_iter_cards_info_parallel", card_count * repeats, "cards"):
+            for _ in range(repeats):
+                for _ in client.iter_cards_info(card_ids, parallel=4):
+                    pass
+        with timings.timed("anki_client_batch_version", repeats, "actions"):
+            with client.batch() as batch:
+                for _ in range(repeats):
+                    batch.invoke("version")
+        timings.results["anki_client_connections"] = {"connections": fake.connections, "requests": fake.requests}
+
+        mirror = AnkiMirror(str(work_dir / "anki_mirror.db"), client)
+        with timings.timed("anki_mirror_sync_first", card_count, "cards"):
+            mirror.sync()
+        with timings.timed("anki_mirror_sync_unchanged", card_count, "cards"):
+            mirror.sync()
+        with timings.timed("anki_mirror_find_difficult_card_ids", repeats, "queries"):
+            for _ in range(repeats):
+                mirror.find_difficult_card_ids(limit=card_count)
+        with timings.timed("anki_mirror_find_exact_match_card_ids", len(words), "queries"):
+            for word in words:
+                mirror.find_exact_match_card_ids(word, limit=100)
+
+        mirror.conn.close()
+        client.close()
+
+        app = backend.init_backend(card_manager_file=str(work_dir / "card_manager_import.json"),
+                                   corpus_db_file=str(db_path), anki_mirror_file=str(work_dir / "anki_mirror.db"),
+                                   anki_host="127.0.0.1", anki_port=fake.port)
+        test_client = app.test_client()
+        with timings.timed("GET /api/anki_import_difficult", card_count, "cards"):
+            test_client.get(f'/api/anki_import_difficult?limit={card_count}&delta=1')
+        with timings.timed("GET /api/anki_import_difficult again", card_count, "cards"):
+            test_client.get(f'/api/anki_import_difficult?limit={card_count}&delta=1')
+        backend.sentence_lookup.pool.close_all()
+        backend.anki_mirror.conn.close()
+        backend.anki_client.close()
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def append_history(history_path: Path, run: Dict[str, Any]) -> None:
+    """Append the run and print how it compares with the previous run that used the same parameters."""
+    previous = None
+    if history_path.exists():
+        with history_path.open('r', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("params") == run["params"]:
+                    previous = entry
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with history_path.open('a', encoding='utf-8') as f:
+        f.write(json.dumps(run, ensure_ascii=False) + "\n")
+
+    if previous is None:
+        print(f"\nNo earlier run with these parameters in {history_path}")
+        return
+    print(f"\nCompared with {previous['revision']} ({previous['timestamp']}):")
+    for name, result in run["results"].items():
+        old = previous["results"].get(name, {}).get("seconds")
+        new = result.get("seconds")
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        flag = ""
+        if max(old, new) >= MIN_FLAGGED_SECONDS:
+            flag = "  REGRESSION" if change > NOISE_THRESHOLD else ("  faster" if change < -NOISE_THRESHOLD else "")
+        print(f"{name:40s} {old:9.3f}s -> {new:9.3f}s  {change:+7.1%}{flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lines", type=int, default=10000, help="corpus size, 10k to 10M lines")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--repeat-ratio", type=float, default=0.2, help="share of lines that are stock phrases")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--queries", type=int, default=200, help="words used for the query and endpoint benchmarks")
+    parser.add_argument("--cards", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--history", default=DEFAULT_HISTORY)
+    parser.add_argument("--keep", help="build the corpus and databases in this directory and keep them")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(args.keep) if args.keep else Path(tmp)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        # no run reports or token store: every run should start from the same state
+        overrides = work_dir / "bench_settings.toml"
+        overrides.write_text('[ingestion]\nreport_path = ""\ntoken_cache_path = ""\n', encoding='utf-8')
+        settings.override_settings(str(overrides))
+
+        timings = Timings()
+        database = bench_ingestion(timings, work_dir, args)
+        frequent_words = bench_queries(timings, database, args.queries)
+        bench_card_manager(timings, work_dir, frequent_words, args.cards)
+        bench_endpoints(timings, work_dir, database, frequent_words, args.cards, args.repeats)
+        bench_anki_client(timings, work_dir, database, frequent_words, args.cards, args.repeats)
+
+    params = {key: value for key, value in vars(args).items() if key not in ("history", "keep")}
+    append_history(Path(args.history), {
+        "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": timings.results,
+    })
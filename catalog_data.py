@@ -1,11 +1,35 @@
+from collections import Counter, deque
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Pattern, Set, Tuple, Union
+import argparse
 import csv
+import datetime
 import fugashi
+import hashlib
+import mmap
+import multiprocessing
+import os
 import random
 import sqlite3
+import sys
+import time
 
-from library.database_interface import (DATABASE_ROOT, add_baseform_appearances, add_kanji_appearances, add_source_file,
-                                        initialize_database, get_db_connection, get_source_file_id)
+from library.database_interface import (DATABASE_ROOT, PROFILE_BULK_LOAD, AppearanceWriter, RawChunkOrigin,
+                                        RawFileProgress, create_secondary_indexes, drop_secondary_indexes,
+                                        get_baseform, get_metadata, get_raw_file_chunks, get_raw_file_progress,
+                                        get_source_lines, get_sources_missing_baseforms, get_term_frequencies,
+                                        initialize_database, get_db_connection, get_source_file_id, set_metadata)
+from library.anki_client import AnkiConnectClient
+from library.ingest_stats import IngestStats, ProgressLine, profiled, should_profile, write_run_report
+from library.kanji_extraction import compile_kanji_pattern, extract_kanji, kanji_blocks_from_settings
+from library.sentence_ranking import AppearanceScorer, SentenceRanker, make_appearance_scorer
+from library.settings_manager import settings
+from library.token_cache import (LineBaseforms, TokenCache, TokenCacheEntry, open_token_store,
+                                 save_token_entries)
+
+# (line index within the chunk, line text, kanji on the line, baseforms on the line)
+TokenizedLine = Tuple[int, str, List[str], List[str]]
 
 
 def chunk_txt_file(input_file: Path, output_dir: Path, chunk_size: int) -> None:
@@ -91,119 +115,888 @@ def chunk_data(raw_data_root: str, chunks_root: str, chunk_size: int = 100) -> N
             chunk_txt_file(input_file, output_dir, chunk_size)
 
 
-def process_chunk(conn: sqlite3.Connection, text: str, filename: str, tagger: fugashi.Tagger) -> None:
-    try:
-        sourcefile_id = add_source_file(conn, filename)
-        lines = text.splitlines()
-        for line_idx, line in enumerate(lines, start=0):
-            if not line.strip():
-                continue
+# Parts of speech whose baseforms aren't worth indexing, used when [pos_filter] isn't in the settings
+DEFAULT_SKIP_POS1 = [
+    '助詞',  # Particles
+    '助動詞',  # Auxiliary verbs
+    '記号',  # Symbols
+    '補助記号',  # Punctuation
+    '空白',  # Whitespace
+    '接続詞',  # Conjunctions
+    '感動詞',  # Interjections
+    '接尾辞',  # Suffixes (UniDic)
+    '代名詞',  # Pronouns (UniDic)
+]
+DEFAULT_SKIP_POS2 = [
+    '接尾辞',  # Suffixes
+    '助数詞',  # Counter words
+]
+DEFAULT_SKIP_IF_NOUN = [
+    '代名詞',  # Pronouns
+    '数詞',  # Numerical nouns
+]
 
-            kanji_set = set()
-            baseform_set = set()
-
-            for word in tagger(line):
-                for char in word.surface:
-                    if '\u4e00' <= char <= '\u9fff':
-                        kanji_set.add(char)
-                if word.feature.lemma:
-                    baseform_set.add(word.feature.lemma)
-
-            if kanji_set:
-                add_kanji_appearances(
-                    conn,
-                    list(kanji_set),
-                    sourcefile_id,
-                    line_idx,
-                    max_appearances=50
-                )
-
-            if baseform_set:
-                add_baseform_appearances(
-                    conn,
-                    list(baseform_set),
-                    sourcefile_id,
-                    line_idx,
-                    max_appearances=50
-                )
 
-    except Exception as e:
-        print(f"Processing error in {filename}: {e}")
-        raise
+@dataclass(frozen=True)
+class PosFilter:
+    """Parts of speech whose baseforms are left out of the index (see should_keep_word)."""
+    skip_pos1: FrozenSet[str]
+    skip_pos2: FrozenSet[str]
+    skip_if_noun: FrozenSet[str]
 
+    @classmethod
+    def from_settings(cls) -> Optional['PosFilter']:
+        """The [pos_filter] settings, or None if filtering is disabled."""
+        if not settings.get_setting_fallback('pos_filter.enabled', True):
+            return None
+        return cls(skip_pos1=frozenset(settings.get_setting_fallback('pos_filter.skip_pos1', DEFAULT_SKIP_POS1)),
+                   skip_pos2=frozenset(settings.get_setting_fallback('pos_filter.skip_pos2', DEFAULT_SKIP_POS2)),
+                   skip_if_noun=frozenset(settings.get_setting_fallback('pos_filter.skip_if_noun',
+                                                                        DEFAULT_SKIP_IF_NOUN)))
 
-def should_keep_word(word: fugashi.UnidicNode) -> bool:
-    pos1 = word.feature.pos1
-    pos2 = word.feature.pos2
+    def fingerprint(self) -> str:
+        return ';'.join(','.join(sorted(tags)) for tags in (self.skip_pos1, self.skip_pos2, self.skip_if_noun))
 
-    skip_pos1 = {
-        '助詞',  # Particles
-        '助動詞',  # Auxiliary verbs
-        '記号',  # Symbols
-        '接続詞',  # Conjunctions
-        '感動詞',  # Interjections
-    }
 
-    skip_pos2 = {
-        '接尾辞',  # Suffixes
-        '助数詞',  # Counter words
-    }
+DEFAULT_POS_FILTER = PosFilter(frozenset(DEFAULT_SKIP_POS1), frozenset(DEFAULT_SKIP_POS2),
+                               frozenset(DEFAULT_SKIP_IF_NOUN))
 
-    skip_if_noun = {
-        '代名詞',  # Pronouns
-        '数詞',  # Numerical nouns
-    }
 
-    if pos1 in skip_pos1:
+def should_keep_word(word: fugashi.UnidicNode, pos_filter: PosFilter = DEFAULT_POS_FILTER) -> bool:
+    # -Owakati only changes tagger.parse's string output; the nodes still carry the full features
+    feature = word.feature
+    pos1 = feature.pos1
+    pos2 = feature.pos2
+
+    if pos1 in pos_filter.skip_pos1:
         return False
 
-    if pos2 in skip_pos2:
+    if pos2 in pos_filter.skip_pos2:
         return False
 
-    if pos1 == '名詞' and pos2 in skip_if_noun:
+    if pos1 == '名詞' and pos2 in pos_filter.skip_if_noun:
         return False
 
     return True
 
 
-def process_all_chunks(db_root_str: str, chunks_root: str) -> None:
+def _tokenize_line(line: str, tagger: fugashi.Tagger, pos_filter: Optional[PosFilter],
+                   stats: Optional[IngestStats] = None) -> LineBaseforms:
+    """(baseforms kept, baseforms dropped by pos_filter) on the line, each sorted."""
+    started = time.perf_counter()
+    words = tagger(line)
+    if stats is not None:
+        stats.add_time('tagging', time.perf_counter() - started)
+        stats.count('lines_tagged')
+        stats.count('tokens', len(words))
+    kept = set()
+    filtered = set()
+    for word in words:
+        lemma = word.feature.lemma
+        if not lemma:
+            continue
+        if pos_filter is None or should_keep_word(word, pos_filter):
+            kept.add(lemma)
+        else:
+            filtered.add(lemma)
+    return tuple(sorted(kept)), tuple(sorted(filtered - kept))
+
+
+def tokenize_lines(numbered_lines: Iterable[Tuple[int, str]], tagger: fugashi.Tagger,
+                   cache: Optional[TokenCache] = None, kanji_pattern: Optional[Pattern] = None,
+                   pos_filter: Optional[PosFilter] = None, filtered_counts: Optional[Counter] = None,
+                   stats: Optional[IngestStats] = None) -> List[TokenizedLine]:
+    """
+    Tokenize (line number, text) pairs, returning (line number, text, kanji, baseforms) for each line that has any.
+    Kanji come from scanning the line for kanji_pattern, not from the tagger; without a pattern only baseforms are
+    extracted. Baseforms of the parts of speech pos_filter skips are left out and counted per line in filtered_counts.
+    With a cache, lines seen before (in this run or, with a persistent store, an earlier one) aren't tagged again.
+    stats collects the tagging time and line/token counts.
+    """
+    results = []
+    for line_idx, line in numbered_lines:
+        if not line.strip():
+            continue
+
+        # one regex pass per line: a pass over the whole chunk that also matches line breaks to split the kanji by
+        # line wasn't faster (see benchmarks/bench_kanji_extraction.py)
+        kanji = extract_kanji(line, kanji_pattern) if kanji_pattern is not None else []
+        if stats is not None:
+            stats.count('lines')
+        if cache is None:
+            baseforms, filtered = _tokenize_line(line, tagger, pos_filter, stats)
+        else:
+            key, cached = cache.get(line)
+            if cached is None:
+                cached = _tokenize_line(line, tagger, pos_filter, stats)
+                cache.put(key, cached)
+            baseforms, filtered = cached
+        if filtered_counts is not None:
+            filtered_counts.update(filtered)
+
+        if kanji or baseforms:
+            results.append((line_idx, line, kanji, list(baseforms)))
+    return results
+
+
+def tokenize_text(text: str, tagger: fugashi.Tagger, cache: Optional[TokenCache] = None,
+                  kanji_pattern: Optional[Pattern] = None, pos_filter: Optional[PosFilter] = None,
+                  filtered_counts: Optional[Counter] = None,
+                  stats: Optional[IngestStats] = None) -> List[TokenizedLine]:
+    """
+    Tokenize every line of a chunk (see tokenize_lines), finding kanji with ingestion.kanji_blocks by default.
+    Kanji and baseforms are sorted so results are identical no matter which process produced them.
+    """
+    if kanji_pattern is None:
+        kanji_pattern = compile_kanji_pattern(kanji_blocks_from_settings())
+    return tokenize_lines(enumerate(text.splitlines()), tagger, cache, kanji_pattern, pos_filter, filtered_counts,
+                          stats)
+
+
+def scan_kanji(text: str, kanji_pattern: Pattern) -> List[TokenizedLine]:
+    """
+    Kanji-only counterpart of tokenize_text that never runs the tagger. Every non-blank line is returned, with or
+    without kanji, so its text is stored for the baseform pass (see index_pending_baseforms).
+    """
+    return [(line_idx, line, extract_kanji(line, kanji_pattern), [])
+            for line_idx, line in enumerate(text.splitlines()) if line.strip()]
+
+
+def write_tokenized_chunk(writer: AppearanceWriter, filename: str, tokenized_lines: List[TokenizedLine],
+                          store_text: bool = True, work: Optional[str] = None) -> int:
+    sourcefile_id = writer.add_source_file(filename, work)
+    for line_idx, text, kanji_list, baseform_list in tokenized_lines:
+        writer.add_line(sourcefile_id, line_idx, kanji_list, baseform_list, text, store_text)
+    return sourcefile_id
+
+
+def process_chunk(conn: sqlite3.Connection, text: str, filename: str, tagger: fugashi.Tagger) -> None:
+    try:
+        writer = AppearanceWriter(conn, max_appearances=50, ranker=make_appearance_scorer())
+        write_tokenized_chunk(writer, filename, tokenize_text(text, tagger, pos_filter=PosFilter.from_settings()))
+        writer.flush()
+    except Exception as e:
+        print(f"Processing error in {filename}: {e}")
+        raise
+
+
+@dataclass
+class ChunkFile:
+    """A chunk written to disk by chunk_data."""
+    path: Path
+
+    @property
+    def source_name(self) -> str:
+        return str(self.path)
+
+    @property
+    def work(self) -> str:
+        # chunk_data writes each raw file's chunks to their own folder
+        return str(self.path.parent)
+
+    def read_text(self) -> str:
+        return read_file_content(self.path)
+
+
+@dataclass
+class RawChunk:
+    """
+    chunk_size lines read straight from a raw file by iter_raw_chunks, with the same text the equivalent chunk file
+    would give read_file_content. end_offset and end_line are where the next chunk of the raw file starts;
+    file_size and file_mtime_ns are the raw file's stat when it was read.
+    """
+    raw_file: Path
+    first_line: int
+    end_line: int
+    start_offset: int
+    end_offset: int
+    content_hash: bytes
+    file_size: int
+    file_mtime_ns: int
+    text: str
+
+    @property
+    def source_name(self) -> str:
+        return f"{self.raw_file}#{self.first_line:06d}"
+
+    @property
+    def work(self) -> str:
+        return str(self.raw_file)
+
+    def read_text(self) -> str:
+        return self.text
+
+
+@dataclass
+class StoredChunk:
+    """A source file indexed in kanji mode, with its lines read back from the Lines table for the baseform pass."""
+    sourcefile_id: int
+    filename: str
+    lines: List[Tuple[int, str]]
+
+    @property
+    def source_name(self) -> str:
+        return self.filename
+
+    @property
+    def work(self) -> Optional[str]:
+        # the source file already has one
+        return None
+
+
+IngestionTask = Union[ChunkFile, RawChunk, StoredChunk]
+
+# full: kanji and baseforms; kanji: only kanji, by character scanning without the tagger
+MODE_FULL = "full"
+MODE_KANJI = "kanji"
+
+
+@dataclass(frozen=True)
+class TokenizerConfig:
+    """What each tokenizer worker is set up with; see _ingest for the settings these come from."""
+    mode: str
+    kanji_blocks: Tuple[str, ...]
+    pos_filter: Optional[PosFilter]
+    token_cache_size: int = 0
+    token_store_path: Optional[str] = None
+    profile_sample_rate: float = 0.0
+    profile_dir: Optional[str] = None
+
+    @classmethod
+    def from_settings(cls, mode: str) -> 'TokenizerConfig':
+        return cls(mode=mode,
+                   kanji_blocks=tuple(kanji_blocks_from_settings()),
+                   pos_filter=PosFilter.from_settings(),
+                   token_cache_size=settings.get_setting_fallback('ingestion.token_cache_size', 0),
+                   token_store_path=settings.get_setting_fallback('ingestion.token_cache_path', '') or None,
+                   profile_sample_rate=settings.get_setting_fallback('ingestion.profile_sample_rate', 0.0),
+                   profile_dir=settings.get_setting_fallback('ingestion.profile_dir', '') or None)
+
+
+# Each worker process owns its own Tagger (and token cache); the parent process is the only one that writes to SQLite.
+_worker_config = None  # type: Optional[TokenizerConfig]
+_worker_tagger = None  # type: Optional[fugashi.Tagger]
+_worker_token_cache = None  # type: Optional[TokenCache]
+_worker_kanji_pattern = None  # type: Optional[Pattern]
+_worker_stats = IngestStats()
+
+# Bump when tokenize_text changes what it extracts from a line, so persistent token caches stop matching.
+TOKENIZER_VERSION = 3
+
+
+def tokenizer_fingerprint(tagger: fugashi.Tagger, pos_filter: Optional[PosFilter] = None) -> str:
+    """Identifies the tokenizer setup, so cached results are only reused for the same dictionary, filter and version."""
+    dictionaries = ','.join(f"{info['filename']}:{info['size']}:{info['version']}" for info in tagger.dictionary_info)
+    filter_fingerprint = pos_filter.fingerprint() if pos_filter is not None else 'unfiltered'
+    return f"v{TOKENIZER_VERSION}|{dictionaries}|{filter_fingerprint}"
+
+
+def _init_tokenizer_worker(config: TokenizerConfig) -> None:
+    global _worker_config, _worker_tagger, _worker_token_cache, _worker_kanji_pattern
+    _worker_config = config
+    _worker_kanji_pattern = compile_kanji_pattern(config.kanji_blocks)
+    _worker_tagger = None
+    _worker_token_cache = None
+    if config.mode == MODE_KANJI:
+        return
+    _worker_tagger = fugashi.Tagger('-Owakati')
+    if config.token_cache_size > 0:
+        store = open_token_store(config.token_store_path, read_only=True) if config.token_store_path else None
+        _worker_token_cache = TokenCache(tokenizer_fingerprint(_worker_tagger, config.pos_filter),
+                                         config.token_cache_size, store)
+
+
+@dataclass
+class TokenizedTask:
+    task: 'IngestionTask'
+    lines: Optional[List[TokenizedLine]]
+    error: Optional[str]
+    cache_hits: int = 0
+    cache_misses: int = 0
+    new_cache_entries: List[TokenCacheEntry] = field(default_factory=list)
+    # lines each baseform was left out of by the part of speech filter
+    filtered_counts: Counter = field(default_factory=Counter)
+    # the worker's timers and counters for this task
+    stats: IngestStats = field(default_factory=IngestStats)
+
+
+def _tokenize(task: IngestionTask, filtered_counts: Counter) -> List[TokenizedLine]:
+    config = _worker_config
+    if isinstance(task, StoredChunk):
+        # kanji were indexed by the kanji mode run
+        return tokenize_lines(task.lines, _worker_tagger, _worker_token_cache, None, config.pos_filter,
+                              filtered_counts, _worker_stats)
+
+    with _worker_stats.timed('read'):
+        text = task.read_text()
+    if config.mode == MODE_KANJI:
+        lines = scan_kanji(text, _worker_kanji_pattern)
+        _worker_stats.count('lines', len(lines))
+        return lines
+    return tokenize_text(text, _worker_tagger, _worker_token_cache, _worker_kanji_pattern, config.pos_filter,
+                         filtered_counts, _worker_stats)
+
+
+def _tokenize_task(task: IngestionTask) -> TokenizedTask:
+    filtered_counts = Counter()
+    profile_dir = None
+    if should_profile(task.source_name, _worker_config.profile_sample_rate):
+        profile_dir = _worker_config.profile_dir
+    try:
+        with profiled(profile_dir, task.source_name, 'tokenize'), _worker_stats.timed('tokenize'):
+            lines = _tokenize(task, filtered_counts)
+        result = TokenizedTask(task, lines, None, filtered_counts=filtered_counts)
+    except Exception as e:
+        result = TokenizedTask(task, None, str(e))
+    if _worker_token_cache is not None:
+        result.cache_hits, result.cache_misses, result.new_cache_entries = _worker_token_cache.take_stats()
+    result.stats = _worker_stats.take()
+    return result
+
+
+def _imap_bounded(pool: multiprocessing.Pool, func: Callable, tasks: Iterable, max_pending: int) -> Iterator:
+    """Like pool.imap, but reads at most max_pending tasks ahead so streamed input isn't pulled into memory."""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _check_cap_policy(conn: sqlite3.Connection, ranker: AppearanceScorer) -> None:
+    # scores from different policies (or reservoir seeds) can't be compared, so a database sticks to one
+    stored_policy = get_metadata(conn, 'cap_policy')
+    if stored_policy is None:
+        set_metadata(conn, 'cap_policy', ranker.cap_policy)
+    elif stored_policy != ranker.cap_policy:
+        raise ValueError(f"Database was indexed with cap policy '{stored_policy}' but ingestion.cap_policy is "
+                         f"'{ranker.cap_policy}'; index into a new database to change it")
+
+
+def _needs_frequency_pass(ranker: AppearanceScorer, mode: str) -> bool:
+    return (mode != MODE_KANJI and isinstance(ranker, SentenceRanker) and ranker.familiarity_weight > 0
+            and settings.get_setting_fallback('sentence_ranking.frequency_pass', True))
+
+
+def _count_corpus_frequencies(conn: sqlite3.Connection, tokenized_tasks: Iterable[TokenizedTask], stats: IngestStats,
+                              token_store: Optional[sqlite3.Connection], batch_size: int) -> Tuple[Dict[str, int], int]:
+    """
+    Lines each baseform is on in the whole corpus: the ones about to be indexed plus the TermCounts frequency of the
+    ones already indexed. Scoring familiarity against the running counts instead would rank the lines indexed first
+    as rare.
+    The workers' timers and cache counters go into stats, and the lines they tokenized into token_store every
+    batch_size tasks, so the indexing pass finds them there. Returns the frequencies and how many lines were saved.
+    """
+    frequencies = Counter()
+    new_cache_entries = []
+    cache_saved = 0
+    for task_number, result in enumerate(tokenized_tasks, 1):
+        # lines are counted when the indexing pass writes them
+        del result.stats.counts['lines']
+        stats.merge(result.stats)
+        stats.count('token_cache_hits', result.cache_hits)
+        stats.count('token_cache_misses', result.cache_misses)
+        new_cache_entries.extend(result.new_cache_entries)
+        if task_number % batch_size == 0:
+            cache_saved += _save_token_entries(token_store, new_cache_entries)
+            new_cache_entries = []
+        if result.error is None:
+            for _, _, _, baseform_list in result.lines:
+                frequencies.update(baseform_list)
+    cache_saved += _save_token_entries(token_store, new_cache_entries)
+    frequencies.update(get_term_frequencies(conn, frequencies.keys()))
+    return dict(frequencies), cache_saved
+
+
+def _flush_batch(writer: AppearanceWriter, batch: List[IngestionTask], stats: IngestStats) -> bool:
+    """Commit the batch; False if it failed and was rolled back."""
+    started = time.perf_counter()
+    try:
+        writer.flush()
+        latency = time.perf_counter() - started
+        stats.add_time('commit', latency)
+        stats.commit_latencies.append(latency)
+        return True
+    except Exception as e:
+        stats.count('errors')
+        print(f"Error writing batch of {len(batch)} chunks starting with {batch[0].source_name}: {str(e)}")
+        return False
+
+
+def _stop_raw_files(failed_raw_files: Set[Path], tasks: Iterable[IngestionTask]) -> None:
+    """
+    Stop indexing the raw files of the chunks that failed. A later chunk would move the file's checkpoint past the
+    failed one, and the next run would resume after it; skipping the rest of the file leaves the checkpoint at the end
+    of the last chunk committed, so the next run starts at the failed one.
+    """
+    for task in tasks:
+        if isinstance(task, RawChunk) and task.raw_file not in failed_raw_files:
+            failed_raw_files.add(task.raw_file)
+            print(f"Skipping the rest of {task.raw_file} from line {task.first_line}; re-run to index it")
+
+
+def _save_token_entries(token_store: Optional[sqlite3.Connection], entries: List[TokenCacheEntry]) -> int:
+    if token_store is None or not entries:
+        return 0
+    try:
+        saved = save_token_entries(token_store, entries)
+        token_store.commit()
+        return saved
+    except sqlite3.Error as e:
+        print(f"Error saving {len(entries)} token cache entries: {str(e)}")
+        token_store.rollback()
+        return 0
+
+
+def _report_filtered_baseforms(filtered_counts: Counter, max_appearances: int) -> Dict[str, int]:
+    # Each filtered term would have written at most max_appearances appearance rows and one TermCounts row; the byte
+    # estimate is the term plus ~16 bytes of ids, score and record header, stored once in the table and once in the
+    # score index.
+    appearance_rows = sum(min(count, max_appearances) for count in filtered_counts.values())
+    estimated_bytes = sum(min(count, max_appearances) * 2 * (len(term.encode('utf-8')) + 16)
+                          for term, count in filtered_counts.items())
+    print(f"Part of speech filter: skipped {sum(filtered_counts.values())} baseform appearances of "
+          f"{len(filtered_counts)} terms, up to {appearance_rows} appearance rows and {len(filtered_counts)} "
+          f"TermCounts rows (~{estimated_bytes / 1024:.0f}KB) not written")
+    return {"appearances_skipped": sum(filtered_counts.values()), "terms_skipped": len(filtered_counts),
+            "appearance_rows_saved": appearance_rows, "estimated_bytes_saved": estimated_bytes}
+
+
+def _report_run(stats: IngestStats, wall_seconds: float) -> Dict[str, Any]:
+    """Print the throughput summary and return it for the run report."""
+    rates = {
+        "chunks_per_sec": stats.counts['chunks'] / wall_seconds if wall_seconds > 0 else None,
+        "lines_per_sec": stats.counts['lines'] / wall_seconds if wall_seconds > 0 else None,
+        "tagged_tokens_per_sec": stats.rate('tokens', 'tagging'),
+        "rows_inserted_per_commit_sec": stats.rate('rows_inserted', 'commit'),
+    }
+    print(f"Indexed {stats.counts['chunks']} chunks, {stats.counts['lines']} lines in {wall_seconds:.1f}s "
+          f"({rates['lines_per_sec'] or 0:.0f} lines/sec); {stats.counts['rows_inserted']} rows inserted, "
+          f"{stats.counts['appearances_dropped_by_cap']} appearances dropped by the cap")
+    print("Time per stage: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in sorted(
+        stats.seconds.items(), key=lambda item: -item[1])))
+    return {key: round(value, 2) for key, value in rates.items() if value is not None}
+
+
+def _ingest(db_root_str: str, collect_tasks: Callable[[AppearanceWriter], Iterable[IngestionTask]], workers: int,
+            batch_size: int, known_words: Optional[Set[str]], mode: str = MODE_FULL) -> None:
+    """
+    Tokenize the chunks collect_tasks yields and record their appearances.
+    In MODE_KANJI the tagger isn't run: only kanji are indexed, and the sources are left for index_pending_baseforms.
+    With workers > 1 tokenization runs in a process pool while this process writes the results in task order,
+    so the database contents don't depend on the worker count.
+    Which lines each term keeps is set by ingestion.cap_policy: the best scoring ones per SentenceRanker, which favors
+    lines made of known_words (baseforms), or a seeded uniform sample. Unless sentence_ranking.frequency_pass is off,
+    SentenceRanker's familiarity score needs the corpus frequencies up front, so the tasks are tokenized in a first
+    pass that only counts baseforms. That doubles the tagging time unless the token cache holds the lines of the first
+    pass for the second.
+    Appearances are committed once per batch_size chunks over a bulk_load profile connection, and if
+    ingestion.defer_index_build is set the secondary indexes are dropped for the load and rebuilt at the end.
+    ingestion.token_cache_size enables a per-worker cache of tokenized lines, and ingestion.token_cache_path a store
+    that keeps them across runs.
+    Baseforms of the parts of speech in [pos_filter] are skipped, and what that saved is reported at the end.
+    Per-stage timings and counters are printed at the end and, with ingestion.report_path set, written there as JSON
+    (worker stages are summed over the workers). ingestion.profile_sample_rate of the chunks are run under cProfile,
+    with the profiles dumped to ingestion.profile_dir.
+    """
     db_root = Path(db_root_str)
-    chunks_root = Path(chunks_root)
     if not db_root.parent.exists():
         db_root.parent.mkdir(parents=True, exist_ok=True)
 
+    started_at = datetime.datetime.now().isoformat(timespec='seconds')
+    run_start = time.perf_counter()
     initialize_database(db_root_str)
-    connection = get_db_connection(db_root_str)
-    tagger = fugashi.Tagger('-Owakati')
+    connection = get_db_connection(db_root_str, PROFILE_BULK_LOAD)
+    defer_index_build = settings.get_setting_fallback('ingestion.defer_index_build', False)
+    report_path = settings.get_setting_fallback('ingestion.report_path', '')
+    config = TokenizerConfig.from_settings(mode)
+    # created here before any worker opens it read-only
+    token_store = None
+    if config.token_cache_size > 0 and config.token_store_path:
+        token_store = open_token_store(config.token_store_path)
+    stats = IngestStats()
+    cache_saved = 0
+    filtered_counts = Counter()
+    progress = None
+    writer = None
+    pool = None
 
     try:
+        ranker = make_appearance_scorer(known_words)
+        _check_cap_policy(connection, ranker)
+        if defer_index_build:
+            drop_secondary_indexes(connection)
+
+        writer = AppearanceWriter(connection, max_appearances=50, ranker=ranker)
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=_init_tokenizer_worker, initargs=(config,))
+        else:
+            _init_tokenizer_worker(config)
+
+        def tokenize(tasks: Iterable[IngestionTask]) -> Iterator[TokenizedTask]:
+            if pool is not None:
+                return _imap_bounded(pool, _tokenize_task, tasks, max_pending=workers * 4)
+            return map(_tokenize_task, tasks)
+
+        if _needs_frequency_pass(ranker, mode):
+            with stats.timed('frequency_pass'):
+                frequencies, cache_saved = _count_corpus_frequencies(connection, tokenize(collect_tasks(writer)), stats,
+                                                                     token_store, batch_size)
+            writer.set_corpus_frequencies(frequencies)
+        tasks = collect_tasks(writer)
+        if sys.stdout.isatty():
+            # streamed raw chunks aren't counted up front, so those runs get a rate but no ETA
+            progress = ProgressLine(len(tasks) if isinstance(tasks, list) else None)
+        tokenized_tasks = tokenize(tasks)
+
+        batch = []
+        new_cache_entries = []
+        failed_raw_files = set()  # type: Set[Path]
+        while True:
+            # time spent waiting on the tokenizer (and, when streaming, on reading the raw files)
+            with stats.timed('wait_for_tokenizer'):
+                result = next(tokenized_tasks, None)
+            if result is None:
+                break
+            task = result.task
+            stats.merge(result.stats)
+            stats.count('token_cache_hits', result.cache_hits)
+            stats.count('token_cache_misses', result.cache_misses)
+            new_cache_entries.extend(result.new_cache_entries)
+            filtered_counts.update(result.filtered_counts)
+            if isinstance(task, RawChunk) and task.raw_file in failed_raw_files:
+                continue
+            if result.error is not None:
+                stats.count('errors')
+                print(f"Error processing {task.source_name}: {result.error}")
+                _stop_raw_files(failed_raw_files, [task])
+                continue
+            if progress is None:
+                print(f"Processing file: {task.source_name}")
+            profile_dir = config.profile_dir if should_profile(task.source_name, config.profile_sample_rate) else None
+            with profiled(profile_dir, task.source_name, 'write'), stats.timed('write'):
+                is_stored = isinstance(task, StoredChunk)
+                sourcefile_id = write_tokenized_chunk(writer, task.source_name, result.lines,
+                                                      store_text=not is_stored, work=task.work)
+                if is_stored or mode == MODE_KANJI:
+                    writer.set_baseforms_indexed(sourcefile_id, is_stored)
+                if isinstance(task, RawChunk):
+                    writer.set_source_file_origin(sourcefile_id, RawChunkOrigin(
+                        raw_file=str(task.raw_file), byte_start=task.start_offset, byte_end=task.end_offset,
+                        line_start=task.first_line, line_end=task.end_line, content_hash=task.content_hash))
+                    writer.set_raw_file_progress(str(task.raw_file), RawFileProgress(
+                        byte_offset=task.end_offset, line_count=task.end_line, size=task.file_size,
+                        mtime_ns=task.file_mtime_ns))
+            stats.count('chunks')
+            if progress is not None:
+                progress.update(stats.counts['chunks'], stats.counts['lines'])
+            batch.append(task)
+            if len(batch) >= batch_size:
+                if not _flush_batch(writer, batch, stats):
+                    _stop_raw_files(failed_raw_files, batch)
+                with stats.timed('token_cache_save'):
+                    cache_saved += _save_token_entries(token_store, new_cache_entries)
+                batch = []
+                new_cache_entries = []
+        if batch:
+            _flush_batch(writer, batch, stats)
+        with stats.timed('token_cache_save'):
+            cache_saved += _save_token_entries(token_store, new_cache_entries)
+
+    finally:
+        if progress is not None:
+            progress.update(stats.counts['chunks'], stats.counts['lines'], force=True)
+            progress.finish()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if token_store is not None:
+            token_store.close()
+        report = {"started_at": started_at, "database": db_root_str, "mode": mode, "workers": workers,
+                  "batch_size": batch_size}
+        cache_hits, cache_misses = stats.counts['token_cache_hits'], stats.counts['token_cache_misses']
+        if cache_hits or cache_misses:
+            print(f"Token cache: {cache_hits} hits, {cache_misses} misses "
+                  f"({100 * cache_hits / (cache_hits + cache_misses):.1f}% hit rate), {cache_saved} lines saved")
+            stats.count('token_cache_saved', cache_saved)
+        if filtered_counts:
+            report["pos_filter"] = _report_filtered_baseforms(filtered_counts, max_appearances=50)
+        if defer_index_build:
+            print("Rebuilding indexes")
+            with stats.timed('index_rebuild'):
+                create_secondary_indexes(connection)
+        connection.execute("PRAGMA optimize")
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.close()
+
+        if writer is not None:
+            stats.counts.update(writer.counts)
+            stats.count('rows_inserted',
+                        writer.counts['kanji_rows_inserted'] + writer.counts['baseform_rows_inserted'])
+        wall_seconds = time.perf_counter() - run_start
+        report["wall_seconds"] = round(wall_seconds, 2)
+        report["rates"] = _report_run(stats, wall_seconds)
+        report.update(stats.to_dict())
+        if report_path:
+            write_run_report(report_path, report)
+            print(f"Run report written to {report_path}")
+
+
+def process_all_chunks(db_root_str: str, chunks_root: str, workers: int = 1, seed: int = 0,
+                       batch_size: int = 32, known_words: Optional[Set[str]] = None, mode: str = MODE_FULL) -> None:
+    """
+    Index every unprocessed chunk file under chunks_root (see _ingest).
+    The queue is shuffled with a fixed seed to keep the per-term cap from favoring whichever source sorts first.
+    """
+    chunks_root = Path(chunks_root)
+
+    def collect_chunk_files(writer: AppearanceWriter) -> List[ChunkFile]:
         file_queue = []
-        for folder in chunks_root.iterdir():
+        for folder in sorted(chunks_root.iterdir()):
             if not folder.is_dir():
                 continue
-            for file in folder.iterdir():
+            for file in sorted(folder.iterdir()):
                 if not file.is_file():
                     continue
-                if get_source_file_id(connection, str(file)) != -1:
+                if get_source_file_id(writer.conn, str(file)) != -1:
                     print(f"Skipping already processed file: {file}")
                     continue
-                file_queue.append(file)
-        random.shuffle(file_queue)
+                file_queue.append(ChunkFile(file))
+        random.Random(seed).shuffle(file_queue)
+        return file_queue
+
+    _ingest(db_root_str, collect_chunk_files, workers, batch_size, known_words, mode)
+
 
-        for file in file_queue:
+def process_raw_files(db_root_str: str, raw_data_root: str, chunk_size: int = 100, workers: int = 1,
+                      batch_size: int = 32, known_words: Optional[Set[str]] = None, mode: str = MODE_FULL) -> None:
+    """
+    Index the raw files directly, without writing chunk files (see _ingest).
+    Each raw file is read once and split into chunk_size line chunks on the fly. How far each raw file got is
+    checkpointed in RawFiles by byte offset, in the same transaction as the appearances, so a re-run resumes there.
+    Raw files whose size or mtime changed since they were indexed are checked chunk by chunk (see _find_resume_point),
+    so appended files only index the new lines and edited files only re-index from the first edited chunk.
+    Raw files are read in name order; use the reservoir cap policy if the sample shouldn't depend on that order.
+    A raw file that can't be read (bad UTF-8, no Dialogue column, malformed TSV) is reported and skipped from the chunk
+    that failed, and the run goes on with the next file.
+    """
+    raw_data_root = Path(raw_data_root)
+
+    def collect_raw_chunks(writer: AppearanceWriter) -> Iterator[RawChunk]:
+        for raw_file in sorted(raw_data_root.glob('*.*')):
+            if not raw_file.is_file() or raw_file.suffix.lower() not in ('.txt', '.tsv'):
+                continue
+            stat = raw_file.stat()
+            progress = get_raw_file_progress(writer.conn, str(raw_file))
+            unchanged = progress.size == stat.st_size and progress.mtime_ns == stat.st_mtime_ns
+            if unchanged and progress.byte_offset >= stat.st_size:
+                print(f"Skipping already processed file: {raw_file}")
+                continue
+            if unchanged:
+                start_offset, start_line = progress.byte_offset, progress.line_count
+            else:
+                start_offset, start_line = _find_resume_point(writer, raw_file, chunk_size)
             try:
-                text = read_file_content(file)
-                print(f"Processing file: {file}")
-                process_chunk(connection, text, str(file), tagger)
-                connection.commit()
-            except Exception as e:
-                print(f"Error processing file {file}: {str(e)}")
-                connection.rollback()
+                for chunk in iter_raw_chunks(raw_file, chunk_size, start_offset, start_line):
+                    yield chunk
+                    start_offset, start_line = chunk.end_offset, chunk.end_line
+            except (ValueError, csv.Error) as e:
+                # the chunks before it are still indexed and checkpointed, so a re-run tries again from here
+                print(f"Error reading {raw_file} in the chunk from line {start_line} (byte {start_offset}): {str(e)}; "
+                      f"skipping the rest of the file")
+
+    _ingest(db_root_str, collect_raw_chunks, workers, batch_size, known_words, mode)
+
+
+def index_pending_baseforms(db_root_str: str, workers: int = 1, batch_size: int = 32,
+                            known_words: Optional[Set[str]] = None) -> None:
+    """
+    Baseform pass for the sources indexed in kanji mode: tokenize their stored lines and add the baseform appearances.
+    The kanji appearances were ranked without baseforms, so under the ranked cap policy they keep those scores.
+    """
+    def collect_stored_chunks(writer: AppearanceWriter) -> Iterator[StoredChunk]:
+        for sourcefile_id, filename in get_sources_missing_baseforms(writer.conn):
+            yield StoredChunk(sourcefile_id, filename, get_source_lines(writer.conn, sourcefile_id))
 
+    _ingest(db_root_str, collect_stored_chunks, workers, batch_size, known_words)
+
+
+def _find_resume_point(writer: AppearanceWriter, raw_file: Path, chunk_size: int) -> Tuple[int, int]:
+    """
+    Compare the stored chunks of a changed raw file against its current bytes, delete everything from the first
+    chunk that no longer matches (a trailing partial chunk counts, so appends refill it), and return the
+    (byte offset, line) to re-index from. Chunks are line based, so after an edit that changes the line count every
+    later chunk shifts and is re-indexed too.
+    """
+    chunks = get_raw_file_chunks(writer.conn, str(raw_file))
+    header = b''
+    with raw_file.open('rb') as f:
+        if raw_file.suffix.lower() == '.tsv':
+            header = f.readline()
+        first_stale = len(chunks)
+        for idx, chunk in enumerate(chunks):
+            f.seek(chunk.byte_start)
+            data = f.read(chunk.byte_end - chunk.byte_start)
+            if (len(data) != chunk.byte_end - chunk.byte_start
+                    or _chunk_hash(header, data) != chunk.content_hash
+                    or chunk.line_end - chunk.line_start < chunk_size):
+                first_stale = idx
+                break
+
+    stale = chunks[first_stale:]
+    if stale:
+        print(f"{raw_file} changed, re-indexing from line {stale[0].line_start}")
+        writer.remove_source_files([chunk.sourcefile_id for chunk in stale])
+        return stale[0].byte_start, stale[0].line_start
+    if chunks:
+        return chunks[-1].byte_end, chunks[-1].line_end
+    return 0, 0
+
+
+def _chunk_hash(tsv_header: bytes, data: bytes) -> bytes:
+    # a tsv chunk's text depends on the header's column order, so it's part of the hash
+    return hashlib.blake2b(tsv_header + data, digest_size=16).digest()
+
+
+def _iter_mmap_lines(mm: mmap.mmap, start: int) -> Iterator[Tuple[int, int]]:
+    """(start, end) byte offsets of each line from start on, end including the newline."""
+    position = start
+    size = len(mm)
+    while position < size:
+        newline = mm.find(b'\n', position)
+        end = size if newline == -1 else newline + 1
+        yield position, end
+        position = end
+
+
+def _iter_tsv_lines(mm: mmap.mmap, start: int) -> Iterator[Tuple[str, int]]:
+    """Decoded lines with the byte offset after each one, split like a file opened with newline=''."""
+    for line_start, end in _iter_mmap_lines(mm, start):
+        line = mm[line_start:end]
+        position = 0
+        # a lone \r ends a line too
+        carriage_return = line.find(b'\r')
+        while carriage_return != -1 and carriage_return + 1 < len(line) and line[carriage_return + 1] != ord('\n'):
+            yield line[position:carriage_return + 1].decode('utf-8'), line_start + carriage_return + 1
+            position = carriage_return + 1
+            carriage_return = line.find(b'\r', position)
+        yield line[position:].decode('utf-8'), end
+
+
+def _iter_tsv_records(mm: mmap.mmap, start: int) -> Iterator[Tuple[List[str], int]]:
+    """
+    Parsed TSV rows with the byte offset after each one; quoted fields may span lines. The reader pulls one line at a
+    time and doesn't read ahead, so a row ends with the last line it pulled.
+    """
+    line_end = start
+
+    def lines() -> Iterator[str]:
+        nonlocal line_end
+        for text, end in _iter_tsv_lines(mm, start):
+            line_end = end
+            yield text
+
+    for row in csv.reader(lines(), delimiter='\t'):
+        yield row, line_end
+
+
+def iter_raw_chunks(raw_file: Path, chunk_size: int, start_offset: int = 0, start_line: int = 0) -> Iterator[RawChunk]:
+    """
+    Split a raw txt/tsv file into RawChunks the way chunk_data splits it into files, starting at a byte offset
+    previously reported as a chunk's end_offset. Lines are found by scanning a memory map of the file.
+    """
+    suffix = raw_file.suffix.lower()
+    if suffix not in ('.txt', '.tsv'):
+        raise ValueError(f"Unsupported file type: {raw_file.suffix}")
+    stat = raw_file.stat()
+    if stat.st_size == 0:
+        return
+
+    with raw_file.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header = b''
+        if suffix == '.txt':
+            records = ((mm[line_start:end].decode('utf-8'), end)
+                       for line_start, end in _iter_mmap_lines(mm, start_offset))
+        else:
+            headers, header_end = next(_iter_tsv_records(mm, 0), ([], 0))
+            if 'Dialogue' not in headers:
+                raise ValueError(f"TSV file {raw_file} must contain a 'Dialogue' column")
+            header = mm[:header_end]
+            dialogue_idx = headers.index('Dialogue')
+            name_idx = headers.index('Name') if 'Name' in headers else -1
+            start_offset = max(start_offset, header_end)
+            records = ((_format_dialogue(row, name_idx, dialogue_idx) + '\n', end)
+                       for row, end in _iter_tsv_records(mm, start_offset) if row)
+
+        def make_chunk(chunk_start: int, chunk_end: int, line_number: int, lines: List[str]) -> RawChunk:
+            return RawChunk(raw_file, line_number, line_number + len(lines), chunk_start, chunk_end,
+                            _chunk_hash(header, mm[chunk_start:chunk_end]), stat.st_size, stat.st_mtime_ns,
+                            ''.join(lines))
+
+        line_number = start_line
+        chunk_start = start_offset
+        chunk_lines = []
+        end_offset = start_offset
+        for text, end_offset in records:
+            chunk_lines.append(text)
+            if len(chunk_lines) >= chunk_size:
+                yield make_chunk(chunk_start, end_offset, line_number, chunk_lines)
+                line_number += len(chunk_lines)
+                chunk_start = end_offset
+                chunk_lines = []
+        if chunk_lines:
+            yield make_chunk(chunk_start, end_offset, line_number, chunk_lines)
+
+
+def lemmatize_known_words(words: Iterable[str]) -> Set[str]:
+    """Baseforms of the given words, e.g. the first fields of the user's studied Anki cards."""
+    tagger = fugashi.Tagger('-Owakati')
+    return {get_baseform(tagger, word.strip()) for word in words if word.strip()}
+
+
+def load_known_words(known_words_file: Optional[str], known_words_deck: Optional[str]) -> Set[str]:
+    words = []
+    if known_words_file:
+        with open(known_words_file, 'r', encoding='utf-8') as f:
+            words.extend(f.read().splitlines())
+    if known_words_deck:
+        anki_client = AnkiConnectClient()
+        words.extend(card.first_field for card in anki_client.get_reviewed_cards(deck_name=known_words_deck))
+    return lemmatize_known_words(words)
+
+
+def backfill_lines(db_root_str: str) -> None:
+    """Store the line text of chunks indexed before the Lines table existed, reading the chunk files once."""
+    initialize_database(db_root_str)
+    connection = get_db_connection(db_root_str, PROFILE_BULK_LOAD)
+    try:
+        missing = connection.execute("""
+            SELECT id, filename FROM SourceFiles sf
+            WHERE NOT EXISTS (SELECT 1 FROM Lines l WHERE l.sourcefile_id = sf.id)
+        """).fetchall()
+        writer = AppearanceWriter(connection)
+        for sourcefile_id, filename in missing:
+            file = Path(filename)
+            if not file.is_file():
+                print(f"Chunk file {file} no longer exists, its sentences can't be backfilled")
+                continue
+            for line_idx, line in enumerate(read_file_content(file).splitlines()):
+                if line.strip():
+                    writer.add_line(sourcefile_id, line_idx, [], [], line)
+            writer.flush()
     finally:
         connection.close()
 
 
+def _format_dialogue(row: List[str], name_idx: int, dialogue_idx: int) -> str:
+    dialogue = row[dialogue_idx] if dialogue_idx < len(row) else ''
+    if name_idx != -1 and name_idx < len(row) and row[name_idx].strip():
+        return f"{row[name_idx]}: {dialogue}"
+    return dialogue
+
+
 def read_file_content(file_path: Path) -> str:
     """
     Read content from either txt or tsv file.
@@ -237,10 +1030,7 @@ def read_file_content(file_path: Path) -> str:
                 if not row:  # Skip empty rows
                     continue
 
-                if name_idx != -1 and name_idx < len(row) and row[name_idx].strip():
-                    dialogues.append(f"{row[name_idx]}: {row[dialogue_idx]}")
-                else:
-                    dialogues.append(row[dialogue_idx])
+                dialogues.append(_format_dialogue(row, name_idx, dialogue_idx))
 
         return '\n'.join(dialogues)
 
@@ -249,7 +1039,36 @@ def read_file_content(file_path: Path) -> str:
 
 
 if __name__ == "__main__":
-    RAW_ROOT = r'data\raw'
-    CHUNK_ROOT = r'data\chunk'
-    chunk_data(RAW_ROOT, CHUNK_ROOT)
-    process_all_chunks(DATABASE_ROOT+"x", CHUNK_ROOT)
+    parser = argparse.ArgumentParser(description="Chunk the raw corpus and index it into the appearances database.")
+    parser.add_argument("--raw-root", default=os.path.join("data", "raw"))
+    parser.add_argument("--chunk-root", default=os.path.join("data", "chunk"))
+    parser.add_argument("--db", default=DATABASE_ROOT)
+    parser.add_argument("--workers", type=int, default=1, help="number of tokenizer processes")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the chunk processing order")
+    parser.add_argument("--stream", action="store_true",
+                        help="index the raw files directly instead of writing chunk files first")
+    parser.add_argument("--known-words", help="file with one known word per line, used to rank example sentences")
+    parser.add_argument("--known-words-deck", help="Anki deck whose studied cards count as known words")
+    parser.add_argument("--backfill-lines", action="store_true",
+                        help="store sentence text for chunks indexed by an older version, then exit")
+    parser.add_argument("--mode", choices=(MODE_FULL, MODE_KANJI), default=MODE_FULL,
+                        help="kanji: index only kanji, without running the tokenizer (see --index-baseforms)")
+    parser.add_argument("--index-baseforms", action="store_true",
+                        help="add the baseforms of sources indexed with --mode kanji, then exit")
+    args = parser.parse_args()
+
+    if args.backfill_lines:
+        backfill_lines(args.db)
+        raise SystemExit(0)
+
+    known = load_known_words(args.known_words, args.known_words_deck)
+    if args.index_baseforms:
+        index_pending_baseforms(args.db, workers=args.workers, known_words=known)
+        raise SystemExit(0)
+
+    if args.stream:
+        process_raw_files(args.db, args.raw_root, workers=args.workers, known_words=known, mode=args.mode)
+    else:
+        chunk_data(args.raw_root, args.chunk_root)
+        process_all_chunks(args.db, args.chunk_root, workers=args.workers, seed=args.seed, known_words=known,
+                           mode=args.mode)
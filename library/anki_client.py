@@ -1,7 +1,18 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import List, Optional, Any, Dict
+from itertools import islice
+from typing import List, Optional, Any, Dict, Iterator, Union
 import json
-import urllib.request
+import sys
+
+import urllib3
+
+# cardsInfo returns the full question and answer HTML and the CSS of every card, so large imports are fetched in pages
+CARDS_INFO_PAGE_SIZE = 100
+# actions that only read from Anki, so a request whose response was lost can safely be sent again
+READ_ONLY_ACTIONS = frozenset({"version", "findCards", "cardsInfo", "cardsModTime", "deckNames", "cardReviews"})
 
 
 @dataclass
@@ -81,9 +92,107 @@ class CardInfo:
         return ""
 
 
+@dataclass(slots=True)
+class CardRecord:
+    """
+    The part of a card the tool keeps around: enough to list, deduplicate and open it. The question and answer HTML,
+    CSS and scheduling fields stay in Anki and are fetched on demand with fetch_info.
+    """
+    cardId: int
+    note: int
+    deckName: str
+    modelName: str
+    first_field: str
+    mod: int
+
+    @classmethod
+    def from_card(cls, card: Union[CardInfo, 'CardRecord']) -> 'CardRecord':
+        if isinstance(card, CardRecord):
+            return card
+        # deck and note type names repeat across every card, so share one string per name
+        return cls(cardId=card.cardId, note=card.note, deckName=sys.intern(card.deckName),
+                   modelName=sys.intern(card.modelName), first_field=card.first_field, mod=card.mod)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'CardRecord':
+        return cls(cardId=data['cardId'], note=data['note'], deckName=sys.intern(data['deckName']),
+                   modelName=sys.intern(data['modelName']), first_field=data['first_field'], mod=data['mod'])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"cardId": self.cardId, "note": self.note, "deckName": self.deckName, "modelName": self.modelName,
+                "first_field": self.first_field, "mod": self.mod}
+
+    def fetch_info(self, client: 'AnkiConnectClient') -> Optional[CardInfo]:
+        """The full card from Anki, or None if it has been deleted."""
+        return next(client.iter_cards_info([self.cardId]), None)
+
+
+class PendingResult:
+    """The result of an action queued in an AnkiBatch, available once the batch has been sent."""
+
+    def __init__(self, action: str):
+        self.action = action
+        self._sent = False
+        self._result = None  # type: Any
+        self._error = None  # type: Optional[str]
+
+    def _set(self, response: Any) -> None:
+        self._sent = True
+        if isinstance(response, dict) and set(response) == {'result', 'error'}:
+            self._result, self._error = response['result'], response['error']
+        else:
+            self._result = response
+
+    @property
+    def result(self) -> Any:
+        if not self._sent:
+            raise Exception(f'{self.action} is queued in a batch that has not been sent yet')
+        if self._error is not None:
+            raise Exception(f'AnkiConnect {self.action} failed: {self._error}')
+        return self._result
+
+
+class AnkiBatch:
+    """Actions queued to be sent together as one AnkiConnect multi request. See AnkiConnectClient.batch."""
+
+    def __init__(self, client: 'AnkiConnectClient'):
+        self.client = client
+        self._actions = []  # type: List[Dict[str, Any]]
+        self._pending = []  # type: List[PendingResult]
+
+    def invoke(self, action: str, **params) -> PendingResult:
+        self._actions.append({"action": action, "version": 6, "params": params})
+        pending = PendingResult(action)
+        self._pending.append(pending)
+        return pending
+
+    def send(self) -> None:
+        if not self._actions:
+            return
+        actions, pending = self._actions, self._pending
+        self._actions, self._pending = [], []
+        for result, queued in zip(self.client._invoke("multi", actions=actions), pending):
+            queued._set(result)
+
+
 class AnkiConnectClient:
-    def __init__(self, host: str = "localhost", port: int = 8765):
+    """
+    AnkiConnect over a pool of keep-alive HTTP connections, so calls after the first skip the TCP handshake.
+    Failed connections are retried for every action, since the request never reached Anki. Failed reads are only
+    retried for READ_ONLY_ACTIONS (and multi requests made of them): Anki may have carried out anything else already.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 8765, timeout: float = 30.0, connect_timeout: float = 2.0,
+                 retries: int = 2, pool_size: int = 4):
         self.endpoint = f"http://{host}:{port}"
+        self._pool = urllib3.HTTPConnectionPool(
+            host, port, maxsize=pool_size, block=False,
+            timeout=urllib3.Timeout(connect=connect_timeout, read=timeout),
+            retries=urllib3.Retry(total=retries, connect=retries, read=retries, status=0, redirect=0,
+                                  allowed_methods=None, backoff_factor=0.1),
+        )
+        self._connect_retries = urllib3.Retry(total=retries, connect=retries, read=0, status=0, redirect=0,
+                                              backoff_factor=0.1)
 
     def _invoke(self, action: str, **params) -> Any:
         """Send a request to AnkiConnect."""
@@ -93,13 +202,18 @@ class AnkiConnectClient:
             "params": params
         }).encode('utf-8')
 
+        actions = [inner['action'] for inner in params['actions']] if action == "multi" else [action]
+        # None keeps the pool's retries
+        retries = None if READ_ONLY_ACTIONS.issuperset(actions) else self._connect_retries
+
         try:
-            response = urllib.request.urlopen(urllib.request.Request(
-                self.endpoint,
-                request,
-                headers={'Content-Type': 'application/json'}
-            ))
-            response_data = json.loads(response.read().decode('utf-8'))
+            response = self._pool.urlopen(
+                'POST', '/',
+                body=request,
+                headers={'Content-Type': 'application/json'},
+                retries=retries
+            )
+            response_data = json.loads(response.data.decode('utf-8'))
 
             if len(response_data) != 2:
                 raise Exception('Response has an unexpected number of fields')
@@ -118,25 +232,72 @@ class AnkiConnectClient:
         except Exception as e:
             raise Exception(f'Failed to connect to AnkiConnect: {str(e)}')
 
-    def get_failed_cards(self, days: int, limit: int, deck_name: Optional[str] = None) -> List[CardInfo]:
-        """Get cards that were failed in the last X days."""
-        query = f"rated:{days}:1"
+    @contextmanager
+    def batch(self) -> Iterator[AnkiBatch]:
+        """
+        Queue actions with batch.invoke and send them as one multi request when the block ends; each returns a
+        PendingResult to read afterwards. Only for independent actions: findCards followed by cardsInfo on its result
+        still takes two requests.
+        """
+        anki_batch = AnkiBatch(self)
+        yield anki_batch
+        anki_batch.send()
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def find_cards(self, query: str, deck_name: Optional[str] = None) -> List[int]:
         if deck_name:
             query = f"deck:\"{deck_name}\" {query}"
-
-        card_ids = self._invoke(
+        return self._invoke(
             "findCards",
             query=query
         )
 
-        card_ids = card_ids[-limit:]  # Take the most recent ones
+    def iter_cards_info(self, card_ids: List[int], page_size: int = CARDS_INFO_PAGE_SIZE,
+                        parallel: int = 1) -> Iterator[CardInfo]:
+        """
+        Yield the cards in card_ids order, fetched with one cardsInfo call per page_size ids. With parallel > 1 that
+        many pages are requested at once on separate connections, while the earlier ones are being consumed.
+        """
+        pages = (card_ids[start:start + page_size] for start in range(0, len(card_ids), page_size))
+        with ThreadPoolExecutor(max_workers=max(parallel, 1)) as executor:
+            in_flight = deque(executor.submit(self._invoke, "cardsInfo", cards=page)
+                              for page in islice(pages, max(parallel, 1)))
+            while in_flight:
+                cards_info = in_flight.popleft().result()
+                next_page = next(pages, None)
+                if next_page is not None:
+                    in_flight.append(executor.submit(self._invoke, "cardsInfo", cards=next_page))
+                for info in cards_info:
+                    # cards deleted since findCards come back as empty objects
+                    if info:
+                        yield CardInfo.from_dict(info)
+
+    def find_failed_card_ids(self, days: int, limit: int, deck_name: Optional[str] = None) -> List[int]:
+        """Ids of cards that were failed in the last X days."""
+        card_ids = self.find_cards(f"rated:{days}:1", deck_name)
+        return card_ids[-limit:]  # Take the most recent ones
+
+    def find_difficult_card_ids(
+            self,
+            limit: int,
+            deck_name: Optional[str] = None,
+            reps: int = 30,
+            ease: float = 1.4,
+    ) -> List[int]:
+        """Ids of cards with low ease factor (indicating difficulty)."""
+        reps = max(reps, 0)
+        card_ids = self.find_cards(f"prop:reps>{reps} prop:due>0 prop:ease<{ease}", deck_name)
+        return card_ids[:limit]
 
-        cards_info = self._invoke(
-            "cardsInfo",
-            cards=card_ids
-        )
+    def find_exact_match_card_ids(self, search: str, limit: int, deck_name: Optional[str] = None) -> List[int]:
+        card_ids = self.find_cards(f"*:\"{search}\"", deck_name)
+        return card_ids[:limit]
 
-        return [CardInfo.from_dict(info) for info in cards_info]
+    def get_failed_cards(self, days: int, limit: int, deck_name: Optional[str] = None) -> List[CardInfo]:
+        """Get cards that were failed in the last X days."""
+        return list(self.iter_cards_info(self.find_failed_card_ids(days, limit, deck_name)))
 
     def get_difficult_cards(
             self,
@@ -146,23 +307,7 @@ class AnkiConnectClient:
             ease: float = 1.4,
     ) -> List[CardInfo]:
         """Get cards with low ease factor (indicating difficulty)."""
-        reps = max(reps, 0)
-        query = f"prop:reps>{reps} prop:due>0 prop:ease<{ease}"
-        if deck_name:
-            query = f"deck:\"{deck_name}\" {query}"
-
-        card_ids = self._invoke(
-            "findCards",
-            query=query
-        )
-
-        card_ids = card_ids[:limit]
-        cards_info = self._invoke(
-            "cardsInfo",
-            cards=card_ids
-        )
-
-        return [CardInfo.from_dict(info) for info in cards_info]
+        return list(self.iter_cards_info(self.find_difficult_card_ids(limit, deck_name, reps, ease)))
 
     def get_exact_matches_cards(
             self,
@@ -170,22 +315,18 @@ class AnkiConnectClient:
             limit: int,
             deck_name: Optional[str] = None,
     ) -> List[CardInfo]:
-        query = f"*:\"{search}\""
-        if deck_name:
-            query = f"deck:\"{deck_name}\" {query}"
+        return list(self.iter_cards_info(self.find_exact_match_card_ids(search, limit, deck_name)))
 
-        card_ids = self._invoke(
-            "findCards",
-            query=query
-        )
+    def get_reviewed_cards(self, deck_name: Optional[str] = None) -> List[CardInfo]:
+        """Get every card that has left the new queue, i.e. words the user has studied."""
+        return list(self.iter_cards_info(self.find_cards("-is:new", deck_name)))
 
-        card_ids = card_ids[:limit]
-        cards_info = self._invoke(
-            "cardsInfo",
-            cards=card_ids
-        )
+    def get_cards_mod_time(self, card_ids: List[int]) -> Dict[int, int]:
+        """Last modification time of each card, much cheaper than cardsInfo for finding what changed."""
+        return {entry['cardId']: entry['mod'] for entry in self._invoke("cardsModTime", cards=card_ids)}
 
-        return [CardInfo.from_dict(info) for info in cards_info]
+    def get_deck_names(self) -> List[str]:
+        return self._invoke("deckNames")
 
     def open_card_browser(self, note_id: int) -> None:
         """Open the card browser focused on a specific card."""
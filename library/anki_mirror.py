@@ -0,0 +1,246 @@
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import datetime
+import math
+import sqlite3
+import threading
+import time
+
+from library.anki_client import AnkiConnectClient, CardInfo, CardRecord
+
+# Anki starts a new day at 4am by default; rated: and prop:due count days from there
+DAY_ROLLOVER_HOUR = 4
+# cardsModTime takes this many ids per action; a sync sends all the pages in one multi request
+MOD_TIME_PAGE_SIZE = 5000
+# card ids per IN (...) query when reading cards back
+READ_PAGE_SIZE = 500
+
+
+def _anki_day(timestamp: float) -> int:
+    """Ordinal of the Anki day (starting at the rollover hour, local time) that a unix time falls on."""
+    return (datetime.datetime.fromtimestamp(timestamp) - datetime.timedelta(hours=DAY_ROLLOVER_HOUR)).toordinal()
+
+
+def _anki_day_start(day: int) -> float:
+    start = datetime.datetime.combine(datetime.date.fromordinal(day), datetime.time(hour=DAY_ROLLOVER_HOUR))
+    return start.timestamp()
+
+
+def _deck_clause(deck_name: Optional[str]) -> Tuple[str, List[Any]]:
+    """SQL condition on c.deckName matching Anki's deck:"name", which includes the subdecks."""
+    if not deck_name:
+        return "", []
+    prefix = deck_name + "::"
+    return " AND (c.deckName = ? OR substr(c.deckName, 1, ?) = ?)", [deck_name, len(prefix), prefix]
+
+
+class AnkiMirror:
+    """
+    Local SQLite copy of the card fields, scheduling and review log that the imports query, kept up to date by sync.
+    Cards are only re-fetched when their mod time (or their note) changed and reviews are fetched from the last one
+    seen, so a sync costs a few small requests. The failed/difficult/exact queries run here in milliseconds and keep
+    working when Anki is closed; opening the browser still goes through AnkiConnect.
+    """
+
+    def __init__(self, db_path: str, client: AnkiConnectClient):
+        self.client = client
+        self.last_sync_attempt = 0.0
+        self._lock = threading.Lock()  # the connection is shared by the Flask request threads
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS Cards (
+                cardId INTEGER PRIMARY KEY,
+                note INTEGER NOT NULL,
+                deckName TEXT NOT NULL,
+                modelName TEXT NOT NULL,
+                first_field TEXT NOT NULL,
+                factor INTEGER NOT NULL,
+                interval INTEGER NOT NULL,
+                type INTEGER NOT NULL,
+                queue INTEGER NOT NULL,
+                due INTEGER NOT NULL,
+                reps INTEGER NOT NULL,
+                lapses INTEGER NOT NULL,
+                mod INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS CardFields (
+                value TEXT NOT NULL COLLATE NOCASE,
+                cardId INTEGER NOT NULL,
+                PRIMARY KEY (value, cardId)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_cardfields_card ON CardFields(cardId);
+            -- id is the review time in milliseconds, as in Anki's revlog
+            CREATE TABLE IF NOT EXISTS Reviews (
+                id INTEGER PRIMARY KEY,
+                cardId INTEGER NOT NULL,
+                ease INTEGER NOT NULL,
+                interval INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_reviews_card ON Reviews(cardId, id);
+            CREATE TABLE IF NOT EXISTS SyncState (
+                key TEXT PRIMARY KEY,
+                value
+            );
+        ''')
+        self.conn.commit()
+
+    def _get_state(self, key: str, default: Any = None) -> Any:
+        row = self.conn.execute("SELECT value FROM SyncState WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_state(self, key: str, value: Any) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO SyncState (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def last_sync(self) -> Optional[float]:
+        """When the mirror last synced successfully, None if it never did."""
+        with self._lock:
+            return self._get_state('last_sync')
+
+    def sync(self) -> bool:
+        """Bring the mirror up to date with Anki. Returns False, leaving the mirror as it was, if Anki is closed."""
+        with self._lock:
+            self.last_sync_attempt = time.time()
+            try:
+                self._sync()
+            except Exception as e:
+                self.conn.rollback()
+                print(f"Anki mirror not synced, using the local copy: {e}")
+                return False
+            return True
+
+    def sync_if_stale(self, max_age: float) -> bool:
+        """Sync unless the last attempt (successful or not) was less than max_age seconds ago."""
+        if time.time() - self.last_sync_attempt < max_age:
+            return False
+        return self.sync()
+
+    def _sync(self) -> None:
+        # the queries that don't depend on each other go out together, so a sync takes two multi requests before the
+        # cardsInfo pages of the changed cards
+        started = time.time()
+        last_sync = self._get_state('last_sync')
+        last_review_id = self._get_state('last_review_id', 0)
+        with self.client.batch() as batch:
+            all_cards = batch.invoke("findCards", query="deck:*")
+            deck_names = batch.invoke("deckNames")
+            edited_cards = None
+            if last_sync is not None:
+                # editing a note changes the note's mod time, not its cards'
+                edited_cards = batch.invoke("findCards",
+                                            query=f"edited:{math.ceil((started - last_sync) / 86400) + 1}")
+        card_ids = all_cards.result
+        edited = set(edited_cards.result) if edited_cards is not None else set()
+
+        # Anki only reports reviews per deck (without subdecks), so ask for every deck along with the mod times
+        with self.client.batch() as batch:
+            mod_time_pages = [batch.invoke("cardsModTime", cards=card_ids[start:start + MOD_TIME_PAGE_SIZE])
+                              for start in range(0, len(card_ids), MOD_TIME_PAGE_SIZE)]
+            pending_reviews = [batch.invoke("cardReviews", deck=deck, startID=last_review_id)
+                               for deck in deck_names.result]
+        mod_times = {entry['cardId']: entry['mod'] for page in mod_time_pages for entry in page.result}
+        # [reviewTime, cardID, usn, buttonPressed, newInterval, previousInterval, newFactor, reviewDuration, reviewType]
+        reviews = [(review[0], review[1], review[3], review[4])
+                   for result in pending_reviews for review in result.result]
+
+        local_mod_times = dict(self.conn.execute("SELECT cardId, mod FROM Cards"))
+        changed = [card_id for card_id in card_ids
+                   if local_mod_times.get(card_id) != mod_times.get(card_id) or card_id in edited]
+        deleted = [(card_id,) for card_id in local_mod_times.keys() - set(card_ids)]
+
+        with self.conn:
+            for card in self.client.iter_cards_info(changed):
+                self._store_card(card)
+            self.conn.executemany("DELETE FROM CardFields WHERE cardId = ?", deleted)
+            self.conn.executemany("DELETE FROM Cards WHERE cardId = ?", deleted)
+            self.conn.executemany("INSERT OR IGNORE INTO Reviews (id, cardId, ease, interval) VALUES (?, ?, ?, ?)",
+                                  reviews)
+            if reviews:
+                self._set_state('last_review_id', max(last_review_id, max(review[0] for review in reviews)))
+            self._set_state('day_offset', self._find_day_offset())
+            self._set_state('last_sync', started)
+
+    def _store_card(self, card: CardInfo) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO Cards (cardId, note, deckName, modelName, first_field, factor, interval, type, "
+            "queue, due, reps, lapses, mod) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (card.cardId, card.note, card.deckName, card.modelName, card.first_field, card.factor, card.interval,
+             card.type, card.queue, card.due, card.reps, card.lapses, card.mod))
+        self.conn.execute("DELETE FROM CardFields WHERE cardId = ?", (card.cardId,))
+        self.conn.executemany("INSERT OR IGNORE INTO CardFields (value, cardId) VALUES (?, ?)",
+                              [(field.value, card.cardId) for field in card.fields.values() if field.value])
+
+    def _find_day_offset(self) -> Optional[int]:
+        """
+        The review cards' due is a day number counted from the collection's creation, which AnkiConnect doesn't
+        report. A card's last review day plus its interval is the same day, so the most common difference between
+        the two converts Anki days to local ones.
+        """
+        rows = self.conn.execute('''
+            SELECT c.due, r.id, r.interval
+            FROM Cards c JOIN Reviews r ON r.id = (SELECT MAX(id) FROM Reviews WHERE cardId = c.cardId)
+            WHERE c.type = 2 AND c.queue IN (2, 3) AND r.interval > 0
+        ''')
+        offsets = Counter(due - (_anki_day(review_id / 1000) + interval) for due, review_id, interval in rows)
+        return offsets.most_common(1)[0][0] if offsets else self._get_state('day_offset')
+
+    def find_failed_card_ids(self, days: int, limit: int, deck_name: Optional[str] = None) -> List[int]:
+        """Ids of cards answered Again in the last X days, like rated:X:1."""
+        since = _anki_day_start(_anki_day(time.time()) - max(days - 1, 0))
+        deck_sql, deck_params = _deck_clause(deck_name)
+        with self._lock:
+            card_ids = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT r.cardId FROM Reviews r JOIN Cards c ON c.cardId = r.cardId "
+                f"WHERE r.ease = 1 AND r.id >= ?{deck_sql} ORDER BY r.cardId",
+                [int(since * 1000)] + deck_params)]
+        return card_ids[-limit:]  # Take the most recent ones
+
+    def find_difficult_card_ids(
+            self,
+            limit: int,
+            deck_name: Optional[str] = None,
+            reps: int = 30,
+            ease: float = 1.4,
+    ) -> List[int]:
+        """Ids of cards with low ease factor, like prop:reps>R prop:due>0 prop:ease<E."""
+        deck_sql, deck_params = _deck_clause(deck_name)
+        with self._lock:
+            day_offset = self._get_state('day_offset')
+            due_sql, due_params = "", []
+            # without any reviews to work out today's day number, overdue cards are included too
+            if day_offset is not None:
+                due_sql, due_params = " AND c.queue IN (2, 3) AND c.due > ?", [_anki_day(time.time()) + day_offset]
+            return [row[0] for row in self.conn.execute(
+                f"SELECT c.cardId FROM Cards c WHERE c.reps > ? AND c.factor < ?{due_sql}{deck_sql} "
+                "ORDER BY c.cardId LIMIT ?",
+                [max(reps, 0), round(ease * 1000)] + due_params + deck_params + [max(limit, 0)])]
+
+    def find_exact_match_card_ids(self, search: str, limit: int, deck_name: Optional[str] = None) -> List[int]:
+        """Ids of cards with a field equal to search (ignoring case), like *:"search"."""
+        deck_sql, deck_params = _deck_clause(deck_name)
+        with self._lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT f.cardId FROM CardFields f JOIN Cards c ON c.cardId = f.cardId "
+                f"WHERE f.value = ?{deck_sql} ORDER BY f.cardId LIMIT ?",
+                [search] + deck_params + [max(limit, 0)])]
+
+    def iter_cards(self, card_ids: List[int]) -> Iterator[CardRecord]:
+        """The mirrored cards in card_ids order, skipping ids that aren't in the mirror."""
+        for start in range(0, len(card_ids), READ_PAGE_SIZE):
+            page = card_ids[start:start + READ_PAGE_SIZE]
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT cardId, note, deckName, modelName, first_field, mod FROM Cards "
+                    f"WHERE cardId IN ({','.join('?' * len(page))})", page).fetchall()
+            records = {row[0]: CardRecord(*row) for row in rows}  # type: Dict[int, CardRecord]
+            for card_id in page:
+                if card_id in records:
+                    yield records[card_id]
+
+    def open_card_browser(self, note_id: int) -> None:
+        """Needs Anki running; raises like AnkiConnectClient otherwise."""
+        self.client.open_card_browser(note_id)
@@ -1,29 +1,61 @@
+from collections import Counter
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 import fugashi
+import heapq
+import json
 import logging
+import queue
 import sqlite3
+import threading
+import zlib
+
+from library.sentence_ranking import AppearanceScorer
+from library.settings_manager import settings
 
 DATABASE_ROOT = "data/real_db.db"
 
+KIND_KANJI = "kanji"
+KIND_BASEFORM = "baseform"
+# kind -> (appearances table, term column)
+APPEARANCE_TABLES = {
+    KIND_KANJI: ("KanjiAppearances", "kanji"),
+    KIND_BASEFORM: ("BaseFormAppearances", "baseform"),
+}
 
-def _initialize_database(db_path: str) -> None:
-    db_file = Path(db_path)
-    if not db_file.parent.exists() and db_file.parent != Path('.'):
-        db_file.parent.mkdir(parents=True, exist_ok=True)
+# Indexes that aren't needed while bulk loading; catalog_data drops them for the load and rebuilds them afterwards.
+# The appearance tables are clustered on their primary key, which already serves the per-term cap bookkeeping.
+SECONDARY_INDEXES = {
+    "idx_kanji_appearances_score": """
+        CREATE INDEX IF NOT EXISTS idx_kanji_appearances_score
+        ON KanjiAppearances (kanji, score DESC);
+    """,
+    "idx_baseform_appearances_score": """
+        CREATE INDEX IF NOT EXISTS idx_baseform_appearances_score
+        ON BaseFormAppearances (baseform, score DESC);
+    """,
+    "idx_term_counts_frequency": """
+        CREATE INDEX IF NOT EXISTS idx_term_counts_frequency
+        ON TermCounts (kind, frequency DESC);
+    """,
+}
 
-    with sqlite3.connect(db_path) as conn:
-        conn.execute("PRAGMA foreign_keys = ON;")
+# Pragmas that a connection profile in settings.toml may set.
+PROFILE_PRAGMAS = {"journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "query_only"}
+PROFILE_BULK_LOAD = "bulk_load"
+PROFILE_READ = "read"
 
-        create_sourcefiles_table = """
+
+def _migrate_initial_schema(conn: sqlite3.Connection) -> None:
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS SourceFiles (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             filename TEXT UNIQUE NOT NULL
         );
-        """
-
-        create_kanjiappearances_table = """
+    """)
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS KanjiAppearances (
             kanji TEXT NOT NULL,
             sourcefile_id INTEGER NOT NULL,
@@ -31,9 +63,8 @@ def _initialize_database(db_path: str) -> None:
             FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
             PRIMARY KEY (kanji, sourcefile_id, line_number)
         );
-        """
-
-        create_baseformappearances_table = """
+    """)
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS BaseFormAppearances (
             baseform TEXT NOT NULL,
             sourcefile_id INTEGER NOT NULL,
@@ -41,28 +72,226 @@ def _initialize_database(db_path: str) -> None:
             FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
             PRIMARY KEY (baseform, sourcefile_id, line_number)
         );
-        """
-
-        create_idx_kanji_appearances = """
-        CREATE INDEX IF NOT EXISTS idx_kanji_appearances 
-        ON KanjiAppearances (kanji, sourcefile_id, line_number);
-        """
-
-        create_idx_baseform_appearances = """
-        CREATE INDEX IF NOT EXISTS idx_baseform_appearances 
-        ON BaseFormAppearances (baseform, sourcefile_id, line_number);
-        """
-
-        conn.executescript(f"""
-        {create_sourcefiles_table}
-        {create_kanjiappearances_table}
-        {create_baseformappearances_table}
-        """)
+    """)
+
 
-        conn.executescript(f"""
-        {create_idx_kanji_appearances}
-        {create_idx_baseform_appearances}
+def _migrate_term_counts(conn: sqlite3.Connection) -> None:
+    # count is the number of rows stored for the term (what max_appearances caps), frequency is the number of
+    # lines the term was seen on, including the ones the cap dropped
+    has_term_counts = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'TermCounts'").fetchone() is not None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS TermCounts (
+            term TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            frequency INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, term)
+        );
+    """)
+    if not has_term_counts:
+        rebuild_term_counts(conn)
+
+
+def _migrate_appearances_without_rowid(conn: sqlite3.Connection) -> None:
+    # The old idx_*_appearances indexes duplicated the primary key; dropping the tables drops them too.
+    for table, column in APPEARANCE_TABLES.values():
+        conn.execute(f"""
+            CREATE TABLE {table}_new (
+                {column} TEXT NOT NULL,
+                sourcefile_id INTEGER NOT NULL,
+                line_number INTEGER NOT NULL,
+                FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
+                PRIMARY KEY ({column}, sourcefile_id, line_number)
+            ) WITHOUT ROWID;
         """)
+        conn.execute(f"""
+            INSERT INTO {table}_new ({column}, sourcefile_id, line_number)
+            SELECT {column}, sourcefile_id, line_number FROM {table}
+        """)
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+def _migrate_lines(conn: sqlite3.Connection) -> None:
+    # text is encoded with encode_line_text
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS Lines (
+            sourcefile_id INTEGER NOT NULL,
+            line_number INTEGER NOT NULL,
+            text BLOB NOT NULL,
+            FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
+            PRIMARY KEY (sourcefile_id, line_number)
+        ) WITHOUT ROWID;
+    """)
+
+
+def _migrate_appearance_scores(conn: sqlite3.Connection) -> None:
+    # see library/sentence_ranking.py; rows indexed before ranking existed all score 0
+    for table, _ in APPEARANCE_TABLES.values():
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN score REAL NOT NULL DEFAULT 0")
+
+
+def _migrate_metadata(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS Metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """)
+
+
+def _migrate_raw_files(conn: sqlite3.Connection) -> None:
+    # how far catalog_data.process_raw_files got in each raw file: the byte offset and line count after the last
+    # committed chunk
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS RawFiles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT UNIQUE NOT NULL,
+            byte_offset INTEGER NOT NULL DEFAULT 0,
+            line_count INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+
+
+def _migrate_raw_file_changes(conn: sqlite3.Connection) -> None:
+    # size/mtime_ns of a raw file when it was indexed, and where each streamed chunk came from, so edits and appends
+    # can be detected (see catalog_data.process_raw_files)
+    conn.execute("ALTER TABLE RawFiles ADD COLUMN size INTEGER")
+    conn.execute("ALTER TABLE RawFiles ADD COLUMN mtime_ns INTEGER")
+    for column, column_type in (("raw_file", "TEXT"), ("byte_start", "INTEGER"), ("byte_end", "INTEGER"),
+                                ("line_start", "INTEGER"), ("line_end", "INTEGER"), ("content_hash", "BLOB")):
+        conn.execute(f"ALTER TABLE SourceFiles ADD COLUMN {column} {column_type}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_source_files_raw_file ON SourceFiles (raw_file, byte_start)")
+
+
+def _migrate_baseforms_indexed(conn: sqlite3.Connection) -> None:
+    # 0 for sources indexed by catalog_data's kanji mode until the baseform pass reaches them
+    conn.execute("ALTER TABLE SourceFiles ADD COLUMN baseforms_indexed INTEGER NOT NULL DEFAULT 1")
+
+
+def _migrate_source_term_counts(conn: sqlite3.Connection) -> None:
+    # per source file and kind, the number of its lines each term was on (encoded with encode_term_counts), so
+    # deleting a source takes exactly its lines out of TermCounts.frequency
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS SourceTermCounts (
+            sourcefile_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            counts BLOB NOT NULL,
+            FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
+            PRIMARY KEY (sourcefile_id, kind)
+        ) WITHOUT ROWID;
+    """)
+
+
+def _migrate_source_work(conn: sqlite3.Connection) -> None:
+    # the raw file or chunk folder a source file came from; the diversity penalty (see library/sentence_ranking.py)
+    # spreads each term's lines across works
+    conn.execute("ALTER TABLE SourceFiles ADD COLUMN work TEXT")
+    conn.execute("UPDATE SourceFiles SET work = raw_file WHERE raw_file IS NOT NULL")
+    chunk_files = conn.execute("SELECT id, filename FROM SourceFiles WHERE raw_file IS NULL").fetchall()
+    conn.executemany("UPDATE SourceFiles SET work = ? WHERE id = ?",
+                     [(str(Path(filename).parent), sourcefile_id) for sourcefile_id, filename in chunk_files])
+
+
+# Schema migrations in order; PRAGMA user_version records how many of them a database has had applied.
+MIGRATIONS = [
+    _migrate_initial_schema,
+    _migrate_term_counts,
+    _migrate_appearances_without_rowid,
+    _migrate_lines,
+    _migrate_appearance_scores,
+    _migrate_metadata,
+    _migrate_raw_files,
+    _migrate_raw_file_changes,
+    _migrate_baseforms_indexed,
+    _migrate_source_term_counts,
+    _migrate_source_work,
+]
+
+# Lines are short, so plain deflate barely helps; priming it with common kana and punctuation runs is what makes
+# compression pay off. Stored lines depend on these bytes, so add a new format byte rather than editing them.
+_LINE_FORMAT_UTF8 = 0
+_LINE_FORMAT_DEFLATE_V1 = 1
+_LINE_ZDICT_V1 = ("ありがとうございますお願いしますすみませんそうですねわかりましたどうしたのなんでだからでもじゃあ"
+                  "ちょっとやっぱりもう一度大丈夫ですかお兄ちゃんお姉ちゃん先輩先生さんくんちゃん様"
+                  "じゃないでしょうだろうかもしれないということしているしていたしてください思います"
+                  "これはそれはあれはこのそのあの私はあなたは僕は俺は彼女は彼は何をどこにいつだれ"
+                  "ですかますかでしたましたませんでしたのですんですけどよねかなよなだよだねなのね"
+                  "「」『』（）、。…！？ー").encode('utf-8')
+
+
+def migrate_database(conn: sqlite3.Connection) -> None:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # so the DDL runs inside the explicit transaction
+    try:
+        for target_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info(f"Migrating database to version {target_version} ({migration.__name__})")
+            conn.execute("BEGIN")
+            try:
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {target_version}")
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def _initialize_database(db_path: str) -> None:
+    db_file = Path(db_path)
+    if not db_file.parent.exists() and db_file.parent != Path('.'):
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA foreign_keys = ON;")
+        migrate_database(conn)
+        create_secondary_indexes(conn)
+    finally:
+        conn.close()
+
+
+def encode_line_text(text: str) -> bytes:
+    raw = text.encode('utf-8')
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=_LINE_ZDICT_V1)
+    compressed = compressor.compress(raw) + compressor.flush()
+    if len(compressed) < len(raw):
+        return bytes([_LINE_FORMAT_DEFLATE_V1]) + compressed
+    return bytes([_LINE_FORMAT_UTF8]) + raw
+
+
+def decode_line_text(data: bytes) -> str:
+    if data[0] == _LINE_FORMAT_DEFLATE_V1:
+        decompressor = zlib.decompressobj(-15, zdict=_LINE_ZDICT_V1)
+        return (decompressor.decompress(data[1:]) + decompressor.flush()).decode('utf-8')
+    return data[1:].decode('utf-8')
+
+
+def encode_term_counts(counts: Dict[str, int]) -> bytes:
+    return zlib.compress(json.dumps(counts, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_term_counts(data: bytes) -> Dict[str, int]:
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def rebuild_term_counts(conn: sqlite3.Connection) -> None:
+    """
+    Recompute TermCounts from the appearances tables, e.g. for databases created before the table existed.
+    Lines dropped by the cap were never recorded, so for those databases frequency is only a lower bound.
+    The caller commits.
+    """
+    conn.execute("DELETE FROM TermCounts")
+    for kind, (table, column) in APPEARANCE_TABLES.items():
+        conn.execute(f"""
+            INSERT INTO TermCounts (term, kind, count, frequency)
+            SELECT {column}, ?, COUNT(*), COUNT(*)
+            FROM {table}
+            GROUP BY {column}
+        """, (kind,))
 
 
 def initialize_database(db_path: str) -> None:
@@ -73,12 +302,186 @@ def initialize_database(db_path: str) -> None:
         logging.error(f"An error occurred while initializing the database: {e}")
 
 
-def get_db_connection(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+def get_db_connection(db_path: str, profile: Optional[str] = None, read_only: bool = False,
+                      check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Open a connection, applying the pragmas of the [database_profiles.<profile>] table in settings.toml if given.
+    A read_only connection fails instead of creating the database when it doesn't exist.
+    """
+    if read_only:
+        conn = sqlite3.connect(f"file:{Path(db_path).resolve().as_posix()}?mode=ro", uri=True,
+                               check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
+    if profile is not None:
+        apply_connection_profile(conn, profile)
     return conn
 
 
+def apply_connection_profile(conn: sqlite3.Connection, profile: str) -> None:
+    pragmas = settings.get_setting_fallback(f"database_profiles.{profile}", None)
+    if pragmas is None:
+        logging.warning(f"No database profile named '{profile}' in settings, using SQLite defaults.")
+        return
+    # query_only has to come last, journal_mode can't be changed once it's set
+    for name in sorted(pragmas, key=lambda pragma_name: pragma_name == "query_only"):
+        if name not in PROFILE_PRAGMAS:
+            raise ValueError(f"Unsupported pragma '{name}' in database profile '{profile}'")
+        value = pragmas[name]
+        if isinstance(value, bool):
+            value = "ON" if value else "OFF"
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+class ConnectionPool:
+    """Read-only connections shared between request threads; at most size are open at once."""
+
+    def __init__(self, db_path: str, profile: Optional[str] = PROFILE_READ, size: int = 4):
+        self.db_path = db_path
+        self.profile = profile
+        self._idle = queue.LifoQueue()  # type: queue.LifoQueue[sqlite3.Connection]
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = get_db_connection(self.db_path, self.profile, read_only=True, check_same_thread=False)
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def drop_secondary_indexes(conn: sqlite3.Connection) -> None:
+    for index_name in SECONDARY_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+    conn.commit()
+
+
+def create_secondary_indexes(conn: sqlite3.Connection) -> None:
+    for create_index in SECONDARY_INDEXES.values():
+        conn.execute(create_index)
+    conn.commit()
+
+
+def get_metadata(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM Metadata WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_metadata(conn: sqlite3.Connection, key: str, value: str) -> None:
+    conn.execute("INSERT OR REPLACE INTO Metadata (key, value) VALUES (?, ?)", (key, value))
+    conn.commit()
+
+
+@dataclass
+class RawFileProgress:
+    """How far indexing of a raw file got, and the raw file's size and mtime at the time."""
+    byte_offset: int
+    line_count: int
+    size: Optional[int]
+    mtime_ns: Optional[int]
+
+
+@dataclass
+class RawChunkOrigin:
+    """The part of a raw file a streamed chunk (a SourceFiles row) was read from."""
+    raw_file: str
+    byte_start: int
+    byte_end: int
+    line_start: int
+    line_end: int
+    content_hash: Optional[bytes]
+    sourcefile_id: int = -1
+
+
+def get_raw_file_progress(conn: sqlite3.Connection, filename: str) -> RawFileProgress:
+    row = conn.execute("""
+        SELECT byte_offset, line_count, size, mtime_ns FROM RawFiles WHERE filename = ?
+    """, (filename,)).fetchone()
+    if row is None:
+        return RawFileProgress(0, 0, None, None)
+    return RawFileProgress(row[0], row[1], row[2], row[3])
+
+
+def get_raw_file_chunks(conn: sqlite3.Connection, filename: str) -> List[RawChunkOrigin]:
+    cursor = conn.execute("""
+        SELECT id, raw_file, byte_start, byte_end, line_start, line_end, content_hash
+        FROM SourceFiles
+        WHERE raw_file = ?
+        ORDER BY byte_start
+    """, (filename,))
+    return [RawChunkOrigin(raw_file=row[1], byte_start=row[2], byte_end=row[3], line_start=row[4], line_end=row[5],
+                           content_hash=row[6], sourcefile_id=row[0]) for row in cursor.fetchall()]
+
+
+def delete_source_files(conn: sqlite3.Connection, sourcefile_ids: List[int]) -> None:
+    """
+    Delete source files with their appearances and lines, taking them out of TermCounts. The caller commits.
+    count loses the deleted appearance rows and frequency the lines recorded in SourceTermCounts. Sources indexed
+    before that table existed only take out their stored rows: lines the cap had dropped were never stored, so for
+    those frequency stays an overestimate.
+    """
+    for start in range(0, len(sourcefile_ids), 500):
+        batch = sourcefile_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(batch))
+        for kind, (table, column) in APPEARANCE_TABLES.items():
+            removed_rows = Counter(dict(conn.execute(f"""
+                SELECT {column}, COUNT(*) FROM {table}
+                WHERE sourcefile_id IN ({placeholders})
+                GROUP BY {column}
+            """, batch).fetchall()))
+            removed_lines = Counter()
+            counted = set()
+            for sourcefile_id, counts in conn.execute(f"""
+                SELECT sourcefile_id, counts FROM SourceTermCounts
+                WHERE kind = ? AND sourcefile_id IN ({placeholders})
+            """, [kind] + batch):
+                removed_lines.update(decode_term_counts(counts))
+                counted.add(sourcefile_id)
+            uncounted = [sourcefile_id for sourcefile_id in batch if sourcefile_id not in counted]
+            if uncounted:
+                removed_lines.update(dict(conn.execute(f"""
+                    SELECT {column}, COUNT(*) FROM {table}
+                    WHERE sourcefile_id IN ({", ".join("?" * len(uncounted))})
+                    GROUP BY {column}
+                """, uncounted).fetchall()))
+            conn.executemany("""
+                UPDATE TermCounts
+                SET count = MAX(count - ?, 0), frequency = MAX(frequency - ?, 0)
+                WHERE kind = ? AND term = ?
+            """, [(removed_rows[term], removed_lines[term], kind, term) for term in removed_rows | removed_lines])
+            conn.execute(f"DELETE FROM {table} WHERE sourcefile_id IN ({placeholders})", batch)
+        conn.execute(f"DELETE FROM SourceTermCounts WHERE sourcefile_id IN ({placeholders})", batch)
+        conn.execute(f"DELETE FROM Lines WHERE sourcefile_id IN ({placeholders})", batch)
+        conn.execute(f"DELETE FROM SourceFiles WHERE id IN ({placeholders})", batch)
+
+
+def get_sources_missing_baseforms(conn: sqlite3.Connection) -> List[Tuple[int, str]]:
+    """(id, filename) of the source files indexed without baseforms, in id order."""
+    return conn.execute("""
+        SELECT id, filename FROM SourceFiles WHERE baseforms_indexed = 0 ORDER BY id
+    """).fetchall()
+
+
+def get_source_lines(conn: sqlite3.Connection, sourcefile_id: int) -> List[Tuple[int, str]]:
+    """(line number, text) of every stored line of a source file."""
+    return [(line_number, decode_line_text(text)) for line_number, text in conn.execute("""
+        SELECT line_number, text FROM Lines WHERE sourcefile_id = ? ORDER BY line_number
+    """, (sourcefile_id,))]
+
+
 def get_source_file_id(conn: sqlite3.Connection, filename: str) -> int:
     try:
         cursor = conn.cursor()
@@ -112,6 +515,16 @@ def add_source_file(conn: sqlite3.Connection, filename: str) -> int:
         return -1
 
 
+def _bump_term_count(cursor: sqlite3.Cursor, kind: str, term: str, inserted: int) -> None:
+    cursor.execute("""
+        INSERT INTO TermCounts (term, kind, count, frequency)
+        VALUES (?, ?, ?, 1)
+        ON CONFLICT (kind, term) DO UPDATE SET
+            count = count + excluded.count,
+            frequency = frequency + 1
+    """, (term, kind, inserted))
+
+
 def add_kanji_appearances(
     conn: sqlite3.Connection,
     kanji_list: List[str],
@@ -126,12 +539,13 @@ def add_kanji_appearances(
             cursor.execute("""
                 INSERT OR IGNORE INTO KanjiAppearances (kanji, sourcefile_id, line_number)
                 SELECT ?, ?, ?
-                WHERE (
-                    SELECT COUNT(*)
-                    FROM KanjiAppearances
-                    WHERE kanji = ?
-                ) < ?
-            """, (kanji, sourcefile_id, line_number, kanji, max_appearances))
+                WHERE COALESCE((
+                    SELECT count
+                    FROM TermCounts
+                    WHERE kind = ? AND term = ?
+                ), 0) < ?
+            """, (kanji, sourcefile_id, line_number, KIND_KANJI, kanji, max_appearances))
+            _bump_term_count(cursor, KIND_KANJI, kanji, cursor.rowcount)
 
         conn.commit()
     except sqlite3.Error as e:
@@ -152,18 +566,297 @@ def add_baseform_appearances(
             cursor.execute("""
                 INSERT OR IGNORE INTO BaseFormAppearances (baseform, sourcefile_id, line_number)
                 SELECT ?, ?, ?
-                WHERE (
-                    SELECT COUNT(*)
-                    FROM BaseFormAppearances
-                    WHERE baseform = ?
-                ) < ?
-            """, (baseform, sourcefile_id, line_number, baseform, max_appearances))
+                WHERE COALESCE((
+                    SELECT count
+                    FROM TermCounts
+                    WHERE kind = ? AND term = ?
+                ), 0) < ?
+            """, (baseform, sourcefile_id, line_number, KIND_BASEFORM, baseform, max_appearances))
+            _bump_term_count(cursor, KIND_BASEFORM, baseform, cursor.rowcount)
 
         conn.commit()
     except sqlite3.Error as e:
         print(f"Database error: {e}")
 
 
+class _TermState:
+    __slots__ = ("count", "frequency", "min_score", "kept", "works")
+
+    def __init__(self, count: int, frequency: int):
+        self.count = count
+        self.frequency = frequency
+        # lowest stored score once the term is capped, so most candidates are rejected without touching the db
+        self.min_score = None  # type: Optional[float]
+        # min-heap of (score, sourcefile_id, line_number) for the stored rows, loaded only while it's needed
+        self.kept = None  # type: Optional[List[Tuple[float, int, int]]]
+        # work -> rows kept from it, when the scorer uses work hits
+        self.works = None  # type: Optional[Counter]
+
+
+class AppearanceWriter:
+    """
+    Buffers the appearances of a batch of chunks and writes them with executemany in a single transaction.
+    The max_appearances cap is checked against TermCounts entries cached in memory, and the updated counts are written
+    in the same transaction as the rows.
+    With a scorer (see library/sentence_ranking.py), a capped term keeps its max_appearances highest scoring lines,
+    replacing lower ones as better lines come in. Without one every score is 0 and the first lines win, like
+    add_kanji_appearances/add_baseform_appearances.
+    Lines are scored for familiarity against the frequencies given to set_corpus_frequencies, or failing that the
+    running TermCounts frequencies, which are low for the lines indexed first.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, max_appearances: int = 50,
+                 ranker: Optional[AppearanceScorer] = None):
+        self.conn = conn
+        self.max_appearances = max_appearances
+        self.ranker = ranker
+        self._terms = {}  # type: Dict[Tuple[str, str], _TermState]
+        self._dirty_terms = set()  # type: Set[Tuple[str, str]]
+        # per kind, term -> {(sourcefile_id, line_number): score} to insert and {(sourcefile_id, line_number)} to delete
+        self._inserts = {
+            kind: {} for kind in APPEARANCE_TABLES
+        }  # type: Dict[str, Dict[str, Dict[Tuple[int, int], float]]]
+        self._deletes = {kind: {} for kind in APPEARANCE_TABLES}  # type: Dict[str, Dict[str, Set[Tuple[int, int]]]]
+        self._line_rows = []  # type: List[Tuple[int, int, bytes]]
+        # (sourcefile_id, kind) -> term -> lines of the source it was on, for SourceTermCounts
+        self._source_terms = {}  # type: Dict[Tuple[int, str], Counter]
+        self._source_name = ""
+        self._work = ""
+        # sourcefile_id -> work, for the sources whose rows the term states count
+        self._source_works = {}  # type: Dict[int, str]
+        self._corpus_frequencies = None  # type: Optional[Dict[str, int]]
+        self._raw_file_progress = {}  # type: Dict[str, RawFileProgress]
+        # appearances added/dropped_by_cap/replaced and rows committed, for ingestion reports
+        self.counts = Counter()  # type: Counter
+
+    def add_source_file(self, filename: str, work: Optional[str] = None) -> int:
+        # Not committed until flush, so a chunk is only marked as processed together with its appearances.
+        # work is the raw file or chunk folder the source came from; an existing source keeps the one it has.
+        self._source_name = filename
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            INSERT OR IGNORE INTO SourceFiles (filename, work)
+            VALUES (?, ?)
+        """, (filename, work))
+        cursor.execute("""
+            SELECT id, work FROM SourceFiles WHERE filename = ?
+        """, (filename,))
+        sourcefile_id, stored_work = cursor.fetchone()
+        self._work = stored_work or filename
+        self._source_works[sourcefile_id] = self._work
+        return sourcefile_id
+
+    def set_corpus_frequencies(self, frequencies: Dict[str, int]) -> None:
+        """Baseform -> lines it is on in the whole corpus, counted before indexing, for scoring familiarity."""
+        self._corpus_frequencies = frequencies
+
+    def set_source_file_origin(self, sourcefile_id: int, origin: RawChunkOrigin) -> None:
+        self.conn.execute("""
+            UPDATE SourceFiles
+            SET raw_file = ?, byte_start = ?, byte_end = ?, line_start = ?, line_end = ?, content_hash = ?
+            WHERE id = ?
+        """, (origin.raw_file, origin.byte_start, origin.byte_end, origin.line_start, origin.line_end,
+              origin.content_hash, sourcefile_id))
+
+    def set_baseforms_indexed(self, sourcefile_id: int, indexed: bool) -> None:
+        self.conn.execute("UPDATE SourceFiles SET baseforms_indexed = ? WHERE id = ?", (int(indexed), sourcefile_id))
+
+    def set_raw_file_progress(self, filename: str, progress: RawFileProgress) -> None:
+        """Checkpoint a streamed raw file; written with the batch so it never runs ahead of the appearances."""
+        self._raw_file_progress[filename] = progress
+
+    def remove_source_files(self, sourcefile_ids: List[int]) -> None:
+        """Flush, then delete the source files (see delete_source_files) and forget the cached term state."""
+        self.flush()
+        try:
+            delete_source_files(self.conn, sourcefile_ids)
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        finally:
+            self._terms.clear()
+            self._source_works.clear()
+
+    def add_line(self, sourcefile_id: int, line_number: int, kanji_list: List[str], baseform_list: List[str],
+                 text: Optional[str] = None, store_text: bool = True) -> None:
+        # store_text=False when the line is already in Lines and text is only passed for ranking
+        if text is not None and store_text:
+            self._line_rows.append((sourcefile_id, line_number, encode_line_text(text)))
+
+        line_terms = [(KIND_KANJI, kanji) for kanji in kanji_list]
+        line_terms += [(KIND_BASEFORM, baseform) for baseform in baseform_list]
+        states = [self._term_state(key) for key in line_terms]
+        for (kind, term), state in zip(line_terms, states):
+            state.frequency += 1
+            self._source_terms.setdefault((sourcefile_id, kind), Counter())[term] += 1
+
+        line_score = 0.0
+        if self.ranker is not None:
+            line_score = self.ranker.score_line(text, baseform_list, self._frequency_of)
+
+        for key, state in zip(line_terms, states):
+            score = line_score
+            if self.ranker is not None:
+                work_hits = state.works[self._work] if state.works is not None else 0
+                score = self.ranker.score_appearance(line_score, work_hits, key[1], self._source_name, line_number)
+            if self._offer(key, state, (score, sourcefile_id, line_number)) and state.works is not None:
+                state.works[self._work] += 1
+
+    def _term_state(self, key: Tuple[str, str]) -> _TermState:
+        state = self._terms.get(key)
+        if state is None:
+            row = self.conn.execute("""
+                SELECT count, frequency FROM TermCounts WHERE kind = ? AND term = ?
+            """, key).fetchone()
+            state = _TermState(row[0], row[1]) if row else _TermState(0, 0)
+            if self.ranker is not None and self.ranker.uses_work_hits:
+                state.works = self._load_works(key) if state.count else Counter()
+            self._terms[key] = state
+        self._dirty_terms.add(key)
+        return state
+
+    def _frequency_of(self, baseform: str) -> int:
+        if self._corpus_frequencies is not None:
+            return self._corpus_frequencies.get(baseform, 0)
+        return self._terms[(KIND_BASEFORM, baseform)].frequency
+
+    def _load_works(self, key: Tuple[str, str]) -> Counter:
+        kind, term = key
+        table, column = APPEARANCE_TABLES[kind]
+        works = Counter()
+        for sourcefile_id, work, rows in self.conn.execute(f"""
+                    SELECT a.sourcefile_id, COALESCE(s.work, s.filename), COUNT(*)
+                    FROM {table} a JOIN SourceFiles s ON s.id = a.sourcefile_id
+                    WHERE a.{column} = ?
+                    GROUP BY a.sourcefile_id
+                """, (term,)):
+            works[work] += rows
+            self._source_works[sourcefile_id] = work
+        return works
+
+    def _offer(self, key: Tuple[str, str], state: _TermState, candidate: Tuple[float, int, int]) -> bool:
+        """Keep the candidate if the cap allows, evicting the lowest kept row if needed; True if it was kept."""
+        kind, term = key
+        score, sourcefile_id, line_number = candidate
+        if state.count < self.max_appearances:
+            state.count += 1
+            self.counts['appearances_added'] += 1
+            self._inserts[kind].setdefault(term, {})[(sourcefile_id, line_number)] = score
+            if state.kept is not None:
+                heapq.heappush(state.kept, candidate)
+            return True
+
+        if state.min_score is not None and score <= state.min_score:
+            self.counts['appearances_dropped_by_cap'] += 1
+            return False
+        if state.kept is None:
+            state.kept = self._load_kept(kind, term)
+        if not state.kept or score <= state.kept[0][0]:
+            state.min_score = state.kept[0][0] if state.kept else None
+            self.counts['appearances_dropped_by_cap'] += 1
+            return False
+
+        self.counts['appearances_replaced'] += 1
+
+        _, evicted_sourcefile_id, evicted_line_number = heapq.heapreplace(state.kept, candidate)
+        evicted = (evicted_sourcefile_id, evicted_line_number)
+        pending = self._inserts[kind].get(term, {})
+        if evicted in pending:
+            del pending[evicted]
+        else:
+            self._deletes[kind].setdefault(term, set()).add(evicted)
+        self._inserts[kind].setdefault(term, {})[(sourcefile_id, line_number)] = score
+        state.min_score = state.kept[0][0]
+        if state.works is not None:
+            evicted_work = self._work_of(evicted_sourcefile_id)
+            state.works[evicted_work] -= 1
+            if state.works[evicted_work] <= 0:
+                del state.works[evicted_work]
+        return True
+
+    def _work_of(self, sourcefile_id: int) -> str:
+        work = self._source_works.get(sourcefile_id)
+        if work is None:
+            work = self.conn.execute("""
+                SELECT COALESCE(work, filename) FROM SourceFiles WHERE id = ?
+            """, (sourcefile_id,)).fetchone()[0]
+            self._source_works[sourcefile_id] = work
+        return work
+
+    def _load_kept(self, kind: str, term: str) -> List[Tuple[float, int, int]]:
+        table, column = APPEARANCE_TABLES[kind]
+        deleted = self._deletes[kind].get(term, set())
+        kept = [(row[0], row[1], row[2]) for row in self.conn.execute(f"""
+                    SELECT score, sourcefile_id, line_number FROM {table} WHERE {column} = ?
+                """, (term,)) if (row[1], row[2]) not in deleted]
+        kept += [(score, location[0], location[1]) for location, score in self._inserts[kind].get(term, {}).items()]
+        heapq.heapify(kept)
+        return kept
+
+    def flush(self) -> None:
+        written = Counter()
+        try:
+            cursor = self.conn.cursor()
+            for kind, (table, column) in APPEARANCE_TABLES.items():
+                cursor.executemany(f"""
+                    DELETE FROM {table} WHERE {column} = ? AND sourcefile_id = ? AND line_number = ?
+                """, [(term, sourcefile_id, line_number) for term, locations in self._deletes[kind].items()
+                      for sourcefile_id, line_number in locations])
+                written['rows_deleted'] += max(cursor.rowcount, 0)
+                cursor.executemany(f"""
+                    INSERT OR IGNORE INTO {table} ({column}, sourcefile_id, line_number, score)
+                    VALUES (?, ?, ?, ?)
+                """, [(term, sourcefile_id, line_number, score) for term, locations in self._inserts[kind].items()
+                      for (sourcefile_id, line_number), score in locations.items()])
+                written[f'{kind}_rows_inserted'] += max(cursor.rowcount, 0)
+            cursor.executemany("""
+                INSERT INTO TermCounts (term, kind, count, frequency)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (kind, term) DO UPDATE SET
+                    count = excluded.count,
+                    frequency = excluded.frequency
+            """, [(term, kind, self._terms[(kind, term)].count, self._terms[(kind, term)].frequency)
+                  for kind, term in self._dirty_terms])
+            cursor.executemany("""
+                INSERT OR REPLACE INTO Lines (sourcefile_id, line_number, text)
+                VALUES (?, ?, ?)
+            """, self._line_rows)
+            written['lines_stored'] += len(self._line_rows)
+            cursor.executemany("""
+                INSERT OR REPLACE INTO SourceTermCounts (sourcefile_id, kind, counts)
+                VALUES (?, ?, ?)
+            """, [(sourcefile_id, kind, encode_term_counts(counts))
+                  for (sourcefile_id, kind), counts in self._source_terms.items()])
+            cursor.executemany("""
+                INSERT INTO RawFiles (filename, byte_offset, line_count, size, mtime_ns)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (filename) DO UPDATE SET
+                    byte_offset = excluded.byte_offset,
+                    line_count = excluded.line_count,
+                    size = excluded.size,
+                    mtime_ns = excluded.mtime_ns
+            """, [(filename, progress.byte_offset, progress.line_count, progress.size, progress.mtime_ns)
+                  for filename, progress in self._raw_file_progress.items()])
+            self.conn.commit()
+            self.counts.update(written)
+            for state in self._terms.values():
+                state.kept = None
+        except sqlite3.Error:
+            self.conn.rollback()
+            # the cached state includes the rows that were just rolled back
+            self._terms.clear()
+            self._source_works.clear()
+            raise
+        finally:
+            self._dirty_terms = set()
+            self._inserts = {kind: {} for kind in APPEARANCE_TABLES}
+            self._deletes = {kind: {} for kind in APPEARANCE_TABLES}
+            self._line_rows = []
+            self._source_terms = {}
+            self._raw_file_progress = {}
+
+
 def get_baseform(tagger: fugashi.Tagger, word: str) -> str:
     for word_obj in tagger(word):
         base_form = word_obj.feature.lemma or word_obj.surface
@@ -188,7 +881,7 @@ def get_source_locations_for_baseform(conn: sqlite3.Connection, baseform: str) -
             FROM BaseFormAppearances bfa
             JOIN SourceFiles sf ON bfa.sourcefile_id = sf.id
             WHERE bfa.baseform = ?
-            ORDER BY sf.filename, bfa.line_number
+            ORDER BY bfa.score DESC, sf.filename, bfa.line_number
         """, (baseform,))
 
         return [
@@ -202,6 +895,76 @@ def get_source_locations_for_baseform(conn: sqlite3.Connection, baseform: str) -
         return []
 
 
+@dataclass
+class Sentence:
+    filename: str
+    line_number: int
+    text: str
+
+
+def _get_sentences(conn: sqlite3.Connection, kind: str, term: str, offset: int,
+                   limit: Optional[int]) -> List[Sentence]:
+    table, column = APPEARANCE_TABLES[kind]
+    try:
+        cursor = conn.execute(f"""
+            SELECT sf.filename, a.line_number, l.text
+            FROM {table} a
+            JOIN SourceFiles sf ON a.sourcefile_id = sf.id
+            JOIN Lines l ON l.sourcefile_id = a.sourcefile_id AND l.line_number = a.line_number
+            WHERE a.{column} = ?
+            ORDER BY a.score DESC, sf.filename, a.line_number
+            LIMIT ? OFFSET ?
+        """, (term, -1 if limit is None else limit, offset))
+        return [Sentence(filename=row[0], line_number=row[1], text=decode_line_text(row[2]))
+                for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return []
+
+
+def _get_sentences_for_terms(conn: sqlite3.Connection, kind: str, terms: List[str]) -> Dict[str, List[Sentence]]:
+    table, column = APPEARANCE_TABLES[kind]
+    results = {term: [] for term in terms}  # type: Dict[str, List[Sentence]]
+    unique_terms = list(results)
+    try:
+        # stay under SQLite's bound parameter limit
+        for start in range(0, len(unique_terms), 500):
+            batch = unique_terms[start:start + 500]
+            cursor = conn.execute(f"""
+                SELECT a.{column}, sf.filename, a.line_number, l.text
+                FROM {table} a
+                JOIN SourceFiles sf ON a.sourcefile_id = sf.id
+                JOIN Lines l ON l.sourcefile_id = a.sourcefile_id AND l.line_number = a.line_number
+                WHERE a.{column} IN ({", ".join("?" * len(batch))})
+                ORDER BY a.{column}, a.score DESC, sf.filename, a.line_number
+            """, batch)
+            for row in cursor:
+                results[row[0]].append(Sentence(filename=row[1], line_number=row[2], text=decode_line_text(row[3])))
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+    return results
+
+
+def get_sentences_for_baseforms(conn: sqlite3.Connection, baseforms: List[str]) -> Dict[str, List[Sentence]]:
+    """get_sentences_for_baseform for many baseforms in one query, grouped by baseform."""
+    return _get_sentences_for_terms(conn, KIND_BASEFORM, baseforms)
+
+
+def get_sentences_for_kanjis(conn: sqlite3.Connection, kanjis: List[str]) -> Dict[str, List[Sentence]]:
+    return _get_sentences_for_terms(conn, KIND_KANJI, kanjis)
+
+
+def get_sentences_for_baseform(conn: sqlite3.Connection, baseform: str, offset: int = 0,
+                               limit: Optional[int] = None) -> List[Sentence]:
+    """Stored lines containing the baseform, ready to display without reading the chunk files."""
+    return _get_sentences(conn, KIND_BASEFORM, baseform, offset, limit)
+
+
+def get_sentences_for_kanji(conn: sqlite3.Connection, kanji: str, offset: int = 0,
+                            limit: Optional[int] = None) -> List[Sentence]:
+    return _get_sentences(conn, KIND_KANJI, kanji, offset, limit)
+
+
 def get_source_locations_for_kanji(conn: sqlite3.Connection, kanji: str) -> List[SourceLocation]:
     try:
         conn.row_factory = sqlite3.Row
@@ -212,7 +975,7 @@ def get_source_locations_for_kanji(conn: sqlite3.Connection, kanji: str) -> List
             FROM KanjiAppearances ka
             JOIN SourceFiles sf ON ka.sourcefile_id = sf.id
             WHERE ka.kanji = ?
-            ORDER BY sf.filename, ka.line_number
+            ORDER BY ka.score DESC, sf.filename, ka.line_number
         """, (kanji,))
 
         return [
@@ -224,3 +987,42 @@ def get_source_locations_for_kanji(conn: sqlite3.Connection, kanji: str) -> List
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return []
+
+
+def get_term_frequency(conn: sqlite3.Connection, term: str, kind: str = KIND_BASEFORM) -> int:
+    """Number of corpus lines the term appears on, including lines beyond the stored max_appearances."""
+    try:
+        row = conn.execute("""
+            SELECT frequency FROM TermCounts WHERE kind = ? AND term = ?
+        """, (kind, term)).fetchone()
+        return row[0] if row else 0
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return 0
+
+
+def get_term_frequencies(conn: sqlite3.Connection, terms: Iterable[str], kind: str = KIND_BASEFORM) -> Dict[str, int]:
+    """get_term_frequency for many terms; terms that were never seen are left out."""
+    terms = list(terms)
+    frequencies = {}
+    for start in range(0, len(terms), 500):
+        batch = terms[start:start + 500]
+        frequencies.update(conn.execute(f"""
+            SELECT term, frequency FROM TermCounts WHERE kind = ? AND term IN ({", ".join("?" * len(batch))})
+        """, [kind] + batch))
+    return frequencies
+
+
+def get_most_frequent_terms(conn: sqlite3.Connection, kind: str = KIND_BASEFORM,
+                            limit: int = 100) -> List[Tuple[str, int]]:
+    try:
+        cursor = conn.execute("""
+            SELECT term, frequency FROM TermCounts
+            WHERE kind = ?
+            ORDER BY frequency DESC
+            LIMIT ?
+        """, (kind, limit))
+        return [(row[0], row[1]) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return []
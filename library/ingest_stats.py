@@ -0,0 +1,130 @@
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+import cProfile
+import datetime
+import hashlib
+import json
+import sys
+import time
+
+
+class IngestStats:
+    """
+    Per-stage timers and counters for an ingestion run. Each worker fills its own and hands it back with every task
+    (see take), and the writing process merges them into the run's totals.
+    """
+
+    def __init__(self):
+        self.seconds = Counter()  # type: Counter
+        self.counts = Counter()  # type: Counter
+        self.commit_latencies = []  # type: List[float]
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self.seconds[stage] += seconds
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        self.counts[counter] += amount
+
+    def merge(self, other: 'IngestStats') -> None:
+        self.seconds.update(other.seconds)
+        self.counts.update(other.counts)
+        self.commit_latencies.extend(other.commit_latencies)
+
+    def take(self) -> 'IngestStats':
+        """Return what was collected since the last call and start over."""
+        taken = IngestStats()
+        taken.seconds, self.seconds = self.seconds, Counter()
+        taken.counts, self.counts = self.counts, Counter()
+        taken.commit_latencies, self.commit_latencies = self.commit_latencies, []
+        return taken
+
+    def rate(self, counter: str, stage: str) -> Optional[float]:
+        """counter per second of stage, if any time was spent in it."""
+        return self.counts[counter] / self.seconds[stage] if self.seconds[stage] > 0 else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = sorted(self.commit_latencies)
+        return {
+            "stage_seconds": {stage: round(seconds, 4) for stage, seconds in sorted(self.seconds.items())},
+            "counts": dict(sorted(self.counts.items())),
+            "commit_latency_seconds": {
+                "count": len(latencies),
+                "mean": round(sum(latencies) / len(latencies), 4) if latencies else None,
+                "p50": round(latencies[len(latencies) // 2], 4) if latencies else None,
+                "max": round(latencies[-1], 4) if latencies else None,
+            },
+        }
+
+
+class ProgressLine:
+    """A progress line redrawn in place at most every interval seconds, with an ETA when the total is known."""
+
+    def __init__(self, total: Optional[int], interval: float = 1.0, stream: TextIO = sys.stdout):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.start = time.perf_counter()
+        self._last_draw = 0.0
+        self._drawn = False
+
+    def update(self, done: int, lines: int, force: bool = False) -> None:
+        now = time.perf_counter()
+        if not force and now - self._last_draw < self.interval:
+            return
+        self._last_draw = now
+        elapsed = max(now - self.start, 1e-9)
+        text = f"{done}" + (f"/{self.total} chunks ({100 * done / self.total:.1f}%)" if self.total else " chunks")
+        text += f", {lines} lines, {lines / elapsed:.0f} lines/sec"
+        if self.total and done:
+            remaining = elapsed / done * (self.total - done)
+            text += f", ETA {datetime.timedelta(seconds=round(remaining))}"
+        self.stream.write(f"\r{text}\033[K")
+        self.stream.flush()
+        self._drawn = True
+
+    def finish(self) -> None:
+        if self._drawn:
+            self.stream.write("\n")
+            self.stream.flush()
+
+
+def should_profile(source_name: str, sample_rate: float) -> bool:
+    """Deterministically picks about sample_rate of the sources, the same ones in every process and run."""
+    if sample_rate <= 0:
+        return False
+    digest = hashlib.blake2b(source_name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64 < sample_rate
+
+
+@contextmanager
+def profiled(profile_dir: Optional[str], source_name: str, stage: str) -> Iterator[None]:
+    """Run the block under cProfile and dump it to profile_dir (if given) for snakeviz/pstats."""
+    if not profile_dir:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        Path(profile_dir).mkdir(parents=True, exist_ok=True)
+        safe_name = ''.join(c if c.isalnum() or c in '.-_' else '_' for c in source_name)[-120:]
+        profiler.dump_stats(str(Path(profile_dir) / f"{safe_name}.{stage}.prof"))
+
+
+def write_run_report(path: str, report: Dict[str, Any]) -> None:
+    report_file = Path(path)
+    report_file.parent.mkdir(parents=True, exist_ok=True)
+    with report_file.open('w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,36 @@
+from typing import Dict, Iterable, List, Pattern, Tuple
+import re
+
+from library.settings_manager import settings
+
+# Unicode blocks that can be counted as kanji, by the names used in ingestion.kanji_blocks
+KANJI_BLOCKS = {
+    "cjk_unified": (0x4E00, 0x9FFF),
+    "cjk_ext_a": (0x3400, 0x4DBF),
+    "cjk_compat": (0xF900, 0xFAFF),
+    "cjk_ext_b": (0x20000, 0x2A6DF),
+    "cjk_compat_supplement": (0x2F800, 0x2FA1F),
+}  # type: Dict[str, Tuple[int, int]]
+DEFAULT_KANJI_BLOCKS = ["cjk_unified", "cjk_ext_a", "cjk_compat"]
+
+
+def compile_kanji_pattern(blocks: Iterable[str]) -> Pattern:
+    """A regex matching one character from any of the named blocks."""
+    ranges = []
+    for name in blocks:
+        if name not in KANJI_BLOCKS:
+            raise ValueError(f"Unknown kanji block '{name}', expected one of {', '.join(KANJI_BLOCKS)}")
+        start, end = KANJI_BLOCKS[name]
+        ranges.append(f"{chr(start)}-{chr(end)}")
+    if not ranges:
+        raise ValueError("At least one kanji block is needed")
+    return re.compile(f"[{''.join(ranges)}]")
+
+
+def kanji_blocks_from_settings() -> List[str]:
+    return list(settings.get_setting_fallback('ingestion.kanji_blocks', DEFAULT_KANJI_BLOCKS))
+
+
+def extract_kanji(text: str, pattern: Pattern) -> List[str]:
+    """The distinct kanji in text, sorted. Works on a single line or a whole chunk."""
+    return sorted(set(pattern.findall(text)))
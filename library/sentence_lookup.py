@@ -0,0 +1,120 @@
+from typing import Dict, List, Optional, Tuple
+import fugashi
+import os
+import sqlite3
+import threading
+
+from library.database_interface import (PROFILE_READ, ConnectionPool, Sentence, get_baseform,
+                                        get_sentences_for_baseform, get_sentences_for_baseforms,
+                                        get_sentences_for_kanji, get_sentences_for_kanjis)
+from library.lru_cache import LRUCache
+
+
+class SentenceLookup:
+    """
+    Example sentences for a word from the corpus database.
+    Words are lemmatized with one shared Tagger and results are kept in LRU caches; the sentence cache is dropped
+    whenever the database files change on disk, so a re-ingest is picked up without restarting the backend.
+    """
+
+    def __init__(self, db_path: str, cache_size: int = 1024, pool_size: int = 4):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, PROFILE_READ, size=pool_size)
+        self.baseform_cache = LRUCache(cache_size * 4)
+        self.sentence_cache = LRUCache(cache_size)
+        self._tagger = fugashi.Tagger()
+        self._tagger_lock = threading.Lock()  # MeCab taggers aren't thread safe
+        self._corpus_version = self._read_corpus_version()
+
+    def _read_corpus_version(self) -> Tuple[float, ...]:
+        # in WAL mode writes land in the -wal file and only reach the main file on checkpoint
+        # (readers opening the database create an empty -wal file, which doesn't count as a change)
+        version = []
+        for path in (self.db_path, self.db_path + "-wal"):
+            try:
+                stat = os.stat(path)
+                version.append(stat.st_mtime if stat.st_size else 0.0)
+            except FileNotFoundError:
+                version.append(0.0)
+        return tuple(version)
+
+    def _invalidate_if_corpus_changed(self) -> None:
+        corpus_version = self._read_corpus_version()
+        if corpus_version != self._corpus_version:
+            self._corpus_version = corpus_version
+            self.sentence_cache.clear()
+            self.pool.close_all()
+
+    def lemmatize(self, word: str) -> str:
+        baseform = self.baseform_cache.get(word)
+        if baseform is None:
+            with self._tagger_lock:
+                baseform = get_baseform(self._tagger, word)
+            self.baseform_cache.put(word, baseform)
+        return baseform
+
+    def lemmatize_all(self, words: List[str]) -> Dict[str, str]:
+        baseforms = {word: self.baseform_cache.get(word) for word in words}
+        uncached = [word for word, baseform in baseforms.items() if baseform is None]
+        if uncached:
+            with self._tagger_lock:
+                for word in uncached:
+                    baseforms[word] = get_baseform(self._tagger, word)
+            for word in uncached:
+                self.baseform_cache.put(word, baseforms[word])
+        return baseforms
+
+    def get_sentences(self, word: str, offset: int = 0, limit: Optional[int] = None) -> List[Sentence]:
+        self._invalidate_if_corpus_changed()
+        baseform = self.lemmatize(word)
+        sentences = self.sentence_cache.get(baseform)
+        if sentences is None:
+            sentences = self._query_sentences(word, baseform)
+            self.sentence_cache.put(baseform, sentences)
+        end = None if limit is None else offset + limit
+        return sentences[offset:end]
+
+    def _query_sentences(self, word: str, baseform: str) -> List[Sentence]:
+        try:
+            with self.pool.connection() as conn:
+                sentences = get_sentences_for_baseform(conn, baseform)
+                if not sentences and len(word) == 1:
+                    sentences = get_sentences_for_kanji(conn, word)
+                return sentences
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return []
+
+    def get_sentences_batch(self, words: List[str], limit: Optional[int] = None) -> Dict[str, List[Sentence]]:
+        """get_sentences for every word, with all the uncached words resolved by a single query."""
+        self._invalidate_if_corpus_changed()
+        baseforms = self.lemmatize_all(words)
+        by_baseform = {}  # type: Dict[str, List[Sentence]]
+        for baseform in set(baseforms.values()):
+            sentences = self.sentence_cache.get(baseform)
+            if sentences is not None:
+                by_baseform[baseform] = sentences
+
+        missing = sorted(set(baseforms.values()) - by_baseform.keys())
+        if missing:
+            by_baseform.update(self._query_sentences_batch(words, baseforms, missing))
+            for baseform in missing:
+                self.sentence_cache.put(baseform, by_baseform[baseform])
+
+        return {word: by_baseform[baseforms[word]][:limit] for word in words}
+
+    def _query_sentences_batch(self, words: List[str], baseforms: Dict[str, str],
+                               missing: List[str]) -> Dict[str, List[Sentence]]:
+        try:
+            with self.pool.connection() as conn:
+                found = get_sentences_for_baseforms(conn, missing)
+                # same single-kanji fallback as _query_sentences
+                kanji_words = [word for word in words
+                               if len(word) == 1 and baseforms[word] in found and not found[baseforms[word]]]
+                if kanji_words:
+                    for word, sentences in get_sentences_for_kanjis(conn, kanji_words).items():
+                        found[baseforms[word]] = sentences
+                return found
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return {baseform: [] for baseform in missing}
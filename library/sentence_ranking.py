@@ -0,0 +1,117 @@
+from typing import Callable, List, Optional, Set, Union
+import hashlib
+import math
+
+from library.settings_manager import settings
+
+CAP_POLICY_RANKED = "ranked"
+CAP_POLICY_RESERVOIR = "reservoir"
+
+
+class SentenceRanker:
+    """
+    Scores corpus lines as example sentences; higher is better.
+    Scores are computed once at ingestion and stored with each appearance, so only the best max_appearances lines of
+    each term are kept and lookups read them back in score order.
+    """
+
+    def __init__(self, known_words: Optional[Set[str]] = None, length_weight: float = 1.0,
+                 known_words_weight: float = 1.0, familiarity_weight: float = 1.0, diversity_penalty: float = 0.5,
+                 ideal_min_length: int = 8, ideal_max_length: int = 40, common_frequency: int = 1000):
+        self.known_words = known_words or set()
+        self.length_weight = length_weight
+        self.known_words_weight = known_words_weight
+        self.familiarity_weight = familiarity_weight
+        self.diversity_penalty = diversity_penalty
+        self.ideal_min_length = ideal_min_length
+        self.ideal_max_length = ideal_max_length
+        self.common_frequency = common_frequency
+        self.cap_policy = CAP_POLICY_RANKED
+        # whether score_appearance needs work_hits, which AppearanceWriter only tracks when asked
+        self.uses_work_hits = diversity_penalty != 0
+
+    @classmethod
+    def from_settings(cls, known_words: Optional[Set[str]] = None) -> 'SentenceRanker':
+        return cls(
+            known_words=known_words,
+            length_weight=settings.get_setting_fallback('sentence_ranking.length_weight', 1.0),
+            known_words_weight=settings.get_setting_fallback('sentence_ranking.known_words_weight', 1.0),
+            familiarity_weight=settings.get_setting_fallback('sentence_ranking.familiarity_weight', 1.0),
+            diversity_penalty=settings.get_setting_fallback('sentence_ranking.diversity_penalty', 0.5),
+            ideal_min_length=settings.get_setting_fallback('sentence_ranking.ideal_min_length', 8),
+            ideal_max_length=settings.get_setting_fallback('sentence_ranking.ideal_max_length', 40),
+            common_frequency=settings.get_setting_fallback('sentence_ranking.common_frequency', 1000),
+        )
+
+    def length_score(self, text: Optional[str]) -> float:
+        if text is None:
+            return 0.5
+        length = len(text.strip())
+        if length < self.ideal_min_length:
+            return length / self.ideal_min_length
+        if length > self.ideal_max_length:
+            return self.ideal_max_length / length
+        return 1.0
+
+    def known_words_score(self, baseforms: List[str]) -> float:
+        """Share of the line's words the user already knows; neutral when there's no known word list."""
+        if not self.known_words or not baseforms:
+            return 0.5
+        return sum(1 for baseform in baseforms if baseform in self.known_words) / len(baseforms)
+
+    def familiarity_score(self, baseforms: List[str], frequency_of: Callable[[str], int]) -> float:
+        """Close to 1 when the line's words are common in the corpus, close to 0 when they're rare."""
+        if not baseforms:
+            return 0.5
+        saturation = math.log1p(self.common_frequency)
+        return sum(min(1.0, math.log1p(frequency_of(baseform)) / saturation) for baseform in baseforms) / len(baseforms)
+
+    def score_line(self, text: Optional[str], baseforms: List[str], frequency_of: Callable[[str], int]) -> float:
+        total_weight = self.length_weight + self.known_words_weight + self.familiarity_weight
+        if total_weight <= 0:
+            return 0.0
+        return (self.length_weight * self.length_score(text)
+                + self.known_words_weight * self.known_words_score(baseforms)
+                + self.familiarity_weight * self.familiarity_score(baseforms, frequency_of)) / total_weight
+
+    def score_appearance(self, line_score: float, work_hits: int, term: str, source: str, line_number: int) -> float:
+        """
+        Each line of the same work (raw file or chunk folder) already kept for the term lowers the score, spreading
+        the picks across works.
+        """
+        return line_score / (1 + self.diversity_penalty * work_hits)
+
+
+class ReservoirSampler:
+    """
+    Keeps a uniform random sample of lines per term instead of the best ones (bottom-k sampling).
+    Every appearance gets a pseudo-random score hashed from (seed, term, source, line), and the highest scores are
+    kept. That is a single streaming pass whose result doesn't depend on processing order, and indexing a new source
+    only compares its lines against the stored scores, so samples rebalance without reprocessing the corpus.
+    """
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        self.cap_policy = f"{CAP_POLICY_RESERVOIR}:{seed}"
+        self.uses_work_hits = False
+
+    def score_line(self, text: Optional[str], baseforms: List[str], frequency_of: Callable[[str], int]) -> float:
+        return 0.0
+
+    def score_appearance(self, line_score: float, work_hits: int, term: str, source: str, line_number: int) -> float:
+        digest = hashlib.blake2b(f"{self.seed}\0{term}\0{source}\0{line_number}".encode('utf-8'),
+                                 digest_size=8).digest()
+        return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+AppearanceScorer = Union[SentenceRanker, ReservoirSampler]
+
+
+def make_appearance_scorer(known_words: Optional[Set[str]] = None) -> AppearanceScorer:
+    """The scorer for the ingestion.cap_policy setting."""
+    cap_policy = settings.get_setting_fallback('ingestion.cap_policy', CAP_POLICY_RANKED)
+    if cap_policy == CAP_POLICY_RANKED:
+        return SentenceRanker.from_settings(known_words)
+    if cap_policy == CAP_POLICY_RESERVOIR:
+        return ReservoirSampler(seed=settings.get_setting_fallback('ingestion.sample_seed', 0))
+    raise ValueError(f"{cap_policy} is unsupported for the setting ingestion.cap_policy")
@@ -0,0 +1,102 @@
+from typing import Iterable, List, Optional, Tuple
+import hashlib
+import sqlite3
+
+from library.lru_cache import LRUCache
+
+# (baseforms kept on the line, baseforms dropped by the part of speech filter)
+LineBaseforms = Tuple[Tuple[str, ...], Tuple[str, ...]]
+# (line key, baseforms) as written to the persistent store
+TokenCacheEntry = Tuple[bytes, LineBaseforms]
+
+# terms never contain control characters, so they can be joined into one column
+_TERM_SEPARATOR = '\x1f'
+
+
+def line_key(fingerprint: str, line: str) -> bytes:
+    """Content address of a line; the fingerprint keeps results from different tokenizer setups apart."""
+    return hashlib.blake2b(f"{fingerprint}\n{line}".encode('utf-8'), digest_size=16).digest()
+
+
+def _join_terms(terms: Tuple[str, ...]) -> str:
+    return _TERM_SEPARATOR.join(terms)
+
+
+def _split_terms(joined: str) -> Tuple[str, ...]:
+    return tuple(joined.split(_TERM_SEPARATOR)) if joined else ()
+
+
+def open_token_store(path: str, read_only: bool = False) -> sqlite3.Connection:
+    """Open (creating it unless read_only) the persistent line -> baseforms store shared across runs."""
+    if read_only:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS LineBaseforms (
+            line_key BLOB PRIMARY KEY,
+            baseforms TEXT NOT NULL,
+            filtered TEXT NOT NULL DEFAULT ''
+        ) WITHOUT ROWID
+    ''')
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(LineBaseforms)")}
+    if 'filtered' not in columns:
+        # stores written before filtering; their keys have an older fingerprint and never match again
+        conn.execute("ALTER TABLE LineBaseforms ADD COLUMN filtered TEXT NOT NULL DEFAULT ''")
+    conn.commit()
+    return conn
+
+
+def save_token_entries(conn: sqlite3.Connection, entries: Iterable[TokenCacheEntry]) -> int:
+    """Add entries to the persistent store (the caller commits). Returns how many were new."""
+    before = conn.total_changes
+    conn.executemany("INSERT OR IGNORE INTO LineBaseforms (line_key, baseforms, filtered) VALUES (?, ?, ?)",
+                     [(key, _join_terms(kept), _join_terms(filtered)) for key, (kept, filtered) in entries])
+    return conn.total_changes - before
+
+
+class TokenCache:
+    """
+    Line hash -> baseforms cache used while tokenizing, so repeated lines are only tagged once.
+    Lookups go to an in-process LRU first and then to the persistent store, if one is open. The store is only read
+    here; lines tokenized for the first time are queued in new_entries for the writing process to save.
+    """
+
+    def __init__(self, fingerprint: str, max_size: int, store: Optional[sqlite3.Connection] = None):
+        self.fingerprint = fingerprint
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.new_entries = []  # type: List[TokenCacheEntry]
+        self._lru = LRUCache(max_size)
+
+    def get(self, line: str) -> Tuple[bytes, Optional[LineBaseforms]]:
+        key = line_key(self.fingerprint, line)
+        baseforms = self._lru.get(key)
+        if baseforms is None and self.store is not None:
+            row = self.store.execute("SELECT baseforms, filtered FROM LineBaseforms WHERE line_key = ?",
+                                     (key,)).fetchone()
+            if row is not None:
+                baseforms = (_split_terms(row[0]), _split_terms(row[1]))
+                self._lru.put(key, baseforms)
+        if baseforms is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key, baseforms
+
+    def put(self, key: bytes, baseforms: LineBaseforms) -> None:
+        self._lru.put(key, baseforms)
+        if self.store is not None:
+            self.new_entries.append((key, baseforms))
+
+    def take_stats(self) -> Tuple[int, int, List[TokenCacheEntry]]:
+        """Return and reset (hits, misses, new entries) since the last call."""
+        stats = (self.hits, self.misses, self.new_entries)
+        self.hits = 0
+        self.misses = 0
+        self.new_entries = []
+        return stats
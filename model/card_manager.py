@@ -1,75 +1,229 @@
-from dataclasses import dataclass, asdict
-from typing import List, Dict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple, Union
 import json
+import os
 from pathlib import Path
 
-from library.anki_client import CardInfo, AnkiField
+from library.anki_client import CardInfo, CardRecord, AnkiField
+
+# card arguments can be full CardInfos (e.g. straight from an import); only their CardRecord is kept
+Card = Union[CardInfo, CardRecord]
+
+# 2: cards are saved as CardRecords
+SNAPSHOT_VERSION = 2
 
 
 @dataclass
 class CardManager:
-    current_cards: List[CardInfo]
-    history: List[CardInfo]
+    """
+    The current card list and the history of removed cards as CardRecords, each an insertion-ordered dict keyed by
+    (cardId, deckName), with a cardId index over the current cards.
+    State is persisted as a snapshot (save_path) plus an append-only log of operations next to it, so each change
+    writes one line instead of the whole file. The log is folded into the snapshot by compact, which runs on load and
+    should run on shutdown.
+    """
+    current_cards: Dict[Tuple[int, str], CardRecord]
+    history: Dict[Tuple[int, str], CardRecord]
     save_path: Path
+    _pending_ops: List[Dict] = field(default_factory=list, repr=False)
+    _batch_depth: int = field(default=0, repr=False)
+    # cardId -> keys of the current cards with that id, in insertion order
+    _current_by_id: Dict[int, Dict[Tuple[int, str], None]] = field(default_factory=dict, repr=False)
 
-    @classmethod
-    def load_from_file(cls, save_path: Path) -> 'CardManager':
-        if not save_path.exists():
-            return cls([], [], save_path)
-
-        with save_path.open('r', encoding='utf-8') as f:
-            data = json.load(f)
+    def __post_init__(self):
+        for key in self.current_cards:
+            self._current_by_id.setdefault(key[0], {})[key] = None
 
-        def dict_to_cardinfo(card_dict: Dict) -> CardInfo:
-            fields = {
-                k: AnkiField(**v) if isinstance(v, dict) else v
-                for k, v in card_dict['fields'].items()
-            }
-            card_dict['fields'] = fields
-            return CardInfo(**card_dict)
+    @property
+    def log_path(self) -> Path:
+        return self.save_path.with_name(self.save_path.name + '.log')
 
-        current_cards = [dict_to_cardinfo(card) for card in data.get('current_cards', [])]
-        history = [dict_to_cardinfo(card) for card in data.get('history', [])]
+    @staticmethod
+    def _dict_to_record(card_dict: Dict) -> CardRecord:
+        if 'fields' not in card_dict:
+            return CardRecord.from_dict(card_dict)
+        # saved before CardRecord, as a full CardInfo
+        fields = {
+            k: AnkiField(**v) if isinstance(v, dict) else v
+            for k, v in card_dict['fields'].items()
+        }
+        card_dict['fields'] = fields
+        return CardRecord.from_card(CardInfo(**card_dict))
 
-        return cls(current_cards, history, save_path)
+    @classmethod
+    def load_from_file(cls, save_path: Path) -> 'CardManager':
+        manager, outdated = cls._read_files(save_path)
+        if outdated:
+            manager._write_snapshot()
+        return manager
 
-    def _save_to_file(self) -> None:
+    @classmethod
+    def _read_files(cls, save_path: Path) -> Tuple['CardManager', bool]:
+        """The state in the snapshot plus the log, and whether the snapshot file needs rewriting to hold it."""
+        current_cards = {}
+        history = {}
+        migrate = False
+        if save_path.exists():
+            with save_path.open('r', encoding='utf-8') as f:
+                data = json.load(f)
+            for card_dict in data.get('current_cards', []):
+                card = cls._dict_to_record(card_dict)
+                current_cards.setdefault(cls._get_card_key(card), card)
+            for card_dict in data.get('history', []):
+                card = cls._dict_to_record(card_dict)
+                history.setdefault(cls._get_card_key(card), card)
+            # older snapshots hold full CardInfos; rewriting them as CardRecords shrinks the file
+            migrate = data.get('version', 1) < SNAPSHOT_VERSION
+
+        manager = cls(current_cards, history, save_path)
+        replayed = manager._replay_log()
+        return manager, bool(replayed) or migrate
+
+    def _replay_log(self) -> int:
+        """Apply the logged operations on top of the snapshot, returning how many there were."""
+        if not self.log_path.exists():
+            return 0
+        replayed = 0
+        with self.log_path.open('r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    # a write cut short by a crash; everything before it is intact
+                    break
+                self._batch_depth += 1  # replaying must not log the operations again
+                try:
+                    if op['op'] == 'add':
+                        self.add_card(self._dict_to_record(op['card']))
+                    elif op['op'] == 'remove':
+                        self.remove_card(self._dict_to_record(op['card']))
+                    elif op['op'] == 'clear_history':
+                        self.clear_history()
+                finally:
+                    self._batch_depth -= 1
+                replayed += 1
+        self._pending_ops = []
+        return replayed
+
+    def compact(self) -> None:
+        """
+        Fold the operation log into a new snapshot. The state is re-read from the files rather than taken from memory,
+        so a process holding an outdated copy (e.g. the reloader's parent in debug mode) can't overwrite newer changes.
+        """
+        self.flush()
+        on_disk, _ = self._read_files(self.save_path)
+        self.current_cards, self.history, self._current_by_id = (on_disk.current_cards, on_disk.history,
+                                                                 on_disk._current_by_id)
+        self._write_snapshot()
+
+    def _write_snapshot(self) -> None:
+        """Write the full state as the new snapshot (atomically) and empty the operation log."""
         data = {
-            'current_cards': [asdict(card) for card in self.current_cards],
-            'history': [asdict(card) for card in self.history]
+            'version': SNAPSHOT_VERSION,
+            'current_cards': [card.to_dict() for card in self.current_cards.values()],
+            'history': [card.to_dict() for card in self.history.values()]
         }
 
-        with self.save_path.open('w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        self.save_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.save_path.with_name(self.save_path.name + '.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.save_path)
+        if self.log_path.exists():
+            self.log_path.unlink()
+
+    def _log(self, op: str, card: Optional[CardRecord] = None) -> None:
+        entry = {'op': op}
+        if card is not None:
+            entry['card'] = card.to_dict()
+        self._pending_ops.append(entry)
+        if self._batch_depth == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        """Append the operations recorded since the last flush to the log in one write."""
+        if not self._pending_ops:
+            return
+        lines = ''.join(json.dumps(op, ensure_ascii=False) + '\n' for op in self._pending_ops)
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.log_path.open('a', encoding='utf-8') as f:
+            f.write(lines)
+        self._pending_ops = []
+
+    @contextmanager
+    def batch(self) -> Iterator['CardManager']:
+        """Group many changes into a single log write when the outermost batch ends."""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
 
     @staticmethod
-    def _get_card_key(card: CardInfo) -> tuple:
+    def _get_card_key(card: Card) -> tuple:
         return card.cardId, card.deckName
 
-    def add_card(self, card: CardInfo) -> None:
-        self.history = [h for h in self.history
-                        if self._get_card_key(h) != self._get_card_key(card)]
-
-        if not any(self._get_card_key(c) == self._get_card_key(card)
-                   for c in self.current_cards):
-            self.current_cards.append(card)
-            self._save_to_file()
-
-    def remove_card(self, card: CardInfo) -> None:
-        self.current_cards = [c for c in self.current_cards
-                              if self._get_card_key(c) != self._get_card_key(card)]
-
-        if not any(self._get_card_key(h) == self._get_card_key(card)
-                   for h in self.history):
-            self.history.append(card)
-            self._save_to_file()
-
-    def get_current_cards(self) -> List[CardInfo]:
-        return self.current_cards.copy()
-
-    def get_history(self) -> List[CardInfo]:
-        return self.history.copy()
+    def add_card(self, card: Card) -> bool:
+        """Move the card from the history to the end of the current cards; False if it was already current."""
+        card = CardRecord.from_card(card)
+        key = self._get_card_key(card)
+        changed = self.history.pop(key, None) is not None
+        added = key not in self.current_cards
+        if added:
+            self.current_cards[key] = card
+            self._current_by_id.setdefault(card.cardId, {})[key] = None
+            changed = True
+
+        if changed:
+            self._log('add', card)
+        return added
+
+    def remove_card(self, card: Card) -> bool:
+        """Move the card from the current cards to the history; False if it wasn't current."""
+        card = CardRecord.from_card(card)
+        key = self._get_card_key(card)
+        removed = self.current_cards.pop(key, None) is not None
+        changed = removed
+        if removed:
+            same_id = self._current_by_id[card.cardId]
+            del same_id[key]
+            if not same_id:
+                del self._current_by_id[card.cardId]
+
+        if key not in self.history:
+            self.history[key] = card
+            changed = True
+
+        if changed:
+            self._log('remove', card)
+        return removed
+
+    def add_cards(self, cards: Iterable[Card]) -> List[CardRecord]:
+        """add_card for each card with a single log write, returning the cards that weren't already current."""
+        with self.batch():
+            return [record for record in map(CardRecord.from_card, cards) if self.add_card(record)]
+
+    def remove_cards(self, cards: Iterable[Card]) -> List[CardRecord]:
+        """remove_card for each card with a single log write, returning the cards that were current."""
+        with self.batch():
+            return [record for record in list(map(CardRecord.from_card, cards)) if self.remove_card(record)]
+
+    def get_by_id(self, card_id: int) -> Optional[CardRecord]:
+        """The first added current card with this cardId."""
+        keys = self._current_by_id.get(card_id)
+        if not keys:
+            return None
+        return self.current_cards[next(iter(keys))]
+
+    def get_current_cards(self) -> List[CardRecord]:
+        return list(self.current_cards.values())
+
+    def get_history(self) -> List[CardRecord]:
+        return list(self.history.values())
 
     def clear_history(self) -> None:
-        self.history = []
-        self._save_to_file()
+        self.history = {}
+        self._log('clear_history')
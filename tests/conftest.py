@@ -0,0 +1,44 @@
+from dataclasses import replace
+from pathlib import Path
+from typing import Callable, List, Tuple
+import sys
+
+import pytest
+
+# the modules import each other from the repository root, as when the scripts are run from there
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from library.anki_client import AnkiField, CardInfo  # noqa: E402
+from library.database_interface import AppearanceWriter, get_db_connection, initialize_database  # noqa: E402
+from library.kanji_extraction import DEFAULT_KANJI_BLOCKS, compile_kanji_pattern, extract_kanji  # noqa: E402
+
+KANJI_PATTERN = compile_kanji_pattern(DEFAULT_KANJI_BLOCKS)
+
+
+@pytest.fixture
+def make_card() -> Callable[..., CardInfo]:
+    """Factory for a Basic card whose first field is word; keyword arguments override CardInfo fields."""
+    def make(card_id: int, word: str, **changes) -> CardInfo:
+        fields = {"Word": AnkiField(word, 0), "Meaning": AnkiField(f"meaning {card_id}", 1)}
+        card = CardInfo(cardId=card_id, fields=fields,
+                        question=f"<div>{word}</div>", answer=f"<div>{word}</div><hr>meaning {card_id}",
+                        modelName="Basic", ord=0, deckName="Japanese", css=".card {}", factor=2500, interval=3,
+                        note=card_id + 1_000_000, type=2, queue=2, due=100, reps=10, lapses=1, left=0,
+                        mod=1700000000, nextReviews=[])
+        return replace(card, **changes)
+    return make
+
+
+@pytest.fixture
+def add_corpus_lines() -> Callable[[str, str, List[Tuple[str, List[str]]]], None]:
+    """Writes a source file of (text, baseforms) lines to the corpus database at db_path, creating it if needed."""
+    def add(db_path: str, filename: str, lines: List[Tuple[str, List[str]]]) -> None:
+        initialize_database(db_path)
+        conn = get_db_connection(db_path)
+        writer = AppearanceWriter(conn)
+        sourcefile_id = writer.add_source_file(filename)
+        for line_number, (text, baseforms) in enumerate(lines):
+            writer.add_line(sourcefile_id, line_number, extract_kanji(text, KANJI_PATTERN), baseforms, text)
+        writer.flush()
+        conn.close()
+    return add
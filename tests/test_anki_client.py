@@ -0,0 +1,44 @@
+import pytest
+
+from benchmarks.fake_anki_connect import FakeAnkiConnect
+from library.anki_client import AnkiConnectClient
+
+
+@pytest.fixture
+def slow_fake(make_card):
+    # answers after the client has given up on the read
+    with FakeAnkiConnect([make_card(1, "猫")], latency=0.3) as fake:
+        yield fake
+
+
+@pytest.fixture
+def client(slow_fake):
+    client = AnkiConnectClient("127.0.0.1", slow_fake.port, timeout=0.05, retries=2)
+    yield client
+    client.close()
+
+
+def test_read_only_actions_are_retried_after_a_failed_read(client, slow_fake):
+    with pytest.raises(Exception):
+        client.find_cards("deck:*")
+    assert slow_fake.requests == 3
+
+    slow_fake.requests = 0
+    with pytest.raises(Exception):
+        with client.batch() as batch:
+            batch.invoke("findCards", query="deck:*")
+            batch.invoke("deckNames")
+    assert slow_fake.requests == 3
+
+
+def test_other_actions_are_sent_once(client, slow_fake):
+    with pytest.raises(Exception):
+        client.open_card_browser(1)
+    assert slow_fake.requests == 1
+
+    slow_fake.requests = 0
+    with pytest.raises(Exception):
+        with client.batch() as batch:
+            batch.invoke("findCards", query="deck:*")
+            batch.invoke("guiBrowse", query="nid:1")
+    assert slow_fake.requests == 1
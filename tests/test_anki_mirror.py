@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from benchmarks.fake_anki_connect import FakeAnkiConnect
+from library.anki_client import AnkiConnectClient
+from library.anki_mirror import AnkiMirror
+
+
+@pytest.fixture
+def cards(make_card):
+    return [
+        make_card(1, "猫"),
+        make_card(2, "Dog", deckName="Japanese::Animals"),
+        make_card(3, "鳥", deckName="Japanese Extra"),
+        make_card(4, "難しい", reps=40, factor=1300),
+        make_card(5, "易しい", reps=40, factor=2500),
+    ]
+
+
+@pytest.fixture
+def fake(cards):
+    now_ms = int(time.time() * 1000)
+    # [reviewTime, cardID, usn, buttonPressed, newInterval, previousInterval, newFactor, reviewDuration, reviewType]
+    reviews = [
+        [now_ms - 60_000, 1, -1, 1, 1, 3, 2500, 5000, 1],
+        [now_ms - 30_000, 2, -1, 3, 5, 3, 2500, 5000, 1],
+        [now_ms - 20 * 86_400_000, 3, -1, 1, 1, 3, 2500, 5000, 1],
+    ]
+    with FakeAnkiConnect(cards, reviews=reviews) as fake:
+        yield fake
+
+
+@pytest.fixture
+def mirror(tmp_path, fake):
+    client = AnkiConnectClient("127.0.0.1", fake.port, retries=0)
+    mirror = AnkiMirror(str(tmp_path / "mirror.db"), client)
+    assert mirror.sync()
+    yield mirror
+    mirror.conn.close()
+    client.close()
+
+
+def test_exact_match_ignores_case_and_filters_by_deck(mirror):
+    assert mirror.find_exact_match_card_ids("dog", limit=10) == [2]
+    assert mirror.find_exact_match_card_ids("猫", limit=10) == [1]
+    # deck:"Japanese" includes its subdecks but not a deck that only shares the prefix
+    assert mirror.find_exact_match_card_ids("dog", limit=10, deck_name="Japanese") == [2]
+    assert mirror.find_exact_match_card_ids("鳥", limit=10, deck_name="Japanese") == []
+
+
+def test_failed_cards_are_the_recent_again_answers(mirror):
+    assert mirror.find_failed_card_ids(days=7, limit=10) == [1]
+    assert mirror.find_failed_card_ids(days=30, limit=10) == [1, 3]
+    assert mirror.find_failed_card_ids(days=30, limit=1) == [3]
+
+
+def test_difficult_cards_have_many_reps_and_a_low_ease(tmp_path, cards):
+    # without reviews the mirror can't tell today's due day, so due cards aren't filtered
+    with FakeAnkiConnect(cards) as fake:
+        client = AnkiConnectClient("127.0.0.1", fake.port, retries=0)
+        mirror = AnkiMirror(str(tmp_path / "mirror.db"), client)
+        assert mirror.sync()
+        assert mirror.find_difficult_card_ids(limit=10) == [4]
+        assert mirror.find_difficult_card_ids(limit=10, reps=5, ease=3.0) == [1, 2, 3, 4, 5]
+        assert mirror.find_difficult_card_ids(limit=10, reps=5, ease=3.0, deck_name="Japanese") == [1, 2, 4, 5]
+        mirror.conn.close()
+        client.close()
+
+
+def test_iter_cards_keeps_the_requested_order(mirror):
+    assert [card.cardId for card in mirror.iter_cards([3, 99, 1])] == [3, 1]
+    assert next(mirror.iter_cards([2])).first_field == "Dog"
+
+
+def test_sync_picks_up_changed_and_deleted_cards(mirror, fake):
+    fake.cards[1]['fields']['Word']['value'] = "子猫"
+    fake.cards[1]['mod'] += 10
+    del fake.cards[5]
+
+    assert mirror.sync()
+
+    assert mirror.find_exact_match_card_ids("子猫", limit=10) == [1]
+    assert mirror.find_exact_match_card_ids("猫", limit=10) == []
+    assert [card.cardId for card in mirror.iter_cards([5])] == []
+
+
+def test_queries_keep_working_when_anki_is_closed(mirror, fake):
+    last_sync = mirror.last_sync
+    fake.stop()
+    # the fake's handler threads outlive it, so a pooled keep-alive connection would still be answered
+    mirror.client.close()
+    mirror.client = AnkiConnectClient("127.0.0.1", fake.port, retries=0)
+
+    assert not mirror.sync()
+
+    assert mirror.last_sync == last_sync
+    assert mirror.find_exact_match_card_ids("猫", limit=10) == [1]
+
+
+def test_sync_sends_two_requests_before_cards_info(mirror, fake):
+    fake.requests = 0
+    fake.actions.clear()
+    fake.cards[1]['mod'] += 10
+
+    assert mirror.sync()
+
+    assert fake.requests == 3
+    assert fake.actions.count("multi") == 2
+    assert fake.actions[-1] == "cardsInfo"
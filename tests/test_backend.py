@@ -0,0 +1,137 @@
+import json
+
+import pytest
+
+import backend
+from benchmarks.fake_anki_connect import FakeAnkiConnect
+from library.anki_client import AnkiConnectClient
+
+CORPUS_LINES = [("猫が好きです", ["猫", "が", "好き", "です"]), ("猫を飼う", ["猫", "を", "飼う"]),
+                ("犬が走る", ["犬", "が", "走る"])]
+
+
+@pytest.fixture
+def cards(make_card):
+    # cards 1 and 2 are difficult, 3 isn't, and 4 is a second card of the word of 1
+    return [make_card(1, "猫", reps=40, factor=1300), make_card(2, "犬", reps=50, factor=1200),
+            make_card(3, "鳥"), make_card(4, "猫", reps=45, factor=1250, deckName="Japanese::Animals")]
+
+
+@pytest.fixture
+def fake(cards):
+    with FakeAnkiConnect(cards) as fake:
+        yield fake
+
+
+@pytest.fixture
+def client(tmp_path, fake, add_corpus_lines):
+    corpus_db_file = str(tmp_path / "corpus.db")
+    add_corpus_lines(corpus_db_file, "a.txt", CORPUS_LINES)
+    app = backend.init_backend(card_manager_file=str(tmp_path / "cards.json"), corpus_db_file=corpus_db_file,
+                               anki_mirror_file=str(tmp_path / "mirror.db"), anki_port=fake.port)
+    yield app.test_client()
+    backend.sentence_lookup.pool.close_all()
+    backend.anki_mirror.conn.close()
+    backend.anki_client.close()
+
+
+def test_sentences_are_paged_by_offset_and_limit(client):
+    assert client.get('/api/sentences/猫').get_json() == [
+        {"sentence": "猫が好きです", "id": "a.txt:0"}, {"sentence": "猫を飼う", "id": "a.txt:1"}]
+    assert client.get('/api/sentences/猫?offset=1&limit=5').get_json() == [
+        {"sentence": "猫を飼う", "id": "a.txt:1"}]
+    assert client.get('/api/sentences/猫?limit=0').get_json() == []
+    # negative values are clamped rather than counted from the end
+    assert len(client.get('/api/sentences/猫?offset=-1&limit=-1').get_json()) == 0
+    assert len(client.get('/api/sentences/猫?offset=-1').get_json()) == 2
+
+
+def test_batch_defaults_to_the_current_card_words(client, make_card):
+    backend.card_manager.add_cards([make_card(1, "猫"), make_card(2, "走った")])
+
+    response = client.post('/api/sentences/batch', json={"limit": 1})
+
+    assert response.get_json() == {"猫": [{"sentence": "猫が好きです", "id": "a.txt:0"}],
+                                   "走った": [{"sentence": "犬が走る", "id": "a.txt:2"}]}
+    assert client.post('/api/sentences/batch', json={"words": ["犬", "鳥"]}).get_json() == {
+        "犬": [{"sentence": "犬が走る", "id": "a.txt:2"}], "鳥": []}
+
+
+@pytest.mark.parametrize("body", [{"words": "猫"}, {"words": ["猫", 1]}, {"words": ["猫"], "limit": "5"},
+                                  {"words": ["猫"], "limit": True}])
+def test_batch_rejects_malformed_bodies(client, body):
+    response = client.post('/api/sentences/batch', json=body)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def words(response):
+    return [(entry["id"], entry["word"]) for entry in response.get_json()]
+
+
+def test_cards_are_removed_by_id(client, cards):
+    backend.card_manager.add_cards(cards[:3])
+
+    assert words(client.post('/api/remove_card', json={"cardId": 2})) == [(1, "猫"), (3, "鳥")]
+    assert client.post('/api/remove_card', json={"cardId": 2}).status_code == 404
+    assert client.post('/api/remove_card', json={}).status_code == 400
+    assert words(client.get('/api/words')) == [(1, "猫"), (3, "鳥")]
+
+    assert words(client.post('/api/remove_all_cards')) == []
+    assert [card.cardId for card in backend.card_manager.get_history()] == [2, 1, 3]
+
+
+def test_anki_open_browses_the_note_of_a_current_card(client, cards, fake):
+    backend.card_manager.add_cards(cards[:1])
+
+    assert client.post('/api/anki_open', json={"cardId": 1}).status_code == 200
+    assert client.post('/api/anki_open', json={"cardId": 2}).status_code == 404
+    assert fake.actions[-1] == "guiBrowse"
+
+
+def test_imports_report_added_and_skipped_cards_with_delta(client):
+    first = client.get('/api/anki_import_difficult?delta=1').get_json()
+    assert first == {"added": [{"word": "猫", "id": 1}, {"word": "犬", "id": 2}, {"word": "猫", "id": 4}],
+                     "skipped": []}
+
+    assert client.get('/api/anki_import_difficult?delta=1').get_json() == {"added": [], "skipped": [1, 2, 4]}
+    assert words(client.get('/api/anki_import_exact?search=鳥')) == [(1, "猫"), (2, "犬"), (4, "猫"), (3, "鳥")]
+    assert client.get('/api/anki_import_exact').status_code == 400
+    # the fake has no reviews, so no card was answered Again
+    assert client.get('/api/anki_import_recent?delta=1').get_json() == {"added": [], "skipped": []}
+
+
+def test_removed_cards_can_be_imported_again(client):
+    client.get('/api/anki_import_exact?search=猫')
+    client.post('/api/remove_card', json={"cardId": 4})
+
+    assert client.get('/api/anki_import_exact?search=猫&delta=1').get_json() == {
+        "added": [{"word": "猫", "id": 4}], "skipped": [1]}
+
+
+def test_streamed_import_reports_progress_per_page(client, monkeypatch):
+    monkeypatch.setattr(backend, "IMPORT_PAGE_SIZE", 2)
+
+    response = client.get('/api/anki_import_difficult?stream=1&delta=1')
+
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == [
+        {"fetched": 2, "total": 3, "added": 2},
+        {"fetched": 3, "total": 3, "added": 3},
+        {"done": True, "result": {"added": [{"word": "猫", "id": 1}, {"word": "犬", "id": 2},
+                                            {"word": "猫", "id": 4}], "skipped": []}},
+    ]
+    assert words(client.get('/api/words')) == [(1, "猫"), (2, "犬"), (4, "猫")]
+
+
+@pytest.mark.parametrize("parallel", [1, 3])
+def test_cards_info_is_fetched_in_pages(fake, parallel):
+    client = AnkiConnectClient("127.0.0.1", fake.port, retries=0)
+    fake.actions.clear()
+
+    cards = list(client.iter_cards_info([4, 99, 2, 1, 3], page_size=2, parallel=parallel))
+
+    # the deleted card comes back empty and is skipped
+    assert [card.cardId for card in cards] == [4, 2, 1, 3]
+    assert fake.actions == ["cardsInfo"] * 3
+    client.close()
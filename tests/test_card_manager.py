@@ -0,0 +1,82 @@
+from dataclasses import asdict
+import json
+
+from library.anki_client import CardRecord
+from model.card_manager import SNAPSHOT_VERSION, CardManager
+
+
+def card_ids(cards):
+    return [card.cardId for card in cards]
+
+
+def test_log_is_replayed_on_load_and_folded_into_the_snapshot(tmp_path, make_card):
+    save_path = tmp_path / "cards.json"
+    manager = CardManager.load_from_file(save_path)
+    cards = [make_card(card_id, f"word{card_id}") for card_id in range(5)]
+    manager.add_cards(cards)
+    manager.remove_card(cards[1])
+    manager.clear_history()
+    manager.remove_cards(cards[3:])
+    manager.add_card(cards[4])
+    assert not save_path.exists()
+    assert len(manager.log_path.read_text(encoding='utf-8').splitlines()) == 10
+
+    loaded = CardManager.load_from_file(save_path)
+
+    assert card_ids(loaded.get_current_cards()) == [0, 2, 4]
+    assert card_ids(loaded.get_history()) == [3]
+    assert loaded.get_current_cards() == manager.get_current_cards()
+    assert loaded.get_by_id(4) == CardRecord.from_card(cards[4])
+    assert not loaded.log_path.exists()
+    assert json.loads(save_path.read_text(encoding='utf-8'))['version'] == SNAPSHOT_VERSION
+
+
+def test_replay_stops_at_a_truncated_log_line(tmp_path, make_card):
+    save_path = tmp_path / "cards.json"
+    manager = CardManager.load_from_file(save_path)
+    manager.add_cards([make_card(1, "猫"), make_card(2, "犬")])
+    with manager.log_path.open('a', encoding='utf-8') as f:
+        f.write('{"op": "remove", "card": {"cardId": 1')
+
+    assert card_ids(CardManager.load_from_file(save_path).get_current_cards()) == [1, 2]
+
+
+def test_batch_writes_the_log_once(tmp_path, make_card):
+    manager = CardManager.load_from_file(tmp_path / "cards.json")
+    with manager.batch():
+        manager.add_card(make_card(1, "猫"))
+        assert not manager.log_path.exists()
+        manager.add_card(make_card(2, "犬"))
+    assert len(manager.log_path.read_text(encoding='utf-8').splitlines()) == 2
+
+
+def test_compact_keeps_changes_made_by_another_process(tmp_path, make_card):
+    save_path = tmp_path / "cards.json"
+    stale = CardManager.load_from_file(save_path)
+    stale.add_card(make_card(1, "猫"))
+    current = CardManager.load_from_file(save_path)
+    current.remove_card(make_card(1, "猫"))
+
+    stale.compact()
+
+    reloaded = CardManager.load_from_file(save_path)
+    assert reloaded.get_current_cards() == []
+    assert card_ids(reloaded.get_history()) == [1]
+
+
+def test_old_save_file_with_full_card_infos_is_rewritten_as_records(tmp_path, make_card):
+    save_path = tmp_path / "cards.json"
+    # the original format: no version, every card saved as a full CardInfo
+    cards = [make_card(1, "猫"), make_card(2, "犬"), make_card(3, "鳥")]
+    save_path.write_text(json.dumps({"current_cards": [asdict(card) for card in cards[:2]],
+                                     "history": [asdict(cards[2])]}, ensure_ascii=False), encoding='utf-8')
+
+    manager = CardManager.load_from_file(save_path)
+
+    assert manager.get_current_cards() == [CardRecord.from_card(card) for card in cards[:2]]
+    assert manager.get_history() == [CardRecord.from_card(cards[2])]
+    assert manager.get_by_id(2).first_field == "犬"
+    data = json.loads(save_path.read_text(encoding='utf-8'))
+    assert data['version'] == SNAPSHOT_VERSION
+    assert data['current_cards'] == [CardRecord.from_card(card).to_dict() for card in cards[:2]]
+    assert CardManager.load_from_file(save_path).get_current_cards() == manager.get_current_cards()
@@ -0,0 +1,156 @@
+from typing import Callable, List, Optional
+import sqlite3
+
+import pytest
+
+from library.database_interface import (KIND_BASEFORM, KIND_KANJI, MIGRATIONS, AppearanceWriter, get_db_connection,
+                                        initialize_database)
+
+# the schema databases were created with before PRAGMA user_version migrations
+BASELINE_SCHEMA = """
+    CREATE TABLE SourceFiles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT UNIQUE NOT NULL
+    );
+    CREATE TABLE KanjiAppearances (
+        kanji TEXT NOT NULL,
+        sourcefile_id INTEGER NOT NULL,
+        line_number INTEGER NOT NULL,
+        FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
+        PRIMARY KEY (kanji, sourcefile_id, line_number)
+    );
+    CREATE TABLE BaseFormAppearances (
+        baseform TEXT NOT NULL,
+        sourcefile_id INTEGER NOT NULL,
+        line_number INTEGER NOT NULL,
+        FOREIGN KEY (sourcefile_id) REFERENCES SourceFiles(id),
+        PRIMARY KEY (baseform, sourcefile_id, line_number)
+    );
+    CREATE INDEX idx_kanji_appearances ON KanjiAppearances (kanji, sourcefile_id, line_number);
+    CREATE INDEX idx_baseform_appearances ON BaseFormAppearances (baseform, sourcefile_id, line_number);
+"""
+
+
+class LineTextScorer:
+    """Scores a line by the number in its text, with the diversity penalty of SentenceRanker when penalty is set."""
+
+    cap_policy = "test"
+
+    def __init__(self, penalty: float = 0.0):
+        self.penalty = penalty
+        self.uses_work_hits = penalty != 0
+
+    def score_line(self, text: Optional[str], baseforms: List[str], frequency_of: Callable[[str], int]) -> float:
+        return float(text)
+
+    def score_appearance(self, line_score: float, work_hits: int, term: str, source: str, line_number: int) -> float:
+        return line_score / (1 + self.penalty * work_hits)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    db_path = str(tmp_path / "corpus.db")
+    initialize_database(db_path)
+    conn = get_db_connection(db_path)
+    yield conn
+    conn.close()
+
+
+def kept_lines(conn: sqlite3.Connection, baseform: str) -> List[tuple]:
+    return [tuple(row) for row in conn.execute("""
+        SELECT s.filename, a.line_number FROM BaseFormAppearances a JOIN SourceFiles s ON s.id = a.sourcefile_id
+        WHERE a.baseform = ? ORDER BY s.filename, a.line_number
+    """, (baseform,))]
+
+
+def term_counts(conn: sqlite3.Connection, baseform: str) -> tuple:
+    return tuple(conn.execute("SELECT count, frequency FROM TermCounts WHERE kind = ? AND term = ?",
+                              (KIND_BASEFORM, baseform)).fetchone())
+
+
+def test_migrates_baseline_database(tmp_path):
+    db_path = str(tmp_path / "baseline.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO SourceFiles (filename) VALUES (?)",
+                     [("chunks/a/a.000000.txt",), ("chunks/b/b.000000.txt",)])
+    conn.executemany("INSERT INTO KanjiAppearances VALUES (?, ?, ?)", [("猫", 1, 0), ("猫", 2, 3), ("犬", 2, 4)])
+    conn.executemany("INSERT INTO BaseFormAppearances VALUES (?, ?, ?)", [("猫", 1, 0), ("猫", 2, 3)])
+    conn.commit()
+    conn.close()
+
+    initialize_database(db_path)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    assert sorted(conn.execute("SELECT kanji, sourcefile_id, line_number, score FROM KanjiAppearances")) == [
+        ("犬", 2, 4, 0.0), ("猫", 1, 0, 0.0), ("猫", 2, 3, 0.0)]
+    assert sorted(conn.execute("SELECT kind, term, count, frequency FROM TermCounts")) == [
+        (KIND_BASEFORM, "猫", 2, 2), (KIND_KANJI, "犬", 1, 1), (KIND_KANJI, "猫", 2, 2)]
+    assert sorted(conn.execute("SELECT filename, work, baseforms_indexed FROM SourceFiles")) == [
+        ("chunks/a/a.000000.txt", "chunks/a", 1), ("chunks/b/b.000000.txt", "chunks/b", 1)]
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"Lines", "Metadata", "RawFiles", "SourceTermCounts"} <= tables
+    conn.close()
+
+
+def test_writer_keeps_first_lines_without_a_scorer(conn):
+    writer = AppearanceWriter(conn, max_appearances=2)
+    sourcefile_id = writer.add_source_file("a.txt")
+    for line_number in range(3):
+        writer.add_line(sourcefile_id, line_number, [], ["猫"], "猫")
+    writer.flush()
+
+    assert kept_lines(conn, "猫") == [("a.txt", 0), ("a.txt", 1)]
+    assert term_counts(conn, "猫") == (2, 3)
+    assert writer.counts['appearances_dropped_by_cap'] == 1
+
+
+def test_writer_replaces_lower_scores_across_batches(conn):
+    writer = AppearanceWriter(conn, max_appearances=2, ranker=LineTextScorer())
+    first = writer.add_source_file("a.txt")
+    for line_number, score in enumerate(["1", "3"]):
+        writer.add_line(first, line_number, [], ["猫"], score)
+    writer.flush()
+    second = writer.add_source_file("b.txt")
+    for line_number, score in enumerate(["2", "0"]):
+        writer.add_line(second, line_number, [], ["猫"], score)
+    writer.flush()
+
+    assert kept_lines(conn, "猫") == [("a.txt", 1), ("b.txt", 0)]
+    assert term_counts(conn, "猫") == (2, 4)
+    assert writer.counts['appearances_replaced'] == 1
+    assert writer.counts['appearances_dropped_by_cap'] == 1
+
+
+def test_writer_penalizes_lines_kept_from_the_same_work(conn):
+    writer = AppearanceWriter(conn, max_appearances=3, ranker=LineTextScorer(penalty=1.0))
+    # two chunks of the same raw file: the penalty carries over from the first one
+    for chunk in range(2):
+        sourcefile_id = writer.add_source_file(f"a.txt#{chunk:06d}", work="a.txt")
+        writer.add_line(sourcefile_id, 0, [], ["猫"], "1")
+        writer.add_line(sourcefile_id, 1, [], ["猫"], "1")
+    writer.flush()
+    sourcefile_id = writer.add_source_file("b.txt#000000", work="b.txt")
+    writer.add_line(sourcefile_id, 0, [], ["猫"], "0.9")
+    writer.flush()
+
+    assert kept_lines(conn, "猫") == [("a.txt#000000", 0), ("a.txt#000000", 1), ("b.txt#000000", 0)]
+
+
+def test_deleting_a_source_subtracts_its_lines(conn):
+    writer = AppearanceWriter(conn, max_appearances=1)
+    sourcefile_ids = []
+    for filename in ("a.txt", "b.txt"):
+        sourcefile_id = writer.add_source_file(filename)
+        writer.add_line(sourcefile_id, 0, ["猫"], ["猫"], "猫")
+        writer.add_line(sourcefile_id, 1, ["猫"], ["猫"], "猫")
+        sourcefile_ids.append(sourcefile_id)
+    writer.flush()
+    assert term_counts(conn, "猫") == (1, 4)
+
+    writer.remove_source_files(sourcefile_ids[1:])
+    assert term_counts(conn, "猫") == (1, 2)
+    writer.remove_source_files(sourcefile_ids[:1])
+    assert term_counts(conn, "猫") == (0, 0)
+    assert conn.execute("SELECT COUNT(*) FROM SourceTermCounts").fetchone()[0] == 0
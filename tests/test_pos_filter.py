@@ -0,0 +1,45 @@
+from collections import Counter
+
+import fugashi
+import pytest
+
+from catalog_data import DEFAULT_POS_FILTER, PosFilter, should_keep_word, tokenize_text
+
+TEXT = "私は三匹の猫を飼っています。\n猫と犬。"
+
+
+@pytest.fixture(scope="module")
+def tagger():
+    return fugashi.Tagger()
+
+
+def test_default_filter_keeps_content_words(tagger):
+    kept = {word.surface for word in tagger("私は三匹の猫を飼っています。") if should_keep_word(word)}
+    # pronouns, numerals, counters, particles, auxiliaries and punctuation are dropped
+    assert kept == {"猫", "飼っ", "い"}
+
+
+def test_noun_subtypes_are_only_skipped_for_nouns(tagger):
+    numerals_kept = PosFilter(DEFAULT_POS_FILTER.skip_pos1, DEFAULT_POS_FILTER.skip_pos2, frozenset())
+    assert [should_keep_word(word, numerals_kept) for word in tagger("三")] == [True]
+    assert [should_keep_word(word) for word in tagger("三")] == [False]
+
+
+def test_filtered_baseforms_are_counted_once_per_line(tagger):
+    filtered_counts = Counter()
+    lines = tokenize_text(TEXT, tagger, pos_filter=DEFAULT_POS_FILTER, filtered_counts=filtered_counts)
+
+    assert [baseforms for _, _, _, baseforms in lines] == [["居る", "猫", "飼う"], ["犬", "猫"]]
+    assert filtered_counts["。"] == 2
+    assert filtered_counts["と"] == 1
+    assert "猫" not in filtered_counts
+
+
+def test_unfiltered_tokenizing_keeps_every_baseform(tagger):
+    lines = tokenize_text(TEXT, tagger)
+    assert "を" in lines[0][3] and "と" in lines[1][3]
+
+
+def test_fingerprint_changes_with_the_filter():
+    numerals_kept = PosFilter(DEFAULT_POS_FILTER.skip_pos1, DEFAULT_POS_FILTER.skip_pos2, frozenset())
+    assert numerals_kept.fingerprint() != DEFAULT_POS_FILTER.fingerprint()
@@ -0,0 +1,71 @@
+import sqlite3
+
+import pytest
+
+from catalog_data import iter_raw_chunks, process_raw_files, read_file_content
+
+RAW_FILES = {
+    "lines.txt": "一行目\n二行目\n\n四行目\n五行目\n六行目\n七行目",
+    "dialogue.tsv": "Name\tDialogue\n太郎\tこんにちは\n\t独り言\n花子\t\"二行に\n分かれた台詞\"\n\n太郎\tじゃあね\n",
+    "columns_swapped.tsv": "Dialogue\tName\tStart\nはい\t太郎\t0:01\nいいえ\t\t0:02\nまた\t花子\t0:03\n",
+    "line_endings.tsv": "Name\tDialogue\r\n太郎\tCRLF\r\n花子\tCRだけ\r次郎\t\"改行\r\n入り\"\r\n",
+    "unclosed_quote.tsv": "Name\tDialogue\n太郎\t\"閉じない\n引用\n最後まで\n",
+}
+
+
+@pytest.mark.parametrize("filename", sorted(RAW_FILES))
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_chunks_have_the_text_of_read_file_content(tmp_path, filename, chunk_size):
+    raw_file = tmp_path / filename
+    raw_file.write_bytes(RAW_FILES[filename].encode('utf-8'))
+
+    chunks = list(iter_raw_chunks(raw_file, chunk_size))
+
+    text = ''.join(chunk.text for chunk in chunks)
+    if raw_file.suffix == '.tsv':
+        # read_file_content joins the rows with newlines, a chunk ends each one with a newline
+        assert text == read_file_content(raw_file) + '\n'
+    else:
+        assert text == read_file_content(raw_file)
+    assert all(chunk.end_line - chunk.first_line <= chunk_size for chunk in chunks)
+    assert [chunk.first_line for chunk in chunks[1:]] == [chunk.end_line for chunk in chunks[:-1]]
+    assert [chunk.start_offset for chunk in chunks[1:]] == [chunk.end_offset for chunk in chunks[:-1]]
+    assert chunks[-1].end_offset == raw_file.stat().st_size
+
+
+@pytest.mark.parametrize("filename", sorted(RAW_FILES))
+def test_resuming_at_a_chunk_end_gives_the_remaining_chunks(tmp_path, filename):
+    raw_file = tmp_path / filename
+    raw_file.write_bytes(RAW_FILES[filename].encode('utf-8'))
+    chunks = list(iter_raw_chunks(raw_file, 2))
+
+    for index, chunk in enumerate(chunks):
+        resumed = list(iter_raw_chunks(raw_file, 2, chunk.end_offset, chunk.end_line))
+        assert resumed == chunks[index + 1:]
+
+
+def test_tsv_without_dialogue_column_is_rejected(tmp_path):
+    raw_file = tmp_path / "no_dialogue.tsv"
+    raw_file.write_text("Name\tText\n太郎\tこんにちは\n", encoding='utf-8')
+    with pytest.raises(ValueError):
+        list(iter_raw_chunks(raw_file, 10))
+
+
+def test_stream_run_skips_the_rest_of_an_unreadable_file(tmp_path, capsys):
+    raw_root = tmp_path / "raw"
+    raw_root.mkdir()
+    (raw_root / "a_bad_utf8.txt").write_bytes("猫が好き\n".encode('utf-8') * 3 + b"\xff\xfe\n" + "犬\n".encode('utf-8'))
+    (raw_root / "b_no_dialogue.tsv").write_text("Name\tText\n太郎\tこんにちは\n", encoding='utf-8')
+    (raw_root / "c_good.txt").write_text("鳥が飛ぶ\n", encoding='utf-8')
+    db_path = str(tmp_path / "corpus.db")
+
+    process_raw_files(db_path, str(raw_root), chunk_size=2)
+
+    output = capsys.readouterr().out
+    assert f"Error reading {raw_root / 'a_bad_utf8.txt'} in the chunk from line 2 (byte 26)" in output
+    assert f"Error reading {raw_root / 'b_no_dialogue.tsv'} in the chunk from line 0 (byte 0)" in output
+    conn = sqlite3.connect(db_path)
+    # the first chunk of the bad file is kept, the one with the bad byte and everything after it isn't
+    assert sorted(row[0] for row in conn.execute("SELECT filename FROM SourceFiles")) == [
+        str(raw_root / "a_bad_utf8.txt#000000"), str(raw_root / "c_good.txt#000000")]
+    conn.close()
@@ -0,0 +1,49 @@
+import pytest
+
+from library.sentence_lookup import SentenceLookup
+
+CAT_LINES = [("猫が好きです", ["猫", "が", "好き", "です"]), ("猫を飼う", ["猫", "を", "飼う"])]
+
+
+@pytest.fixture
+def db_path(tmp_path, add_corpus_lines):
+    db_path = str(tmp_path / "corpus.db")
+    add_corpus_lines(db_path, "a.txt", CAT_LINES)
+    return db_path
+
+
+@pytest.fixture
+def lookup(db_path):
+    lookup = SentenceLookup(db_path, cache_size=8, pool_size=1)
+    yield lookup
+    lookup.pool.close_all()
+
+
+def texts(sentences):
+    return [sentence.text for sentence in sentences]
+
+
+def test_inflected_words_are_looked_up_by_baseform(lookup):
+    assert texts(lookup.get_sentences("飼った")) == ["猫を飼う"]
+    assert texts(lookup.get_sentences("猫", offset=1, limit=5)) == ["猫を飼う"]
+
+
+def test_single_kanji_falls_back_to_kanji_appearances(lookup):
+    assert texts(lookup.get_sentences("飼")) == ["猫を飼う"]
+
+
+def test_batch_matches_single_lookups(lookup):
+    words = ["猫", "飼った", "飼", "鳥"]
+    batch = lookup.get_sentences_batch(words, limit=1)
+    assert {word: texts(sentences) for word, sentences in batch.items()} == {
+        word: texts(lookup.get_sentences(word, limit=1)) for word in words}
+
+
+def test_cached_sentences_are_dropped_when_the_corpus_changes(lookup, db_path, add_corpus_lines):
+    assert texts(lookup.get_sentences("犬")) == []
+    assert texts(lookup.get_sentences("猫")) == ["猫が好きです", "猫を飼う"]
+
+    add_corpus_lines(db_path, "b.txt", [("犬と猫", ["犬", "と", "猫"])])
+
+    assert texts(lookup.get_sentences("犬")) == ["犬と猫"]
+    assert texts(lookup.get_sentences("猫")) == ["猫が好きです", "猫を飼う", "犬と猫"]
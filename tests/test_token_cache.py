@@ -0,0 +1,50 @@
+import fugashi
+import pytest
+
+from catalog_data import DEFAULT_POS_FILTER, tokenize_text, tokenizer_fingerprint
+from library.token_cache import TokenCache, open_token_store, save_token_entries
+
+TEXT = "猫が好きです。\n\n犬を飼っている。\n猫が好きです。"
+
+
+@pytest.fixture(scope="module")
+def tagger():
+    return fugashi.Tagger()
+
+
+@pytest.fixture
+def fingerprint(tagger):
+    return tokenizer_fingerprint(tagger, DEFAULT_POS_FILTER)
+
+
+def test_cached_tokenizing_matches_uncached(tagger, fingerprint):
+    cache = TokenCache(fingerprint, max_size=16)
+
+    assert tokenize_text(TEXT, tagger, cache, pos_filter=DEFAULT_POS_FILTER) == tokenize_text(
+        TEXT, tagger, pos_filter=DEFAULT_POS_FILTER)
+    # the repeated line is a hit; without a store nothing is queued for saving
+    assert cache.take_stats() == (1, 2, [])
+
+
+def test_store_carries_lines_over_to_the_next_run(tmp_path, tagger, fingerprint):
+    store_path = str(tmp_path / "tokens.db")
+    store = open_token_store(store_path)
+    cache = TokenCache(fingerprint, max_size=16, store=store)
+    first_run = tokenize_text(TEXT, tagger, cache, pos_filter=DEFAULT_POS_FILTER)
+    hits, misses, entries = cache.take_stats()
+    assert (hits, misses, len(entries)) == (1, 2, 2)
+    assert save_token_entries(store, entries) == 2
+    assert save_token_entries(store, entries) == 0
+    store.commit()
+    store.close()
+
+    reader = open_token_store(store_path, read_only=True)
+    cache = TokenCache(fingerprint, max_size=16, store=reader)
+    assert tokenize_text(TEXT, tagger, cache, pos_filter=DEFAULT_POS_FILTER) == first_run
+    assert cache.take_stats() == (3, 0, [])
+
+    # another tokenizer setup doesn't reuse the stored lines
+    unfiltered = TokenCache(tokenizer_fingerprint(tagger), max_size=16, store=reader)
+    tokenize_text(TEXT, tagger, unfiltered)
+    assert unfiltered.take_stats()[:2] == (1, 2)
+    reader.close()